@@ -0,0 +1,494 @@
+"""Performance benchmarks for Cozy itself.
+
+Run with --help for options. There are three kinds of benchmarks:
+ - By default, measure enumeration throughput on the given specifications.
+ - With --replay FILE, rerun the solver queries recorded during an earlier run
+   with --record-solver-queries=FILE and report how long they take.
+ - With --suite, run full synthesis on each specification (SUITE if none are
+   given) in a fresh process with a pinned hash seed and timeout, write the
+   results as JSON (--output), and compare them against an earlier run
+   (--baseline). The exit status is nonzero if there are regressions.
+
+Important functions:
+ - load_implementation: parse a specification and build its initial
+   implementation, as the main entry point does
+ - enumeration_throughput: measure how quickly the enumerator produces
+   expressions for a query
+ - synthesis_benchmark: run synthesis on a specification and measure it
+ - run_suite: run synthesis_benchmark on several specifications, each in its
+   own process
+ - compare: find regressions between two sets of results
+ - replay_solver_queries: rerun recorded solver queries
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import statistics
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from cozy import parse
+from cozy import typecheck
+from cozy import desugar
+from cozy import invariant_preservation
+from cozy import synthesis
+from cozy import opts
+from cozy.common import read_file, unique, StopException
+from cozy.syntax import Visibility
+from cozy.target_syntax import *
+from cozy.syntax_tools import wrap_naked_statevars
+from cozy.contexts import RootCtx, shred
+from cozy.pools import STATE_POOL, RUNTIME_POOL
+from cozy.solver import satisfy, ModelCachingSolver, IncrementalSolver, query_cache, solver_pool, query_cache_size, load_recorded_queries, portfolio
+from cozy.evaluation import eval, uneval, compile_cache
+from cozy.cost_model import CostModel, asymptotic_runtime
+from cozy.wf import ExpIsNotWf, exp_wf
+from cozy.timeouts import Timeout
+from cozy.synthesis.enumeration import Enumerator
+from cozy.synthesis.acceleration import try_optimize
+
+# The standard synthesis suite: (specification, timeout in seconds). Changing
+# it invalidates saved baselines.
+SUITE = [
+    ("examples/basic.ds", 60),
+    ("examples/in.ds", 60),
+    ("examples/map.ds", 60),
+    ("examples/argmin.ds", 60),
+    ("examples/agg.ds", 120),
+]
+SEED = 0
+
+RESULTS_VERSION = 1
+
+def load_implementation(filename):
+    spec = parse.parse_spec(read_file(filename))
+    errors = typecheck.typecheck(spec)
+    if errors:
+        raise ValueError("{} does not typecheck: {}".format(filename, "; ".join(errors)))
+    spec = desugar.desugar(spec)
+    spec = invariant_preservation.add_implicit_handle_assumptions(spec)
+    return synthesis.construct_initial_implementation(spec)
+
+def _examples(target, assumptions, vars, funcs, n):
+    """
+    Find up to `n` models of `assumptions` on which `target` takes pairwise
+    different values.
+    """
+    res = []
+    formula = assumptions
+    while len(res) < n:
+        ex = satisfy(formula, vars=vars, funcs=funcs)
+        if ex is None:
+            break
+        res.append(ex)
+        try:
+            val = uneval(target.type, eval(target, ex))
+        except NotImplementedError:
+            break
+        formula = EAll([formula, ENot(EEq(target, val))])
+    return res
+
+def enumeration_throughput(impl, query, sizes, timeout=None, num_examples=3):
+    """
+    Enumerate expressions for the given query of the given implementation.
+
+    Yields (size, considered, accepted, seconds) tuples, one per size. The
+    counts are for that size alone; all smaller sizes are enumerated (but not
+    reported) first. If the timeout (a timedelta) expires, the current size is
+    reported with partial counts and enumeration stops.
+    """
+    state_vars = impl.abstract_state
+    funcs = impl.extern_funcs
+    ctx = RootCtx(
+        state_vars=state_vars,
+        args=[EVar(v).with_type(t) for (v, t) in query.args],
+        funcs=funcs)
+    assumptions = EAll(list(impl.spec.assumptions) + list(query.assumptions))
+    target = wrap_naked_statevars(query.ret, state_vars)
+    hints = [EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()]
+    examples = _examples(target, assumptions, [v for (v, p) in ctx.vars()], funcs, num_examples)
+
+    wf_solver = ModelCachingSolver(vars=[v for (v, p) in ctx.vars()], funcs=funcs)
+    considered = [0]
+    def check_wf(e, ctx, pool):
+        considered[0] += 1
+        try:
+            exp_wf(e, pool=pool, context=ctx, assumptions=assumptions, solver=wf_solver)
+        except ExpIsNotWf:
+            return False
+        return True
+
+    timeout = Timeout(timeout)
+    enum = Enumerator(
+        examples=examples,
+        cost_model=CostModel(funcs=funcs, assumptions=assumptions),
+        check_wf=check_wf,
+        hints=list(unique(itertools.chain(*[shred(h, ctx) for h in [target] + hints]))),
+        heuristics=try_optimize,
+        stop_callback=timeout.is_timed_out)
+
+    for size in range(max(sizes) + 1):
+        considered[0] = 0
+        accepted = 0
+        start = time.perf_counter()
+        try:
+            for pool in (STATE_POOL, RUNTIME_POOL):
+                for info in enum.enumerate_with_info(context=ctx, size=size, pool=pool):
+                    accepted += 1
+        except StopException:
+            if size in sizes:
+                yield (size, considered[0], accepted, time.perf_counter() - start)
+            return
+        if size in sizes:
+            yield (size, considered[0], accepted, time.perf_counter() - start)
+
+def replay_solver_queries(records, repeat=1):
+    """
+    Rerun recorded solver queries (see solver.load_recorded_queries). Each run
+    uses a fresh solver with the recorded declarations and assumptions, and
+    the query cache is disabled.
+
+    Yields (record, seconds, sat) for each run.
+    """
+    old_cache_size = query_cache_size.value
+    query_cache_size.value = 0
+    try:
+        for r in records:
+            for i in range(repeat):
+                solver = IncrementalSolver(
+                    vars=r.vars,
+                    funcs=r.funcs,
+                    collection_depth=r.collection_depth,
+                    min_collection_depth=r.min_collection_depth,
+                    validate_model=r.validate_model,
+                    logic=r.logic,
+                    timeout=r.timeout)
+                start = time.perf_counter()
+                for a in r.assumptions:
+                    solver.add_assumption(a)
+                sat = solver.satisfy(r.formula) is not None
+                yield (r, time.perf_counter() - start, sat)
+    finally:
+        query_cache_size.value = old_cache_size
+
+def time_distribution(times):
+    """
+    Summarize a nonempty list of durations as a dictionary.
+    """
+    times = sorted(times)
+    def percentile(p):
+        return times[min(len(times) - 1, int(p * len(times)))]
+    return {
+        "count": len(times),
+        "total": sum(times),
+        "mean": statistics.mean(times),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": times[-1] }
+
+def _print_distribution(label, times):
+    d = time_distribution(times)
+    print("{:<10} {:>7} {:>10.3f} {:>9.4f} {:>9.4f} {:>9.4f} {:>9.4f} {:>9.4f}".format(
+        label, d["count"], d["total"], d["mean"], d["p50"], d["p90"], d["p99"], d["max"]))
+
+def replay(path, indices=None, repeat=1, top=20):
+    records = list(load_recorded_queries(path))
+    if indices is not None:
+        records = [records[i] for i in indices]
+        numbers = list(indices)
+    else:
+        numbers = list(range(len(records)))
+    print("replaying {} of the solver queries in {}".format(len(records), path))
+    runs = { }
+    mismatches = 0
+    for (r, seconds, sat) in replay_solver_queries(records, repeat=repeat):
+        runs.setdefault(id(r), []).append(seconds)
+        if sat != r.sat:
+            mismatches += 1
+    if not records:
+        return
+
+    print()
+    print("{:<10} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}".format("", "queries", "total (s)", "mean", "p50", "p90", "p99", "max"))
+    _print_distribution("recorded", [r.seconds for r in records])
+    _print_distribution("replayed", [statistics.median(runs[id(r)]) for r in records])
+    sat = [r for r in records if r.sat]
+    unsat = [r for r in records if not r.sat]
+    if sat:
+        _print_distribution(" - sat", [statistics.median(runs[id(r)]) for r in sat])
+    if unsat:
+        _print_distribution(" - unsat", [statistics.median(runs[id(r)]) for r in unsat])
+
+    print()
+    print("slowest queries (median of {} runs):".format(repeat))
+    print("{:>7} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10}".format("query", "size", "sat", "recorded", "min", "median", "max"))
+    order = sorted(range(len(records)), key=lambda i: statistics.median(runs[id(records[i])]), reverse=True)
+    for i in order[:top]:
+        r = records[i]
+        times = runs[id(r)]
+        print("{:>7} {:>6} {:>6} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}".format(
+            numbers[i], r.formula.size(), str(r.sat), r.seconds, min(times), statistics.median(times), max(times)))
+    if portfolio.races:
+        print()
+        print("portfolio (wins/races):")
+        for name, (wins, races) in portfolio.stats().items():
+            print("  {:<14} {:>5}/{}".format(name, wins, races))
+    if mismatches:
+        print()
+        print("WARNING: {} runs disagreed with the recorded result".format(mismatches))
+
+def _peak_rss_kb():
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def synthesis_benchmark(filename, timeout):
+    """
+    Run synthesis on the given specification for `timeout` seconds and return
+    a dictionary of measurements. Times are in seconds since synthesis began.
+
+    For each public query, the result records when it first improved, when it
+    last improved, and the asymptotic runtime and size of its final
+    implementation. Solver calls and candidates considered are summed over
+    all synthesis jobs, including jobs for subqueries.
+    """
+    impl = load_implementation(filename)
+    public = [q.name for q in impl.query_specs if q.visibility == Visibility.Public]
+    rets = { name : impl.query_impls[name].ret for name in public }
+    first = { }
+    last = { }
+    job_metrics = { }
+
+    start = time.perf_counter()
+    def progress_callback(res):
+        now = time.perf_counter() - start
+        new_impl, code, concretization_functions = res
+        for name in public:
+            q = new_impl.query_impls.get(name)
+            if q is not None and q.ret != rets[name]:
+                rets[name] = q.ret
+                first.setdefault(name, now)
+                last[name] = now
+    def metrics_callback(metrics):
+        job_metrics.update(metrics)
+
+    impl = synthesis.improve_implementation(
+        impl,
+        timeout=datetime.timedelta(seconds=timeout),
+        progress_callback=progress_callback,
+        metrics_callback=metrics_callback)
+    wall = time.perf_counter() - start
+
+    queries = { }
+    for name in public:
+        ret = impl.query_impls[name].ret
+        queries[name] = {
+            "time_to_first_improvement": first.get(name),
+            "time_to_final": last.get(name),
+            "runtime": asymptotic_runtime(ret),
+            "size": ret.size() }
+    considered = sum(m.get("considered", 0) for m in job_metrics.values())
+    return {
+        "spec": filename,
+        "timeout": timeout,
+        "wall_seconds": wall,
+        "peak_rss_kb": _peak_rss_kb(),
+        "solver_calls": sum(m.get("solver_calls", 0) for m in job_metrics.values()),
+        "solver_cache_hits": sum(m.get("solver_cache_hits", 0) for m in job_metrics.values()),
+        "eval_cache_hits": sum(m.get("eval_cache_hits", 0) for m in job_metrics.values()),
+        "eval_cache_misses": sum(m.get("eval_cache_misses", 0) for m in job_metrics.values()),
+        "considered": considered,
+        "considered_per_second": considered / wall if wall > 0 else 0.0,
+        "queries": queries }
+
+def run_suite(suite, seed=SEED, extra_args=()):
+    """
+    Run synthesis_benchmark on each (specification, timeout) pair of `suite`,
+    each in a fresh interpreter with PYTHONHASHSEED=seed. Returns a results
+    dictionary suitable for `compare`.
+    """
+    results = []
+    env = dict(os.environ)
+    env["PYTHONHASHSEED"] = str(seed)
+    for (filename, timeout) in suite:
+        print("benchmarking {} for {}s...".format(filename, timeout))
+        (fd, out) = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            subprocess.run(
+                [sys.executable, "-m", "cozy.bench", "--synthesize",
+                    "-t", str(timeout), "--output", out] + list(extra_args) + [filename],
+                env=env, stdout=subprocess.DEVNULL, check=True)
+            with open(out) as f:
+                results.extend(json.load(f)["results"])
+        finally:
+            os.remove(out)
+    return { "version": RESULTS_VERSION, "seed": seed, "results": results }
+
+def compare(results, baseline, time_tolerance=0.5, cost_tolerance=0.0, memory_tolerance=0.5):
+    """
+    Compare two results dictionaries (see run_suite). Returns a list of
+    human-readable regressions; specifications and queries missing from
+    either side are ignored.
+
+    Tolerances are fractions of the baseline value. A time or memory
+    regression must exceed the baseline by more than the tolerance, and so
+    must a regression in the final runtime or size of a query.
+    """
+    regressions = []
+    def worse(what, new, old, tolerance, higher_is_better=False):
+        if new is None or old is None:
+            return
+        if higher_is_better:
+            bad = new < old * (1 - tolerance)
+        else:
+            bad = new > old * (1 + tolerance)
+        if bad:
+            regressions.append("{}: {} (baseline: {})".format(what, _fmt(new), _fmt(old)))
+
+    old_by_spec = { r["spec"] : r for r in baseline["results"] }
+    for r in results["results"]:
+        old = old_by_spec.get(r["spec"])
+        if old is None:
+            continue
+        spec = r["spec"]
+        worse("{} peak RSS (KB)".format(spec), r["peak_rss_kb"], old["peak_rss_kb"], memory_tolerance)
+        worse("{} candidates/second".format(spec), r["considered_per_second"], old["considered_per_second"], time_tolerance, higher_is_better=True)
+        for name, q in r["queries"].items():
+            old_q = old["queries"].get(name)
+            if old_q is None:
+                continue
+            what = "{} {}".format(spec, name)
+            if q["time_to_first_improvement"] is None and old_q["time_to_first_improvement"] is not None:
+                regressions.append("{}: no improvement (baseline: first after {})".format(what, _fmt(old_q["time_to_first_improvement"])))
+            worse(what + " time to first improvement", q["time_to_first_improvement"], old_q["time_to_first_improvement"], time_tolerance)
+            worse(what + " final runtime", q["runtime"], old_q["runtime"], cost_tolerance)
+            worse(what + " final size", q["size"], old_q["size"], cost_tolerance)
+            # Finishing later is fine if it bought a better result.
+            if (q["runtime"], q["size"]) >= (old_q["runtime"], old_q["size"]):
+                worse(what + " time to final", q["time_to_final"], old_q["time_to_final"], time_tolerance)
+    return regressions
+
+def _fmt(x):
+    return "{:.2f}".format(x) if isinstance(x, float) else str(x)
+
+def print_results(results):
+    print("{:<24} {:<16} {:>10} {:>10} {:>8} {:>6}".format("spec", "query", "first (s)", "final (s)", "runtime", "size"))
+    for r in results["results"]:
+        for name, q in r["queries"].items():
+            print("{:<24} {:<16} {:>10} {:>10} {:>8} {:>6}".format(
+                r["spec"], name,
+                _fmt(q["time_to_first_improvement"]) if q["time_to_first_improvement"] is not None else "-",
+                _fmt(q["time_to_final"]) if q["time_to_final"] is not None else "-",
+                q["runtime"], q["size"]))
+    print()
+    print("{:<24} {:>10} {:>12} {:>12} {:>12}".format("spec", "seconds", "peak RSS KB", "solver calls", "exps/sec"))
+    for r in results["results"]:
+        print("{:<24} {:>10.1f} {:>12} {:>12} {:>12.1f}".format(
+            r["spec"], r["wall_seconds"], r["peak_rss_kb"], r["solver_calls"], r["considered_per_second"]))
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmarks for Cozy itself.")
+    parser.add_argument("--min-size", metavar="N", type=int, default=3, help="Smallest expression size to report; default=3")
+    parser.add_argument("--max-size", metavar="N", type=int, default=6, help="Largest expression size to enumerate; default=6")
+    parser.add_argument("-t", "--timeout", metavar="N", type=float, default=None, help="Per-query enumeration timeout (in seconds; default=300), or with --synthesize, the synthesis timeout (default=60)")
+    parser.add_argument("--examples", metavar="N", type=int, default=3, help="Number of examples to fingerprint against; default=3")
+    parser.add_argument("--query", metavar="NAME", action="append", default=None, help="Only benchmark the given query (may be repeated)")
+
+    replay_opts = parser.add_argument_group("Solver benchmarks")
+    replay_opts.add_argument("--replay", metavar="FILE", default=None, help="Rerun the solver queries recorded in FILE with --record-solver-queries")
+    replay_opts.add_argument("--replay-query", metavar="N", type=int, action="append", default=None, help="Only rerun the Nth recorded query (may be repeated)")
+    replay_opts.add_argument("--repeat", metavar="N", type=int, default=1, help="Run each replayed query N times; default=1")
+    replay_opts.add_argument("--top", metavar="N", type=int, default=20, help="Number of slowest replayed queries to list; default=20")
+
+    suite_opts = parser.add_argument_group("Synthesis benchmarks")
+    suite_opts.add_argument("--suite", action="store_true", help="Run the synthesis suite on the given specifications, or on the standard suite if none are given, each in a fresh process")
+    suite_opts.add_argument("--synthesize", action="store_true", help="Run synthesis benchmarks in this process")
+    suite_opts.add_argument("--seed", metavar="N", type=int, default=SEED, help="Hash seed for --suite; default={}".format(SEED))
+    suite_opts.add_argument("--output", metavar="FILE.json", default=None, help="Save synthesis results to this file")
+    suite_opts.add_argument("--baseline", metavar="FILE.json", default=None, help="Compare synthesis results to those saved in this file")
+    suite_opts.add_argument("--time-tolerance", metavar="F", type=float, default=0.5, help="Allowed slowdown, as a fraction of the baseline; default=0.5")
+    suite_opts.add_argument("--cost-tolerance", metavar="F", type=float, default=0.0, help="Allowed increase in final query cost, as a fraction of the baseline; default=0.0")
+    suite_opts.add_argument("--memory-tolerance", metavar="F", type=float, default=0.5, help="Allowed increase in peak RSS, as a fraction of the baseline; default=0.5")
+
+    internal_opts = parser.add_argument_group("Internal parameters")
+    opts.setup(internal_opts)
+
+    parser.add_argument("files", nargs="*", help="Input specifications (e.g. examples/graph.ds)")
+    args = parser.parse_args()
+    opts.read(args)
+
+    if args.replay is not None:
+        replay(args.replay, indices=args.replay_query, repeat=args.repeat, top=args.top)
+        return
+
+    if args.suite or args.synthesize:
+        if args.synthesize:
+            if not args.files:
+                parser.error("--synthesize needs at least one specification")
+            timeout = args.timeout if args.timeout is not None else 60
+            results = { "version": RESULTS_VERSION, "seed": args.seed, "results": [
+                synthesis_benchmark(filename, timeout) for filename in args.files] }
+        else:
+            suite = [(f, args.timeout if args.timeout is not None else 60) for f in args.files] if args.files else [
+                (f, args.timeout if args.timeout is not None else t) for (f, t) in SUITE]
+            results = run_suite(suite, seed=args.seed)
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        print()
+        print_results(results)
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline,
+                time_tolerance=args.time_tolerance,
+                cost_tolerance=args.cost_tolerance,
+                memory_tolerance=args.memory_tolerance)
+            print()
+            if regressions:
+                print("{} regressions:".format(len(regressions)))
+                for r in regressions:
+                    print(" - {}".format(r))
+                sys.exit(1)
+            print("No regressions.")
+        return
+
+    if not args.files:
+        parser.error("no specifications given")
+    if args.timeout is None:
+        args.timeout = 300
+
+    sizes = list(range(args.min_size, args.max_size + 1))
+    rows = []
+    for filename in args.files:
+        impl = load_implementation(filename)
+        for q in impl.query_specs:
+            if args.query is not None and q.name not in args.query:
+                continue
+            for (size, considered, accepted, seconds) in enumeration_throughput(
+                    impl, q, sizes,
+                    timeout=datetime.timedelta(seconds=args.timeout),
+                    num_examples=args.examples):
+                rows.append((filename, q.name, size, considered, accepted, seconds))
+
+    print()
+    print("{:<24} {:<16} {:>4} {:>10} {:>10} {:>9} {:>12}".format("spec", "query", "size", "considered", "accepted", "seconds", "exps/sec"))
+    for (filename, qname, size, considered, accepted, seconds) in rows:
+        print("{:<24} {:<16} {:>4} {:>10} {:>10} {:>9.2f} {:>12.1f}".format(
+            filename, qname, size, considered, accepted, seconds,
+            considered / seconds if seconds > 0 else 0.0))
+    print()
+    print("compiled-expression cache: {} hits, {} misses".format(compile_cache.hits, compile_cache.misses))
+    print("solver query cache: {} hits, {} misses".format(query_cache.hits, query_cache.misses))
+    print("solver pool: {} hits, {} misses, {} evictions".format(solver_pool.hits, solver_pool.misses, solver_pool.evictions))
+
+if __name__ == "__main__":
+    run()
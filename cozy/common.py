@@ -129,15 +129,41 @@ def my_caller(up=0):
     frame = frame[0]
     return inspect.getframeinfo(frame)
 
+# Incremented whenever an attribute of an existing ADT is reassigned (other
+# than `type` and private attributes). Results cached on ADT nodes are
+# tagged with the value of this counter when they were computed, and are
+# ignored once it changes, since the node or one of its descendants may have
+# been modified in place.
+_mutation_count = 0
+
+def cached_result(x, attr):
+    """
+    Returns the value cached on `x` under `attr` by `cache_result`, or None if
+    there is no such value or if some ADT has been modified since.
+    """
+    c = x.__dict__.get(attr)
+    if c is not None and c[0] == _mutation_count:
+        return c[1]
+    return None
+
+def cache_result(x, attr, value):
+    x.__dict__[attr] = (_mutation_count, value)
+
 def _size(x):
     wq = [x]
     res = 0
     while wq:
         x = wq.pop()
-        res += 1
         if isinstance(x, ADT):
+            n = cached_result(x, "_size_cache")
+            if n is not None:
+                res += n
+                continue
+            res += 1
             wq.extend(x.children())
-        elif isinstance(x, list) or isinstance(x, tuple):
+            continue
+        res += 1
+        if isinstance(x, list) or isinstance(x, tuple):
             wq.extend(x)
         elif isinstance(x, dict):
             wq.extend(x.items())
@@ -148,7 +174,11 @@ class ADT(object):
     def children(self):
         return ()
     def size(self):
-        return _size(self)
+        n = cached_result(self, "_size_cache")
+        if n is None:
+            n = _size(self)
+            cache_result(self, "_size_cache", n)
+        return n
     def contains_subtree(self, tree):
         if self == tree:
             return True
@@ -172,17 +202,23 @@ class ADT(object):
         if not hasattr(self, "_hash"):
             self._hash = hash(self.children())
         return self._hash
+    def __setattr__(self, name, value):
+        if name[0] != "_" and name != "type" and hasattr(self, name):
+            global _mutation_count
+            _mutation_count += 1
+        object.__setattr__(self, name, value)
     def __getstate__(self):
         d = dict(self.__dict__)
-        if "_hash" in d:
-            del d["_hash"]
+        for k in ("_hash", "_size_cache", "_free_vars_cache", "_alpha_key_cache"):
+            if k in d:
+                del d[k]
         if hasattr(self, "__slots__"):
             for a in self.__slots__:
                 d[a] = getattr(self, a)
         return d
     def __setstate__(self, d):
         for k, v in d.items():
-            setattr(self, k, v)
+            object.__setattr__(self, k, v)
     def __eq__(self, other):
         if self is other: return True
         return type(self) is type(other) and self.children() == other.children()
@@ -262,6 +298,8 @@ class FrozenDict(_FrozenDict):
     """
     def __lt__(self, other):
         return tuple(sorted(self.items())) < tuple(sorted(other.items()))
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
 
 _MISSING = object()
 class OrderedDefaultDict(OrderedDict):
@@ -412,7 +450,8 @@ def declare_case(supertype, name, attrs=()):
         assert len(args) == len(attrs), "{} expects {} args, was given {}".format(name, len(attrs), len(args))
         supertype.__init__(self)
         for attr, val in zip(attrs, args):
-            setattr(self, attr, val)
+            # skip ADT.__setattr__; a new node has no cached results
+            object.__setattr__(self, attr, val)
     def children(self):
         return tuple(getattr(self, a) for a in attrs)
     t = type(name, (supertype,), {
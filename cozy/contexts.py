@@ -18,7 +18,7 @@ from cozy.common import OrderedSet, unique, Visitor
 from cozy.syntax import TFunc, Exp, EVar, EAll
 from cozy.target_syntax import EDeepIn
 from cozy.evaluation import eval
-from cozy.syntax_tools import pprint, alpha_equivalent, free_vars, subst, BottomUpRewriter
+from cozy.syntax_tools import pprint, alpha_equivalent, alpha_key, free_vars, subst, BottomUpRewriter
 from cozy.pools import Pool, RUNTIME_POOL, STATE_POOL
 
 class Context(object):
@@ -42,6 +42,16 @@ class Context(object):
         raise NotImplementedError()
     def alpha_equivalent(self, other) -> bool:
         raise NotImplementedError()
+    def alpha_key(self):
+        """
+        A hashable key that is equal for alpha-equivalent contexts.
+        """
+        raise NotImplementedError()
+    def binders(self) -> (str,):
+        """
+        Names of the variables bound by this context, outermost first.
+        """
+        raise NotImplementedError()
     def adapt(self, e : Exp, ctx) -> Exp:
         raise NotImplementedError()
     def path_conditions(self) -> [Exp]:
@@ -57,6 +67,9 @@ class RootCtx(Context):
         self.args = OrderedSet(args)
         self.functions = OrderedDict(funcs or ())
         assert not (self.state_vars & self.args)
+        # NOTE: computed once, since contexts are used as keys in long-lived
+        # caches and OrderedSets clear themselves when garbage-collected
+        self._hash = hash((tuple(self.state_vars), tuple(self.args)))
     def vars(self):
         return OrderedSet(itertools.chain(
             [(v, STATE_POOL)   for v in self.state_vars],
@@ -69,6 +82,10 @@ class RootCtx(Context):
         return examples
     def alpha_equivalent(self, other):
         return self == other
+    def alpha_key(self):
+        return self
+    def binders(self):
+        return ()
     def adapt(self, e : Exp, ctx) -> Exp:
         if self == ctx:
             return e
@@ -78,7 +95,7 @@ class RootCtx(Context):
     def generalize(self, fvs):
         return self
     def __hash__(self):
-        return hash((tuple(self.state_vars), tuple(self.args)))
+        return self._hash
     def __eq__(self, other):
         return isinstance(other, RootCtx) and (self.state_vars, self.args) == (other.state_vars, other.args)
     def __repr__(self):
@@ -95,6 +112,7 @@ class UnderBinder(Context):
         self.var = v
         self.bag = bag
         self.pool = bag_pool
+        self._alpha_key = None
     def vars(self):
         return self._parent.vars() | {(self.var, self.pool)}
     def funcs(self):
@@ -119,6 +137,15 @@ class UnderBinder(Context):
         if not self._parent.alpha_equivalent(other._parent):
             return False
         return alpha_equivalent(self.bag, self._parent.adapt(other.bag, other._parent))
+    def alpha_key(self):
+        if self._alpha_key is None:
+            self._alpha_key = (
+                self._parent.alpha_key(),
+                self.var.type,
+                alpha_key(self.bag, binders=self._parent.binders()))
+        return self._alpha_key
+    def binders(self):
+        return self._parent.binders() + (self.var.id,)
     def adapt(self, e : Exp, ctx) -> Exp:
         if self == ctx:
             return e
@@ -51,7 +51,7 @@ class CostModel(object):
         if e1_constant and e2_constant:
             e1v = eval(e1, {})
             e2v = eval(e2, {})
-            event("comparison obvious on constants: {} vs {}".format(e1v, e2v))
+            event("comparison obvious on constants: {} vs {}", e1v, e2v)
             return order_objects(e1v, e2v)
         if alpha_equivalent(e1, e2):
             event("shortcutting comparison of identical terms")
@@ -5,39 +5,65 @@ Important functions:
  - eval_bulk: execute the same expression on many different environments
 """
 
-from collections import UserDict, defaultdict, namedtuple
+from collections import UserDict, OrderedDict, defaultdict, namedtuple
 from functools import total_ordering, cmp_to_key, lru_cache
 import itertools
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from cozy.target_syntax import *
-from cozy.syntax_tools import equal, pprint, free_vars, free_funcs, all_exps, purify
+from cozy.syntax_tools import equal, pprint, free_vars, free_funcs, all_exps, purify, alpha_key
 from cozy.common import FrozenDict, OrderedSet, extend
 from cozy.typecheck import is_numeric, is_collection
 from cozy.structures import extension_handler
+from cozy.opts import Option
+
+vectorize_threshold = Option("vectorize-threshold", int, 32, metavar="N",
+    description="Use NumPy to evaluate integer and boolean operations when evaluating an expression on at least N environments at once (has no effect if NumPy is not installed)")
+compile_cache_size = Option("eval-cache-size", int, 4096, metavar="N",
+    description="Number of compiled expressions to keep for reuse by the interpreter (0 disables the cache)")
 
 @total_ordering
 class Map(object):
     def __init__(self, type, default, items=()):
         self.type = type
         self._items = []
+        self._index = None
+        self._key = _key_function(type.k)
+        self._cmp = comparator(type.k)
+        if self._key is not None:
+            self._index = { } # key(k) -> index into self._items
         for (k, v) in items:
             self[k] = v
         self.default = default
-    def __setitem__(self, k, v):
+    def _find(self, k):
+        if self._index is not None:
+            return self._index.get(self._key(k))
         for i in range(len(self._items)):
             (kk, vv) = self._items[i]
-            if eq(self.type.k, k, kk):
-                self._items[i] = (kk, v)
-                return
+            if self._cmp(k, kk) == EQ:
+                return i
+        return None
+    def __setitem__(self, k, v):
+        i = self._find(k)
+        if i is not None:
+            (kk, vv) = self._items[i]
+            self._items[i] = (kk, v)
+            return
         # if not eq(self.type.v, v, self.default):
+        if self._index is not None:
+            self._index[self._key(k)] = len(self._items)
         self._items.append((k, v))
         # assert all(not eq(self.type.v, v, self.default) for (k, v) in self.items())
     def __getitem__(self, k):
-        for i in range(len(self._items)):
-            (kk, vv) = self._items[i]
-            if eq(self.type.k, k, kk):
-                return vv
-        return self.default
+        i = self._find(k)
+        return self.default if i is None else self._items[i][1]
+    def __reduce__(self):
+        return (Map, (self.type, self.default, self._items))
     def items(self):
         yield from self._items
     def keys(self):
@@ -63,6 +89,11 @@ class Map(object):
 class Bag(object):
     def __init__(self, iterable=()):
         self.elems = iterable if isinstance(iterable, tuple) else tuple(iterable)
+        self._sorted = None
+    def sorted_elems(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.elems)
+        return self._sorted
     def __hash__(self):
         return hash(self.elems)
     def __add__(self, other):
@@ -88,70 +119,140 @@ class Bag(object):
 
 Handle = namedtuple("Handle", ["address", "value"])
 
+def _identity(x):
+    return x
+
+@lru_cache(maxsize=None)
+def _key_function(t : Type):
+    """
+    Returns a function `f` such that `f(v1) == f(v2)` exactly when
+    `eq(t, v1, v2)`, and whose results are hashable. Returns None for types
+    whose values have no such key.
+    """
+    if t in (INT, LONG, BOOL, STRING) or isinstance(t, TEnum):
+        return _identity
+    if isinstance(t, THandle):
+        return lambda h: h.address
+    if isinstance(t, TTuple):
+        fs = [_key_function(tt) for tt in t.ts]
+        if any(f is None for f in fs):
+            return None
+        return lambda v: tuple(f(x) for (f, x) in zip(fs, v))
+    if isinstance(t, TRecord):
+        fs = [(f, _key_function(ft)) for (f, ft) in t.fields]
+        if any(kf is None for (f, kf) in fs):
+            return None
+        return lambda v: tuple(kf(v[f]) for (f, kf) in fs)
+    return None
+
 LT = -1
 EQ =  0
 GT =  1
-def cmp(t, v1, v2, deep=False):
-    stk = [(t, v1, v2)]
-
-    orig_deep = deep
-    def cleardeep():
-        nonlocal deep
-        deep = False
-    def resetdeep():
-        nonlocal deep
-        deep = orig_deep
-
-    while stk:
-        head = stk.pop()
-        if hasattr(head, "__call__"):
-            head()
-            continue
-        (t, v1, v2) = head
-
-        if isinstance(t, THandle):
-            if deep:
-                stk.append((t.value_type, v1.value, v2.value))
-            stk.append((INT, v1.address, v2.address))
-        elif isinstance(t, TEnum):
-            i1 = t.cases.index(v1)
-            i2 = t.cases.index(v2)
-            if i1 == i2: continue
-            if i1 <  i2: return LT
-            else:        return GT
-        elif isinstance(t, TBag) or isinstance(t, TSet):
-            if deep:
-                elems1 = list(v1)
-                elems2 = list(v2)
+
+_SCALAR_VALUE_TYPES = (INT, LONG, BOOL, STRING)
+
+def _cmp_scalars(v1, v2):
+    if   v1 == v2: return EQ
+    elif v1 <  v2: return LT
+    else:          return GT
+
+def _sorted_elems(v):
+    return v.sorted_elems() if isinstance(v, Bag) else sorted(v)
+
+@lru_cache(maxsize=None)
+def comparator(t : Type, deep : bool = False):
+    """
+    Returns a function `f` such that `f(v1, v2) == cmp(t, v1, v2, deep)`.
+    The function is built once per type.
+    """
+    if isinstance(t, THandle):
+        if deep:
+            cmp_value = comparator(t.value_type, deep)
+            def cmp_handles(v1, v2):
+                res = _cmp_scalars(v1.address, v2.address)
+                return cmp_value(v1.value, v2.value) if res == EQ else res
+            return cmp_handles
+        return lambda v1, v2: _cmp_scalars(v1.address, v2.address)
+    elif isinstance(t, TEnum):
+        index = { c : i for (i, c) in enumerate(t.cases) }
+        return lambda v1, v2: _cmp_scalars(index[v1], index[v2])
+    elif isinstance(t, TBag) or isinstance(t, TSet):
+        elems = list if deep else _sorted_elems
+        if t.t in _SCALAR_VALUE_TYPES or isinstance(t.t, TEnum):
+            if isinstance(t.t, TEnum):
+                index = { c : i for (i, c) in enumerate(t.t.cases) }
+                key = lambda v: [index[x] for x in elems(v)]
             else:
-                elems1 = list(sorted(v1))
-                elems2 = list(sorted(v2))
-            if len(elems1) < len(elems2): return LT
-            if len(elems1) > len(elems2): return GT
-            stk.extend(reversed([(t.t, x, y) for (x, y) in zip(elems1, elems2)]))
-        elif isinstance(t, TMap):
+                key = elems
+            def cmp_scalar_bags(v1, v2):
+                if len(v1) != len(v2):
+                    return LT if len(v1) < len(v2) else GT
+                return _cmp_scalars(key(v1), key(v2))
+            return cmp_scalar_bags
+        cmp_elem = comparator(t.t, deep)
+        def cmp_bags(v1, v2):
+            if len(v1) != len(v2):
+                return LT if len(v1) < len(v2) else GT
+            for (x, y) in zip(elems(v1), elems(v2)):
+                res = cmp_elem(x, y)
+                if res != EQ:
+                    return res
+            return EQ
+        return cmp_bags
+    elif isinstance(t, TMap):
+        cmp_value = comparator(t.v, deep)
+        cmp_keys = comparator(TSet(t.k))
+        def cmp_maps(v1, v2):
+            res = cmp_value(v1.default, v2.default)
+            if res != EQ:
+                return res
             keys1 = Bag(v1.keys())
-            keys2 = Bag(v2.keys())
-            stk.extend(reversed([(t.v, v1[k], v2[k]) for k in sorted(keys1)]))
-            stk.append(resetdeep)
-            stk.append((TSet(t.k), keys1, keys2))
-            stk.append(cleardeep)
-            stk.append((t.v, v1.default, v2.default))
-        elif isinstance(t, TTuple):
-            stk.extend(reversed([(tt, vv1, vv2) for (tt, vv1, vv2) in zip(t.ts, v1, v2)]))
-        elif isinstance(t, TList):
-            stk.extend(reversed([(t.t, vv1, vv2) for (vv1, vv2) in zip(v1, v2)]))
-            stk.append((INT, len(v1), len(v2)))
-        elif isinstance(t, TRecord):
-            stk.extend(reversed([(ft, v1[f], v2[f]) for (f, ft) in t.fields]))
-        else:
-            if   v1 == v2: continue
-            elif v1 <  v2: return LT
-            else:          return GT
-    return EQ
+            res = cmp_keys(keys1, Bag(v2.keys()))
+            if res != EQ:
+                return res
+            for k in keys1.sorted_elems():
+                res = cmp_value(v1[k], v2[k])
+                if res != EQ:
+                    return res
+            return EQ
+        return cmp_maps
+    elif isinstance(t, TTuple):
+        cmps = [comparator(tt, deep) for tt in t.ts]
+        def cmp_tuples(v1, v2):
+            for (c, x, y) in zip(cmps, v1, v2):
+                res = c(x, y)
+                if res != EQ:
+                    return res
+            return EQ
+        return cmp_tuples
+    elif isinstance(t, TList):
+        cmp_elem = comparator(t.t, deep)
+        def cmp_lists(v1, v2):
+            if len(v1) != len(v2):
+                return LT if len(v1) < len(v2) else GT
+            for (x, y) in zip(v1, v2):
+                res = cmp_elem(x, y)
+                if res != EQ:
+                    return res
+            return EQ
+        return cmp_lists
+    elif isinstance(t, TRecord):
+        cmps = [(f, comparator(ft, deep)) for (f, ft) in t.fields]
+        def cmp_records(v1, v2):
+            for (f, c) in cmps:
+                res = c(v1[f], v2[f])
+                if res != EQ:
+                    return res
+            return EQ
+        return cmp_records
+    else:
+        return _cmp_scalars
+
+def cmp(t, v1, v2, deep=False):
+    return comparator(t, deep)(v1, v2)
 
 def eq(t, v1, v2):
-    return cmp(t, v1, v2) == EQ
+    return comparator(t)(v1, v2) == EQ
 
 def eval(e, env, *args, **kwargs):
     return eval_bulk(e, (env,), *args, **kwargs)[0]
@@ -288,10 +389,11 @@ def read_map(stk):
     stk.append(m[k])
 
 def has_key(key_type):
+    c = comparator(key_type)
     def _has_key(stk):
         k = stk.pop()
         m = stk.pop()
-        stk.append(any(eq(key_type, k, kk) for kk in m.keys()))
+        stk.append(any(c(k, kk) == EQ for kk in m.keys()))
     return _has_key
 
 def read_map_keys(stk):
@@ -318,78 +420,87 @@ def binaryop_sub(stk):
     stk.append(v1 - v2)
 
 def binaryop_sub_bags(elem_type):
+    c = comparator(elem_type)
     def binaryop_sub_bags(stk):
         v2 = stk.pop()
         v1 = stk.pop()
         elems = list(v1)
         for x in v2:
             for i in range(len(elems)):
-                if eq(elem_type, x, elems[i]):
+                if c(x, elems[i]) == EQ:
                     del elems[i]
                     break
         stk.append(Bag(elems))
     return binaryop_sub_bags
 
 def binaryop_sub_lists(elem_type):
+    c = comparator(elem_type)
     def binaryop_sub_lists(stk):
         v2 = stk.pop()
         v1 = stk.pop()
         elems = list(v1)
         for x in v2:
             for i in range(len(elems)):
-                if eq(elem_type, x, elems[i]):
+                if c(x, elems[i]) == EQ:
                     del elems[i]
                     break
         stk.append(tuple(elems))
     return binaryop_sub_lists
 
 def binaryop_eq(t, deep=False):
+    c = comparator(t, deep)
     def binaryop_eq(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(cmp(t, v1, v2, deep=deep) == EQ)
+        stk.append(c(v1, v2) == EQ)
     return binaryop_eq
 
 def binaryop_ne(t):
+    c = comparator(t)
     def binaryop_ne(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(cmp(t, v1, v2) != EQ)
+        stk.append(c(v1, v2) != EQ)
     return binaryop_ne
 
 def binaryop_lt(t):
+    c = comparator(t)
     def binaryop_lt(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(cmp(t, v1, v2) == LT)
+        stk.append(c(v1, v2) == LT)
     return binaryop_lt
 
 def binaryop_le(t):
+    c = comparator(t)
     def binaryop_le(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(cmp(t, v1, v2) != GT)
+        stk.append(c(v1, v2) != GT)
     return binaryop_le
 
 def binaryop_gt(t):
+    c = comparator(t)
     def binaryop_gt(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(cmp(t, v1, v2) == GT)
+        stk.append(c(v1, v2) == GT)
     return binaryop_gt
 
 def binaryop_ge(t):
+    c = comparator(t)
     def binaryop_ge(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(cmp(t, v1, v2) != LT)
+        stk.append(c(v1, v2) != LT)
     return binaryop_ge
 
 def binaryop_in(elem_type):
+    c = comparator(elem_type)
     def binaryop_in(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(any(eq(elem_type, v1, v2elem) for v2elem in v2))
+        stk.append(any(c(v1, v2elem) == EQ for v2elem in v2))
     return binaryop_in
 
 def unaryop_not(stk):
@@ -414,24 +525,26 @@ def unaryop_neg(stk):
     stk.append(-stk.pop())
 
 def unaryop_areunique(elem_type):
-    keyfunc = cmp_to_key(lambda v1, v2: cmp(elem_type, v1, v2))
+    c = comparator(elem_type)
+    keyfunc = cmp_to_key(c)
     def unaryop_areunique(stk):
         v = stk.pop()
         l = sorted(v, key=keyfunc)
         res = True
         for i in range(len(l) - 1):
-            if eq(elem_type, l[i], l[i+1]):
+            if c(l[i], l[i+1]) == EQ:
                 res = False
                 break
         stk.append(res)
     return unaryop_areunique
 
 def unaryop_distinct(elem_type):
+    c = comparator(elem_type)
     def unaryop_distinct(stk):
         v = stk.pop()
         res = []
         for x in v:
-            if not any(eq(elem_type, x, y) for y in res):
+            if not any(c(x, y) == EQ for y in res):
                 res.append(x)
         stk.append(Bag(res))
     return unaryop_distinct
@@ -492,6 +605,69 @@ def list_slice(stk):
     l = stk.pop()
     stk.append(l[start:end])
 
+def _unaryop(e : EUnaryOp):
+    if e.op == UOp.Not:
+        return unaryop_not
+    elif e.op == UOp.Sum:
+        return unaryop_sum
+    elif e.op == UOp.Exists:
+        return unaryop_exists
+    elif e.op == UOp.Empty:
+        return unaryop_empty
+    elif e.op == UOp.All:
+        return unaryop_all
+    elif e.op == UOp.Any:
+        return unaryop_any
+    elif e.op == UOp.Length:
+        return unaryop_len
+    elif e.op == UOp.AreUnique:
+        return unaryop_areunique(e.e.type.t)
+    elif e.op == UOp.Distinct:
+        return unaryop_distinct(e.e.type.t)
+    elif e.op == UOp.The:
+        return unaryop_the(default=mkval(e.type))
+    elif e.op == UOp.Reversed:
+        return unaryop_reversed
+    elif e.op == "-":
+        return unaryop_neg
+    else:
+        raise NotImplementedError(e.op)
+
+def _binaryop(e : EBinOp):
+    e1type = e.e1.type
+    if e.op == "+":
+        if is_collection(e.type):
+            return binaryop_add_collections
+        else:
+            return binaryop_add_numbers
+    elif e.op == "*":
+        return binaryop_mul
+    elif e.op == "-":
+        if isinstance(e.type, TBag) or isinstance(e.type, TSet):
+            return binaryop_sub_bags(e.type.t)
+        elif isinstance(e.type, TList):
+            return binaryop_sub_lists(e.type.t)
+        else:
+            return binaryop_sub
+    elif e.op == "==":
+        return binaryop_eq(e1type)
+    elif e.op == "===":
+        return binaryop_eq(e1type, deep=True)
+    elif e.op == "<":
+        return binaryop_lt(e1type)
+    elif e.op == ">":
+        return binaryop_gt(e1type)
+    elif e.op == "<=":
+        return binaryop_le(e1type)
+    elif e.op == ">=":
+        return binaryop_ge(e1type)
+    elif e.op == "!=":
+        return binaryop_ne(e1type)
+    elif e.op == BOp.In:
+        return binaryop_in(e1type)
+    else:
+        raise NotImplementedError(e.op)
+
 _EMPTY_BAG = Bag()
 def _compile(e, env : {str:int}, out):
     if isinstance(e, EVar):
@@ -583,32 +759,7 @@ def _compile(e, env : {str:int}, out):
         out.append(make_native)
     elif isinstance(e, EUnaryOp):
         _compile(e.e, env, out)
-        if e.op == UOp.Not:
-            out.append(unaryop_not)
-        elif e.op == UOp.Sum:
-            out.append(unaryop_sum)
-        elif e.op == UOp.Exists:
-            out.append(unaryop_exists)
-        elif e.op == UOp.Empty:
-            out.append(unaryop_empty)
-        elif e.op == UOp.All:
-            out.append(unaryop_all)
-        elif e.op == UOp.Any:
-            out.append(unaryop_any)
-        elif e.op == UOp.Length:
-            out.append(unaryop_len)
-        elif e.op == UOp.AreUnique:
-            out.append(unaryop_areunique(e.e.type.t))
-        elif e.op == UOp.Distinct:
-            out.append(unaryop_distinct(e.e.type.t))
-        elif e.op == UOp.The:
-            out.append(unaryop_the(default=mkval(e.type)))
-        elif e.op == UOp.Reversed:
-            out.append(unaryop_reversed)
-        elif e.op == "-":
-            out.append(unaryop_neg)
-        else:
-            raise NotImplementedError(e.op)
+        out.append(_unaryop(e))
     elif isinstance(e, EBinOp):
         if e.op == BOp.And:
             return _compile(ECond(e.e1, e.e2, F).with_type(BOOL), env, out)
@@ -618,39 +769,7 @@ def _compile(e, env : {str:int}, out):
             return _compile(ECond(e.e1, e.e2, T).with_type(BOOL), env, out)
         _compile(e.e1, env, out)
         _compile(e.e2, env, out)
-        e1type = e.e1.type
-        if e.op == "+":
-            if is_collection(e.type):
-                out.append(binaryop_add_collections)
-            else:
-                out.append(binaryop_add_numbers)
-        elif e.op == "*":
-            out.append(binaryop_mul)
-        elif e.op == "-":
-            if isinstance(e.type, TBag) or isinstance(e.type, TSet):
-                out.append(binaryop_sub_bags(e.type.t))
-            elif isinstance(e.type, TList):
-                out.append(binaryop_sub_lists(e.type.t))
-            else:
-                out.append(binaryop_sub)
-        elif e.op == "==":
-            out.append(binaryop_eq(e1type))
-        elif e.op == "===":
-            out.append(binaryop_eq(e1type, deep=True))
-        elif e.op == "<":
-            out.append(binaryop_lt(e1type))
-        elif e.op == ">":
-            out.append(binaryop_gt(e1type))
-        elif e.op == "<=":
-            out.append(binaryop_le(e1type))
-        elif e.op == ">=":
-            out.append(binaryop_ge(e1type))
-        elif e.op == "!=":
-            out.append(binaryop_ne(e1type))
-        elif e.op == BOp.In:
-            out.append(binaryop_in(e1type))
-        else:
-            raise NotImplementedError(e.op)
+        out.append(_binaryop(e))
     elif isinstance(e, EListGet):
         _compile(e.e, env, out)
         _compile(e.index, env, out)
@@ -810,14 +929,257 @@ def free_vars_and_funcs(e):
     for f in free_funcs(e):
         yield f
 
-def eval_bulk(e, envs, use_default_values_for_undefined_vars : bool = False):
-    e = purify(e)
-    if not envs:
-        return []
+# Bulk evaluation
+#
+# eval_bulk evaluates an expression on many environments at once. Rather than
+# running the stack machine above once per environment, it compiles the
+# expression into a tree of "kernels", each of which computes one
+# subexpression for every environment in a _Batch. A kernel's result is a
+# column: a list (or NumPy array) with one value per environment.
+#
+# Kernels exist for variables, literals, conditionals, and most unary and
+# binary operators. Any other subexpression (notably anything with a binder)
+# is compiled for the stack machine and run once per environment.
+#
+# Integer and boolean operations run on NumPy arrays when NumPy is available
+# and the batch is large enough. NumPy integers are fixed-width while Cozy's
+# are not, so arithmetic only happens on arrays whose values are small enough
+# that the result cannot overflow; otherwise the column falls back to a list.
+
+_SCALAR_TYPES = (INT, LONG, BOOL, STRING)
+_VECTOR_TYPES = (INT, BOOL)
+_SMALL = 2 ** 31
+
+class _Batch(object):
+    def __init__(self, cols, n, vectorize):
+        self.cols = cols # one list per variable
+        self.n = n
+        self.vectorize = vectorize
+        self._rows = None
+        self._arrays = { }
+    def rows(self):
+        if self._rows is None:
+            self._rows = list(zip(*self.cols)) if self.cols else [()] * self.n
+        return self._rows
+    def column(self, i):
+        if not self.vectorize:
+            return self.cols[i]
+        col = self._arrays.get(i)
+        if col is None:
+            col = _to_array(self.cols[i])
+            if col is None:
+                col = self.cols[i]
+            self._arrays[i] = col
+        return col
+    def select(self, idx):
+        return _Batch(
+            [[col[i] for i in idx] for col in self.cols],
+            len(idx),
+            self.vectorize)
+
+def _to_list(col):
+    if numpy is not None and isinstance(col, numpy.ndarray):
+        return col.tolist()
+    return col
+
+def _to_array(col):
+    """
+    Convert a column of ints or bools to a NumPy array. Returns None if some
+    value is not an int in the range (-2**31, 2**31).
+    """
+    if not isinstance(col, numpy.ndarray):
+        try:
+            col = numpy.array(col)
+        except OverflowError:
+            return None
+    if col.dtype == numpy.bool_:
+        return col
+    if col.dtype != numpy.int64 or (col >= _SMALL).any() or (col <= -_SMALL).any():
+        return None
+    return col
+
+def _rowwise(op, *cols):
+    """Run a stack-machine op once per environment."""
+    res = []
+    for args in zip(*[_to_list(c) for c in cols]):
+        stk = list(args)
+        op(stk)
+        res.append(stk[-1])
+    return res
+
+_pyops = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge }
+
+def _compile_bulk(e, env : {str:int}):
+    f = _compile_bulk_node(e, env)
+    if hasattr(e, "type") and isinstance(e.type, TList):
+        return lambda batch: [tuple(v) for v in _to_list(f(batch))]
+    return f
+
+def _compile_bulk_node(e, env : {str:int}):
+    if isinstance(e, EVar):
+        i = env[e.id]
+        if e.type in _VECTOR_TYPES:
+            return lambda batch: batch.column(i)
+        return lambda batch: batch.cols[i]
+    elif isinstance(e, EBool) or isinstance(e, ENum) or isinstance(e, EStr):
+        v = e.val
+        return lambda batch: [v] * batch.n
+    elif isinstance(e, EEnumEntry):
+        v = e.name
+        return lambda batch: [v] * batch.n
+    elif isinstance(e, ENull):
+        return lambda batch: [None] * batch.n
+    elif isinstance(e, EStateVar):
+        return _compile_bulk(e.e, env)
+    elif isinstance(e, ECond):
+        cond = _compile_bulk(e.cond, env)
+        then_branch = _compile_bulk(e.then_branch, env)
+        else_branch = _compile_bulk(e.else_branch, env)
+        def ite(batch):
+            c = _to_list(cond(batch))
+            then_idx = [i for (i, v) in enumerate(c) if v]
+            if len(then_idx) == batch.n:
+                return then_branch(batch)
+            if not then_idx:
+                return else_branch(batch)
+            else_idx = [i for (i, v) in enumerate(c) if not v]
+            res = [None] * batch.n
+            for (i, v) in zip(then_idx, _to_list(then_branch(batch.select(then_idx)))):
+                res[i] = v
+            for (i, v) in zip(else_idx, _to_list(else_branch(batch.select(else_idx)))):
+                res[i] = v
+            return res
+        return ite
+    elif isinstance(e, EGetField) and isinstance(e.e.type, TRecord):
+        child = _compile_bulk(e.e, env)
+        f = e.f
+        return lambda batch: [v[f] for v in _to_list(child(batch))]
+    elif isinstance(e, ETupleGet):
+        child = _compile_bulk(e.e, env)
+        n = e.n
+        return lambda batch: [v[n] for v in _to_list(child(batch))]
+    elif isinstance(e, EUnaryOp):
+        child = _compile_bulk(e.e, env)
+        if e.op == UOp.Not:
+            def not_(batch):
+                c = child(batch)
+                if batch.vectorize and isinstance(c, numpy.ndarray):
+                    return numpy.logical_not(c)
+                return [not v for v in c]
+            return not_
+        if e.op == "-" and e.type == INT:
+            def neg(batch):
+                c = child(batch)
+                if batch.vectorize:
+                    a = _to_array(c)
+                    if a is not None and a.dtype == numpy.int64:
+                        return -a
+                return [-v for v in _to_list(c)]
+            return neg
+        if e.op == UOp.Length:
+            return lambda batch: [len(v) for v in child(batch)]
+        if e.op == UOp.Exists:
+            return lambda batch: [bool(v) for v in child(batch)]
+        if e.op == UOp.Empty:
+            return lambda batch: [not v for v in child(batch)]
+        op = _unaryop(e)
+        return lambda batch: _rowwise(op, child(batch))
+    elif isinstance(e, EBinOp):
+        if e.op == BOp.And:
+            return _compile_bulk(ECond(e.e1, e.e2, F).with_type(BOOL), env)
+        elif e.op == BOp.Or:
+            return _compile_bulk(ECond(e.e1, T, e.e2).with_type(BOOL), env)
+        elif e.op == "=>":
+            return _compile_bulk(ECond(e.e1, e.e2, T).with_type(BOOL), env)
+        e1 = _compile_bulk(e.e1, env)
+        e2 = _compile_bulk(e.e2, env)
+        pyop = _pyops.get(e.op)
+        if pyop is not None and e.e1.type in _SCALAR_TYPES and e.e2.type == e.e1.type:
+            vectorize = e.e1.type in _VECTOR_TYPES
+            def binop(batch):
+                c1 = e1(batch)
+                c2 = e2(batch)
+                if vectorize and batch.vectorize:
+                    a1 = _to_array(c1)
+                    a2 = _to_array(c2)
+                    if a1 is not None and a2 is not None and a1.dtype == a2.dtype:
+                        return pyop(a1, a2)
+                return [pyop(v1, v2) for (v1, v2) in zip(_to_list(c1), _to_list(c2))]
+            return binop
+        op = _binaryop(e)
+        return lambda batch: _rowwise(op, e1(batch), e2(batch))
     ops = []
-    vars = OrderedSet(free_vars_and_funcs(e))
+    _compile(e, env, ops)
+    return lambda batch: [_eval_compiled(ops, row) for row in batch.rows()]
+
+class CompileCache(object):
+    """
+    A least-recently-used cache of compiled expressions, keyed by
+    `alpha_key`. Its size is controlled by the "eval-cache-size" option.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        res = self.entries.get(key)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return res
+
+    def put(self, key, value):
+        self.entries[key] = value
+        while len(self.entries) > compile_cache_size.value:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+compile_cache = CompileCache()
+
+def _compile_for_bulk(e):
+    """
+    Returns (vars, types, kernel) for `e`, where `vars` is the list of names
+    of its free variables and functions, `types` gives the type of each free
+    variable, and `kernel` computes `e` on a _Batch whose columns are in the
+    order of `vars`.
+    """
+    if compile_cache_size.value <= 0:
+        key = None
+    else:
+        key = alpha_key(e, typed=True)
+        res = compile_cache.get(key)
+        if res is not None:
+            return res
+    e = purify(e)
+    vars = list(OrderedSet(free_vars_and_funcs(e)))
     types = { v.id : v.type for v in free_vars(e) }
     vmap = { v : i for (i, v) in enumerate(vars) }
+    res = (vars, types, _compile_bulk(e, vmap))
+    if key is not None:
+        compile_cache.put(key, res)
+    return res
+
+def eval_bulk(e, envs, use_default_values_for_undefined_vars : bool = False):
+    if not envs:
+        return []
+    vars, types, f = _compile_for_bulk(e)
     try:
         envs = [ [(env.get(v, mkval(types[v])) if (use_default_values_for_undefined_vars and v in types) else env[v]) for v in vars] for env in envs ]
     except KeyError:
@@ -826,5 +1188,7 @@ def eval_bulk(e, envs, use_default_values_for_undefined_vars : bool = False):
         print("e = {}".format(pprint(e)), file=sys.stderr)
         print("eval_bulk({!r}, {!r}, use_default_values_for_undefined_vars={!r})".format(e, envs, use_default_values_for_undefined_vars), file=sys.stderr)
         raise
-    _compile(e, vmap, ops)
-    return [_eval_compiled(ops, env) for env in envs]
+    cols = [list(col) for col in zip(*envs)]
+    n = len(envs)
+    vectorize = numpy is not None and n >= vectorize_threshold.value
+    return _to_list(f(_Batch(cols, n, vectorize)))
@@ -1,25 +1,48 @@
 """Helper class to implement interruptable tasks."""
 
-from multiprocessing import Process, Array, Queue
+from multiprocessing import Process, Array, Queue, cpu_count, util
 from queue import Queue as PlainQueue, Empty, Full
 import time
 import threading
 import sys
+import weakref
 
 from cozy.opts import Option
+from cozy import tracing
 
 do_profiling = Option("profile", bool, False, description="Profile Cozy itself")
+max_running_jobs = Option("jobs", int, cpu_count(), metavar="N", description="Maximum number of synthesis jobs to run at once")
+job_time_slice = Option("job-time-slice", int, 0, metavar="N", description="Seconds a synthesis job may run before it can be stopped (and later restarted from its saved progress) in favor of a waiting job; 0 means jobs run to completion. Restarted jobs lose their in-memory caches, so only use this when there are many more queries than --jobs")
+
+# Jobs are not daemonic processes, since daemonic processes may not start
+# children of their own (e.g. the solver portfolio). Instead, jobs still alive
+# when Cozy exits are killed here, before multiprocessing waits for them.
+_live_jobs = weakref.WeakSet()
+
+def _kill_live_jobs():
+    for j in list(_live_jobs):
+        if j.started and not j.done:
+            j.kill()
+            j.join()
+
+util.Finalize(None, _kill_live_jobs, exitpriority=0)
 
 class Job(object):
     def __init__(self):
-        self._thread = Process(target=self._run, daemon=True)
+        self._thread = Process(target=self._run)
         self._flags = Array("b", [False] * 3)
         # flags[0] - stop_requested?
         # flags[1] - done?
         # flags[2] - true iff completed with no exception
     def start(self):
+        _live_jobs.add(self)
         self._thread.start()
+    @property
+    def started(self):
+        return self._thread.pid is not None
     def _run(self):
+        tracing.start(str(self))
+        start = tracing.now()
         try:
             if do_profiling.value:
                 import cProfile
@@ -33,12 +56,20 @@ class Job(object):
         except Exception as e:
             import traceback
             traceback.print_exc()
+        tracing.span("job", start, tracing.now(), job=self)
+        tracing.flush()
         self._flags[1] = True
     def run(self):
         raise NotImplementedError()
     @property
     def stop_requested(self):
         return self._flags[0]
+    def poll_stop(self):
+        """
+        Called periodically by a running job. Returns True if the job should
+        stop.
+        """
+        return self._flags[0]
     @property
     def done(self):
         return self._flags[1] or (self._thread.exitcode is not None)
@@ -57,7 +88,7 @@ class Job(object):
         return self._thread.pid
 
 def stop_jobs(jobs):
-    jobs = list(jobs)
+    jobs = [j for j in jobs if j.started]
     for j in jobs:
         j.request_stop()
 
@@ -70,6 +101,107 @@ def stop_jobs(jobs):
             for j in jobs:
                 print("  --> {} [pid={}]".format(j, j.pid))
 
+class JobPool(object):
+    """
+    Runs jobs so that at most `size` of them have a live process at once.
+
+    Jobs that do not fit wait without a process. If a `restart` function and
+    a positive `time_slice` are given, then every `time_slice` seconds the
+    pool picks the jobs with the
+    least run time, where each improvement reported through `credit` refunds
+    one time slice. Running jobs that were not picked are asked to stop;
+    once their process has exited, they wait like the others, and
+    `restart(job)` makes the fresh job (resuming from the stopped job's saved
+    progress) that replaces them when they are picked again. `restart` may
+    return None if the job should not run again. Otherwise, jobs run to
+    completion.
+
+    New jobs therefore run first, and jobs that keep finding improvements get
+    more time.
+
+    Call `update` periodically to start, stop, and restart jobs.
+    """
+
+    def __init__(self, size=None, time_slice=None, restart=None):
+        self.size = max(size if size is not None else max_running_jobs.value, 1)
+        self.time_slice = time_slice if time_slice is not None else job_time_slice.value
+        self.restart = restart
+        self.jobs = []
+        self.run_time = { } # job -> seconds spent running
+        self.credits = { }  # job -> number of improvements
+        self.running = set()
+        self.stopping = set()  # jobs asked to stop to make room
+        self.suspended = set() # stopped jobs waiting to be restarted
+        self.last_update = time.time()
+        self.slice_start = self.last_update
+    def __iter__(self):
+        return iter(list(self.jobs))
+    @property
+    def done(self):
+        """True if every job has finished for good."""
+        return all(j.done for j in self.jobs) and not self.stopping and not self.suspended
+    def add(self, job):
+        self.jobs.append(job)
+        self.run_time[job] = 0.0
+        self.credits[job] = 0
+    def remove(self, job):
+        self.jobs.remove(job)
+        self.running.discard(job)
+        self.stopping.discard(job)
+        self.suspended.discard(job)
+        del self.run_time[job]
+        del self.credits[job]
+    def credit(self, job):
+        self.credits[job] += 1
+    def _priority(self, job):
+        return self.run_time[job] - self.credits[job] * self.time_slice
+    def _restart(self, job):
+        new = self.restart(job)
+        if new is None:
+            self.remove(job)
+            return None
+        self.jobs[self.jobs.index(job)] = new
+        self.run_time[new] = self.run_time.pop(job)
+        self.credits[new] = self.credits.pop(job)
+        self.suspended.discard(job)
+        return new
+    def update(self):
+        now = time.time()
+        for j in self.running:
+            self.run_time[j] += now - self.last_update
+        self.last_update = now
+        self.running = { j for j in self.running if not j.done }
+        for j in [j for j in self.stopping if j.done]:
+            self.stopping.remove(j)
+            self.suspended.add(j)
+
+        if self.restart is not None and self.time_slice > 0 and now - self.slice_start >= self.time_slice:
+            self.slice_start = now
+            candidates = [j for j in self.jobs if j not in self.stopping and (not j.done or j in self.suspended)]
+            candidates.sort(key=self._priority)
+            chosen = set(candidates[:self.size])
+            for j in self.running - chosen:
+                print("stopping {} to make room".format(j))
+                tracing.instant("stop job", job=j)
+                j.request_stop()
+                self.stopping.add(j)
+            self.running -= self.stopping
+
+        free = self.size - len(self.running) - len(self.stopping)
+        if free <= 0:
+            return
+        waiting = [j for j in self.jobs if j in self.suspended or not j.started]
+        waiting.sort(key=self._priority)
+        for j in waiting[:free]:
+            if j in self.suspended:
+                print("restarting {}".format(j))
+                tracing.instant("restart job", job=j)
+                j = self._restart(j)
+                if j is None:
+                    continue
+            j.start()
+            self.running.add(j)
+
 class SafeQueue(object):
     """
     The multiprocessing.Queue class and its cousins come with a lot of caveats!
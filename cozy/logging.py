@@ -3,27 +3,65 @@
 Important functions:
  - task: a context manager to wrap self-contained tasks
  - event: print a log message (indented based on active tasks)
+ - lazy: wrap an expensive log argument so it is only computed if printed
+
+Tasks also become spans of the trace when --trace-dir is given (see
+cozy.tracing). When none of --verbose, --profile, or --trace-dir is given,
+tasks are not tracked at all and log arguments are never formatted.
 """
 
 from collections import defaultdict
-from contextlib import contextmanager
-import datetime
+import time
 
 from cozy.opts import Option
+from cozy.jobs import do_profiling
+from cozy import tracing
 
 verbose = Option("verbose", bool, False)
 
+# Task paths (tuples of nested task names) are numbered as they are first
+# seen, so tracking a task only costs a dictionary lookup on its parent's
+# number and its own name.
+_path_ids = { }
+_paths = [()]
 _times = defaultdict(float)
 _task_stack = []
-_begin = datetime.datetime.now()
+_begin = time.monotonic()
+
+def enabled():
+    """Whether tasks need to be tracked at all."""
+    return verbose.value or do_profiling.value or tracing.enabled()
+
+class lazy(object):
+    """
+    A log argument that is only computed when it is printed, e.g.
+        task("simplifying", e=lazy(pprint, e))
+    """
+    __slots__ = ("f", "args")
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+    def __str__(self):
+        return str(self.f(*self.args))
 
 def log(string):
     if verbose.value:
         print(string)
 
+def _path_id(parent, name):
+    k = (parent, name)
+    i = _path_ids.get(k)
+    if i is None:
+        i = len(_paths)
+        _paths.append(_paths[parent] + (name,))
+        _path_ids[k] = i
+    return i
+
 def task_begin(name, **kwargs):
-    start = datetime.datetime.now()
-    _task_stack.append((name, start))
+    if not enabled():
+        return
+    parent = _task_stack[-1][1] if _task_stack else 0
+    _task_stack.append((name, _path_id(parent, name), time.monotonic(), kwargs))
     if not verbose.value:
         return
     indent = "  " * (len(_task_stack) - 1)
@@ -33,36 +71,62 @@ def task_begin(name, **kwargs):
         maybe_kwargs = (" [" + ", ".join("{}={}".format(k, v) for k, v in kwargs.items()) + "]") if kwargs else ""))
 
 def task_end():
-    end = datetime.datetime.now()
-    key = tuple(name for name, start in _task_stack)
-    name, start = _task_stack.pop()
-    duration = (end-start).total_seconds()
-    _times[key] += duration
+    if not enabled():
+        return
+    end = time.monotonic()
+    name, path, start, kwargs = _task_stack.pop()
+    duration = end - start
+    _times[path] += duration
+    tracing.span(name, start, end, **kwargs)
     if not verbose.value:
         return
     indent = "  " * len(_task_stack)
     log("{indent}Finished {name} [duration={duration:.3}s]".format(indent=indent, name=name, duration=duration))
 
-@contextmanager
-def task(name, **kwargs):
-    try:
-        yield task_begin(name, **kwargs)
-    finally:
+class _Task(object):
+    __slots__ = ("name", "kwargs")
+    def __init__(self, name, kwargs):
+        self.name = name
+        self.kwargs = kwargs
+    def __enter__(self):
+        task_begin(self.name, **self.kwargs)
+    def __exit__(self, exc_type, exc_value, tb):
         task_end()
+        return False
+
+class _NoTask(object):
+    __slots__ = ()
+    def __enter__(self):
+        pass
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NO_TASK = _NoTask()
+
+def task(name, **kwargs):
+    if not enabled():
+        return _NO_TASK
+    return _Task(name, kwargs)
 
-def event(name):
+def event(name, *args):
+    """
+    Log a message. If `args` are given, `name` is a format string that is
+    only filled in when the message is actually printed.
+    """
     if not verbose.value:
         return
+    if args:
+        name = name.format(*args)
     indent = "  " * len(_task_stack)
     log("{indent}{name}".format(indent=indent, name=name))
 
 def dump_profile():
-    duration = (datetime.datetime.now() - _begin).total_seconds()
+    duration = time.monotonic() - _begin
     with open("/tmp/cozy.profile", "w") as f:
         f.write("Total duration: {:.3} seconds\n".format(duration))
-        f.write("Currently in: {}\n\n".format(", ".join(name for (name, start) in _task_stack)))
+        f.write("Currently in: {}\n\n".format(", ".join(name for (name, path, start, kwargs) in _task_stack)))
         for k in sorted(_times.keys(), key=_times.get, reverse=True):
             f.write("{:16.3}".format(_times[k]))
             f.write(" ")
-            f.write(", ".join(k))
+            f.write(", ".join(_paths[k]))
             f.write("\n")
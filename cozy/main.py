@@ -90,6 +90,7 @@ def run():
 
     if not args.simple:
         callback = None
+        metrics_callback = None
         server = None
 
         if checkpoint_prefix.value:
@@ -125,14 +126,18 @@ def run():
                 s += syntax_tools.pprint(ast, format="html")
                 s += "</pre></body></html>"
                 state[0] = s
-            server = progress_server.ProgressServer(port=args.port, callback=lambda: state[0])
+            metrics = [{}]
+            def metrics_callback(m):
+                metrics[0] = m
+            server = progress_server.ProgressServer(port=args.port, callback=lambda: state[0], metrics_callback=lambda: metrics[0])
             server.start_async()
 
         # Do full synthesis
         ast = synthesis.improve_implementation(
             ast,
             timeout           = datetime.timedelta(seconds=args.timeout),
-            progress_callback = callback)
+            progress_callback = callback,
+            metrics_callback  = metrics_callback)
 
         if server is not None:
             server.join()
@@ -2,33 +2,81 @@
 
 This module exports ProgressServer, a class that runs a simple HTTP server to
 show progress of some task.
+
+Besides the page at "/", the server can publish live counters at "/metrics":
+as JSON by default, or in the Prometheus text format for
+"/metrics?format=prometheus".
 """
 
 from threading import Thread
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import json
+import time
+
+# Prometheus metric types for the per-query counters reported by
+# cozy.synthesis.core.improve. Other numeric entries are exported as gauges.
+COUNTERS = ("considered", "solver_calls", "solver_cache_hits", "eval_cache_hits", "eval_cache_misses", "wf_solver_calls", "wf_solver_hits", "counterexamples", "pruned_examples", "improvements")
+
+def with_derived_metrics(metrics, now=None):
+    """
+    Add entries that depend on the time of the request (currently just
+    "seconds_since_improvement") to a {query name: counters} dictionary.
+    """
+    if now is None:
+        now = time.time()
+    res = { }
+    for name, m in metrics.items():
+        m = dict(m)
+        if "last_improvement" in m:
+            m["seconds_since_improvement"] = now - m["last_improvement"]
+        res[name] = m
+    return res
+
+def metrics_to_json(metrics):
+    return json.dumps(metrics, indent=2, sort_keys=True)
 
-def handler_class(callback):
+def _escape_label(s):
+    return s.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def metrics_to_prometheus(metrics):
+    keys = sorted(set(k for m in metrics.values() for (k, v) in m.items() if isinstance(v, (int, float)) and not isinstance(v, bool)))
+    lines = []
+    for k in keys:
+        name = "cozy_{}{}".format(k, "_total" if k in COUNTERS else "")
+        lines.append("# TYPE {} {}".format(name, "counter" if k in COUNTERS else "gauge"))
+        for query, m in metrics.items():
+            if k in m:
+                lines.append("{}{{query=\"{}\"}} {}".format(name, _escape_label(query), m[k]))
+    return "\n".join(lines) + "\n"
+
+def handler_class(callback, metrics_callback=None):
     class Handler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            if self.path != "/":
-                self.send_response(404)
-                content = "not found"
-                self.send_header("Content-Type", "text/plain")
-                self.send_header("Content-Length", str(len(content)))
-                self.end_headers()
-                self.wfile.write(content.encode("utf-8"))
-                return
-            content = callback()
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html")
+        def respond(self, code, content_type, content):
+            content = content.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
             self.send_header("Content-Length", str(len(content)))
             self.end_headers()
-            self.wfile.write(content.encode("ascii"))
+            self.wfile.write(content)
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/":
+                self.respond(200, "text/html", callback())
+            elif url.path == "/metrics" and metrics_callback is not None:
+                metrics = with_derived_metrics(metrics_callback())
+                fmt = parse_qs(url.query).get("format", ["json"])[0]
+                if fmt == "prometheus":
+                    self.respond(200, "text/plain; version=0.0.4", metrics_to_prometheus(metrics))
+                else:
+                    self.respond(200, "application/json", metrics_to_json(metrics))
+            else:
+                self.respond(404, "text/plain", "not found")
     return Handler
 
 class ProgressServer(HTTPServer):
-    def __init__(self, callback, port=8080):
-        super().__init__(('', port), handler_class(callback))
+    def __init__(self, callback, port=8080, metrics_callback=None):
+        super().__init__(('', port), handler_class(callback, metrics_callback))
     def start_async(self):
         self.thread = Thread(target=self.serve_forever, daemon=True)
         self.thread.start()
@@ -6,29 +6,54 @@ Important functions and classes:
  - valid: check whether an expression is valid for all small models
  - IncrementalSolver: a class to efficiently check assertions incrementally
  - ModelCachingSolver: a class that saves models between satisfiability checks
+ - query_cache: a process-wide cache of solver results
+ - solver_pool: the idle solvers that satisfy, satisfiable, and valid reuse
+ - portfolio: races solver configurations on slow queries (see --portfolio-after)
+ - z3_calls: the number of queries this process has sent to Z3
+ - load_recorded_queries: read the queries saved with --record-solver-queries
+ - shrink_model: drop collection elements and map entries a model does not need
 """
 
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import itertools
+from multiprocessing import Process, Queue
+import os
+from queue import Empty
+import signal
+import sys
+import time
 import threading
 from functools import lru_cache
+import pickle
 
 import z3
 
 from cozy.target_syntax import *
-from cozy.syntax_tools import BottomUpExplorer, pprint, free_vars, free_funcs, cse, all_exps, purify
+from cozy.syntax_tools import BottomUpExplorer, pprint, free_vars, free_funcs, cse, all_exps, all_types, purify, alpha_key
 from cozy.typecheck import is_collection, is_numeric
 from cozy.common import declare_case, fresh_name, Visitor, FrozenDict, typechecked, extend, OrderedSet, make_random_access
 from cozy import evaluation
 from cozy.opts import Option
 from cozy.structures import extension_handler
-from cozy.logging import task
+from cozy.logging import task, event
+from cozy import tracing
 from cozy.evaluation import eval_bulk
 
 save_solver_testcases = Option("save-solver-testcases", str, "", metavar="PATH")
 collection_depth_opt = Option("collection-depth", int, 4, metavar="N", description="Bound for bounded verification")
 use_quantified_encoding = Option("quantified-encoding", bool, False, description="Allow the use of quantifiers during formula encoding. The resulting formulas are still decideable using Z3's macro_finder option. Enabling this option offloads work from Python to Z3. Generally it harms performance.")
+query_cache_size = Option("solver-cache-size", int, 4096, metavar="N", description="Number of solver results to remember across solver instances; 0 disables the cache")
+query_cache_file = Option("solver-cache-file", str, "", metavar="PATH", description="File in which to save solver results across runs")
+record_solver_queries = Option("record-solver-queries", str, "", metavar="PATH", description="Append every solver query, with its result and duration, to this file (see `python -m cozy.bench --replay`)")
+solver_pool_size = Option("solver-pool-size", int, 64, metavar="N", description="Number of idle solvers that satisfy, satisfiable, and valid may keep for reuse; 0 disables the pool")
+iterative_deepening = Option("iterative-deepening", bool, False, description="Look for counterexamples with small collections before trying the full collection depth.")
+portfolio_after = Option("portfolio-after", int, 0, metavar="MS", description="When a solver query takes longer than MS milliseconds, race several solver configurations on it in parallel processes; 0 disables the portfolio")
+portfolio_size = Option("portfolio-size", int, 2, metavar="N", description="Number of solver configurations to race at once with --portfolio-after")
+shrink_models = Option("shrink-models", bool, False, description="Remove unneeded collection elements and map entries from counterexamples and cached models. Shrinking only re-evaluates the formula, but that takes time on every counterexample, and it changes which examples the enumerator sees.")
+memoize_encodings = Option("memoize-encodings", bool, True, description="Let each solver remember the encodings of the subexpressions it has seen, instead of running common subexpression elimination on every formula.")
+encoding_memo_size = Option("encoding-memo-size", int, 65536, metavar="N", description="Number of subexpression encodings each solver may remember with --memoize-encodings")
 
 class SolverReportedUnknown(Exception):
     pass
@@ -235,6 +260,16 @@ class ToZ3(Visitor):
         assert to_bool(self.true) is True
         assert to_bool(self.false) is False
         assert to_bool(self.int_zero) is None
+        # Encodings of expressions visited in the environment `memo_env`.
+        # Other environments bind variables that may shadow `memo_env`, so
+        # expressions visited in them are not memoized.
+        self.memo = None
+        self.memo_env = None
+        # When not None, `mkvar` appends (mask, n) to this list for every
+        # symbolic mask bit of a collection, where n is the number of mask
+        # bits after it. Requiring `mask` to be false for all entries with
+        # n >= d limits every collection to at most d elements.
+        self.masks = None
 
     def bool_to_z3(self, b):
         return self.true if b else self.false
@@ -826,6 +861,11 @@ class ToZ3(Visitor):
                 res_elems += bag2_elems
             return res_mask, res_elems
     def visit_EStateVar(self, e, env):
+        if self.memo_env is not None:
+            # Variables bound outside an EStateVar are not visible inside it.
+            # Without memoization, `purify` lifts state expressions out of
+            # binders before encoding.
+            return self.visit(e.e, self.memo_env)
         return self.visit(e.e, env)
     def visit_Exp(self, e, *args):
         if isinstance(e, Exp):
@@ -839,6 +879,19 @@ class ToZ3(Visitor):
     def visit_bool(self, e, env):
         return z3.BoolVal(e, self.ctx)
     def visit(self, e, *args):
+        memo = self.memo
+        if memo is not None and isinstance(e, Exp) and len(args) == 1 and args[0] is self.memo_env:
+            # NOTE: equality on expressions ignores types, so lambdas also
+            # need their argument type in the key.
+            k = (e, e.arg.type) if isinstance(e, ELambda) else (e, getattr(e, "type", None))
+            res = memo.get(k)
+            if res is None:
+                res = self._visit(e, *args)
+                memo[k] = res
+            return res
+        return self._visit(e, *args)
+
+    def _visit(self, e, *args):
         try:
             return super().visit(e, *args)
         except KeyboardInterrupt:
@@ -933,6 +986,8 @@ class ToZ3(Visitor):
             true_masks = [self.true for i in range(min_collection_depth)]
             symb_masks = [self.mkvar(collection_depth, BOOL, min_collection_depth, on_z3_var, on_z3_assertion) for i in range(size - min_collection_depth)]
             mask  = symb_masks + true_masks
+            if self.masks is not None:
+                self.masks.extend((m, size - 1 - i) for (i, m) in enumerate(symb_masks))
             elems = [self.mkvar(collection_depth, ty.t, min_collection_depth, on_z3_var, on_z3_assertion) for i in range(collection_depth)]
             # symmetry breaking
             for i in range(len(mask) - 1):
@@ -941,6 +996,8 @@ class ToZ3(Visitor):
         elif isinstance(ty, TMap):
             default = self.mkval(ty.v)
             mask = [self.mkvar(collection_depth, BOOL, min_collection_depth, on_z3_var, on_z3_assertion) for i in range(collection_depth)]
+            if self.masks is not None:
+                self.masks.extend((m, collection_depth - 1 - i) for (i, m) in enumerate(mask))
             # symmetry breaking
             for i in range(len(mask) - 1):
                 on_z3_assertion(self.implies(mask[i], mask[i+1]))
@@ -999,11 +1056,174 @@ class ExtractedFunc(object):
     def __call__(self, *args):
         return self.cases.get(args, self.default)
 
+class QueryCache(object):
+    """
+    A least-recently-used cache of solver results, keyed by the query, the
+    solver's assumptions and declarations, and the collection depth. Formulas
+    are compared up to alpha-equivalence. Each entry is a pair (sat, model)
+    where `model` is None for unsatisfiable queries and for queries whose
+    model was not extracted.
+
+    Its size is controlled by the "solver-cache-size" option. If the
+    "solver-cache-file" option is set, entries are also appended to that file
+    and loaded from it on first use.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.loaded_file = None
+
+    def _load(self, path):
+        self.loaded_file = path
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                try:
+                    key, value = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError):
+                    # a truncated trailing record, e.g. from an interrupted run
+                    print("WARNING: ignoring corrupt tail of {}".format(path))
+                    break
+                self.entries[key] = value
+        self._shrink()
+
+    def _shrink(self):
+        while len(self.entries) > query_cache_size.value:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        path = query_cache_file.value
+        if path and path != self.loaded_file:
+            self._load(path)
+        res = self.entries.get(key)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return res
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self._shrink()
+        path = query_cache_file.value
+        if path:
+            try:
+                data = pickle.dumps((key, value))
+            except (pickle.PicklingError, AttributeError, TypeError):
+                data = pickle.dumps((key, (value[0], None)))
+            with open(path, "ab") as f:
+                f.write(data)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+query_cache = QueryCache()
+
+z3_calls = 0
+
+NO_TIMEOUT = 4294967295 # Z3's default "timeout", in milliseconds
+
+RecordedQuery = namedtuple("RecordedQuery", [
+    "formula",              # The query
+    "assumptions",          # Assumptions added to the solver before the query
+    "vars",                 # Declared variables
+    "funcs",                # Declared functions
+    "collection_depth",
+    "min_collection_depth",
+    "validate_model",
+    "logic",
+    "timeout",
+    "sat",                  # Whether the query was satisfiable
+    "seconds",              # How long the query took
+    "cached",               # Whether the result came from the query cache
+    ])
+
+def _record_query(path, record):
+    try:
+        data = pickle.dumps(record)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        print("WARNING: cannot record solver query: {}".format(e))
+        return
+    # one write per record, so that concurrent jobs do not interleave
+    with open(path, "ab") as f:
+        f.write(data)
+
+def load_recorded_queries(path) -> [RecordedQuery]:
+    """
+    Read the queries recorded with the "record-solver-queries" option, in the
+    order they were issued.
+    """
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, AttributeError):
+                print("WARNING: ignoring corrupt tail of {}".format(path))
+                break
+
+class EncodingMemo(object):
+    """
+    The memo of subexpression encodings used by ToZ3 (see ToZ3.memo).
+
+    Encodings made after a `push` may mention variables and assertions that
+    the matching `pop` removes, so `pop` forgets them. Rather than copying
+    the memo on every push, the memo keeps a log of the keys it added and
+    `pop` deletes the ones added since the matching push.
+
+    When the memo holds `max_size` entries it is cleared; afterwards every
+    open scope forgets everything added since the clear when it is popped.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = { }
+        self.log = []    # keys in the order they were added
+        self.scopes = [] # len(self.log) at each push
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, k):
+        return self.entries.get(k)
+
+    def __setitem__(self, k, v):
+        if len(self.entries) >= self.max_size:
+            self.entries.clear()
+            self.log.clear()
+            self.scopes = [0] * len(self.scopes)
+        if k not in self.entries:
+            self.log.append(k)
+        self.entries[k] = v
+
+    def push(self):
+        self.scopes.append(len(self.log))
+
+    def pop(self):
+        n = self.scopes.pop()
+        for k in self.log[n:]:
+            del self.entries[k]
+        del self.log[n:]
+
 class IncrementalSolver(object):
     SAVE_PROPS = [
         "vars",
         "funcs",
-        "_env"]
+        "_env",
+        "_assumptions",
+        "_assumption_keys",
+        "_masks"]
 
     def __init__(self,
             vars = None,
@@ -1025,7 +1245,13 @@ class IncrementalSolver(object):
         self.collection_depth = collection_depth
         self.validate_model = validate_model
         self.model_callback = model_callback
+        self.logic = logic
+        self.timeout = timeout
         self._env = OrderedDict()
+        self._encodings = EncodingMemo(encoding_memo_size.value) if memoize_encodings.value else None
+        self._assumptions = []
+        self._assumption_keys = []
+        self._masks = []
         self.stk = []
         self.do_cse = do_cse
 
@@ -1044,16 +1270,21 @@ class IncrementalSolver(object):
             self._create_vars(vars=vars or (), funcs=funcs or {})
 
     def push(self):
-        self.stk.append(tuple(type(getattr(self, p))(getattr(self, p)) for p in IncrementalSolver.SAVE_PROPS))
+        self.stk.append(tuple((lambda x: x if x is None else type(x)(x))(getattr(self, p)) for p in IncrementalSolver.SAVE_PROPS))
+        if self._encodings is not None:
+            self._encodings.push()
         self.z3_solver.push()
 
     def pop(self):
         x = self.stk.pop()
         for v, p in zip(x, IncrementalSolver.SAVE_PROPS):
             setattr(self, p, v)
+        if self._encodings is not None:
+            self._encodings.pop()
         self.z3_solver.pop()
 
     def _create_vars(self, vars, funcs):
+        self.visitor.masks = self._masks
         for f, t in funcs.items():
             if f not in self._env:
                 self._env[f] = self.visitor.mkvar(self.collection_depth, t, min_collection_depth=self.min_collection_depth)
@@ -1067,15 +1298,24 @@ class IncrementalSolver(object):
         _tick()
         orig_e = e
         try:
-            e = purify(e)
-            if self.do_cse:
-                orig_size = e.size()
-                e = cse(e, verify=False)
-                _tock(e, "cse (size: {} --> {})".format(orig_size, e.size()))
+            if self._encodings is None:
+                e = purify(e)
+                if self.do_cse:
+                    orig_size = e.size()
+                    e = cse(e, verify=False)
+                    _tock(e, "cse (size: {} --> {})".format(orig_size, e.size()))
             with _LOCK:
                 self._create_vars(vars=free_vars(e), funcs=free_funcs(e))
                 with task("encode formula", size=e.size()):
-                    return self.visitor.visit(e, self._env)
+                    # Memoized encodings serve the same purpose as CSE, and
+                    # they are shared across formulas.
+                    self.visitor.memo = self._encodings
+                    self.visitor.memo_env = self._env
+                    try:
+                        return self.visitor.visit(e, self._env)
+                    finally:
+                        self.visitor.memo = None
+                        self.visitor.memo_env = None
         except:
             print("conversion failed for: {!r}".format(orig_e))
             raise
@@ -1084,6 +1324,8 @@ class IncrementalSolver(object):
         try:
             with _LOCK:
                 self.z3_solver.add(self._convert(e))
+                self._assumptions.append(e)
+                self._assumption_keys.append(alpha_key(e, typed=True))
         except Exception:
             print(" ---> to reproduce: satisfy({e!r}, vars={vars!r}, collection_depth={collection_depth!r}, validate_model={validate_model!r})".format(
                 e=e,
@@ -1092,7 +1334,99 @@ class IncrementalSolver(object):
                 validate_model=self.validate_model))
             raise
 
+    def _query_key(self, e):
+        return (
+            alpha_key(e, typed=True),
+            tuple(self._assumption_keys),
+            frozenset((v.id, v.type) for v in self.vars),
+            frozenset(self.funcs.items()),
+            self.collection_depth,
+            self.min_collection_depth,
+            self.validate_model,
+            self.logic,
+            self.timeout)
+
     def satisfy(self, e, model_extraction=True):
+        if not record_solver_queries.value:
+            return self._cached_satisfy(e, model_extraction)
+        start = time.perf_counter()
+        hits = query_cache.hits
+        res = self._cached_satisfy(e, model_extraction)
+        _record_query(record_solver_queries.value, RecordedQuery(
+            formula=e,
+            assumptions=list(self._assumptions),
+            vars=list(self.vars),
+            funcs=OrderedDict(self.funcs),
+            collection_depth=self.collection_depth,
+            min_collection_depth=self.min_collection_depth,
+            validate_model=self.validate_model,
+            logic=self.logic,
+            timeout=self.timeout,
+            sat=res is not None,
+            seconds=time.perf_counter() - start,
+            cached=query_cache.hits > hits))
+        return res
+
+    def _solve(self, e, model_extraction):
+        if portfolio_after.value <= 0:
+            return self._satisfy(e, model_extraction)
+        timeout = portfolio_after.value
+        if self.timeout is not None:
+            timeout = min(timeout, int(self.timeout * 1000))
+        self.z3_solver.set("timeout", timeout)
+        try:
+            return self._satisfy(e, model_extraction)
+        except SolverReportedUnknown:
+            pass
+        finally:
+            self.z3_solver.set("timeout", int(self.timeout * 1000) if self.timeout is not None else NO_TIMEOUT)
+        res = portfolio.race(self, e, model_extraction)
+        if res is not None and self.model_callback is not None:
+            self.model_callback(res)
+        return res
+
+    def _cached_satisfy(self, e, model_extraction):
+        if query_cache_size.value <= 0:
+            return self._solve(e, model_extraction)
+        with _LOCK:
+            key = self._query_key(e)
+            cached = query_cache.get(key)
+            if cached is not None:
+                sat, model = cached
+                if not sat:
+                    return None
+                if model is not None:
+                    res = dict(model)
+                    if self.model_callback is not None:
+                        self.model_callback(res)
+                    return res
+                if not model_extraction:
+                    return { }
+            res = self._solve(e, model_extraction)
+            if res is None:
+                query_cache.put(key, (False, None))
+            else:
+                query_cache.put(key, (True, dict(res) if model_extraction else None))
+            return res
+
+    def _check(self):
+        """
+        Check the formulas added to the solver. With --iterative-deepening,
+        first look for models whose collections have 1, 2, ... elements; only
+        the final round at the full collection depth can report unsat.
+        """
+        solver = self.z3_solver
+        if iterative_deepening.value:
+            for depth in range(1, self.collection_depth):
+                bounds = [z3.Not(m) for (m, n) in self._masks if n >= depth]
+                if not bounds:
+                    break
+                with task("check at depth", depth=depth):
+                    if solver.check(*bounds) == z3.sat:
+                        return z3.sat
+        return solver.check()
+
+    def _satisfy(self, e, model_extraction):
         _env = self._env
         solver = self.z3_solver
         vars = self.vars
@@ -1156,8 +1490,10 @@ class IncrementalSolver(object):
             solver.add(a)
 
             _tock(e, "encode")
+            global z3_calls
+            z3_calls += 1
             with task("invoke Z3"):
-                res = solver.check()
+                res = self._check()
             _tock(e, "solve")
             if res == z3.unsat:
                 solver.pop()
@@ -1262,17 +1598,308 @@ class IncrementalSolver(object):
     def valid(self, e):
         return not self.satisfiable(ENot(e))
 
+class SolverPool(object):
+    """
+    Idle solvers for the module-level satisfy, satisfiable, and valid
+    functions, keyed by the arguments they were constructed with. Creating a
+    solver means creating a Z3 context and declaring every variable, so reusing
+    one is much cheaper. A checked-out solver answers its query between push
+    and pop, so that the query leaves nothing behind.
+
+    At most "solver-pool-size" solvers are kept; the least recently used are
+    dropped first. Solvers are never shared between processes.
+    """
+
+    def __init__(self):
+        self.idle = OrderedDict() # key -> [IncrementalSolver]
+        self.count = 0
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(opts):
+        opts = dict(opts)
+        vars = opts.pop("vars", None) or ()
+        funcs = opts.pop("funcs", None) or { }
+        opts.pop("model_callback", None)
+        try:
+            key = (
+                frozenset((v.id, v.type) for v in vars),
+                frozenset(funcs.items()),
+                frozenset(opts.items()))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _take(self, key):
+        with self.lock:
+            if self.pid != os.getpid():
+                # inherited from a parent process
+                self.idle.clear()
+                self.count = 0
+                self.pid = os.getpid()
+            solvers = self.idle.get(key)
+            if not solvers:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.count -= 1
+            s = solvers.pop()
+            if not solvers:
+                del self.idle[key]
+            return s
+
+    def _give(self, key, s):
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.idle.setdefault(key, []).append(s)
+            self.idle.move_to_end(key)
+            self.count += 1
+            while self.count > solver_pool_size.value:
+                k, solvers = next(iter(self.idle.items()))
+                solvers.pop(0)
+                if not solvers:
+                    del self.idle[k]
+                self.count -= 1
+                self.evictions += 1
+
+    @contextmanager
+    def solver(self, **opts):
+        """
+        Check out a solver equivalent to IncrementalSolver(**opts) for use in
+        a `with` block.
+        """
+        key = self._key(opts) if solver_pool_size.value > 0 else None
+        if key is None:
+            yield IncrementalSolver(**opts)
+            return
+        s = self._take(key)
+        if s is None:
+            s = IncrementalSolver(**opts)
+        s.model_callback = opts.get("model_callback")
+        s.push()
+        try:
+            yield s
+        finally:
+            s.pop()
+            s.model_callback = None
+        self._give(key, s)
+
+    def clear(self):
+        with self.lock:
+            self.idle.clear()
+            self.count = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+solver_pool = SolverPool()
+
+PortfolioConfig = namedtuple("PortfolioConfig", [
+    "name",
+    "options",              # [(Option, value)] to set in the solver process
+    "collection_depth",     # A smaller bound to use, or None; then only sat is definitive
+    ])
+
+PORTFOLIO = (
+    PortfolioConfig("default", (), None),
+    PortfolioConfig("macro-finder", ((use_quantified_encoding, True),), None),
+    PortfolioConfig("shallow", ((iterative_deepening, True),), 2),
+    )
+
+def query_shape(e : Exp):
+    """
+    A coarse description of a query, used to learn which portfolio
+    configuration tends to answer similar queries first.
+    """
+    return (
+        e.size().bit_length(),
+        tuple(sorted(set(type(t).__name__ for v in free_vars(e) for t in all_types(v.type) if is_collection(t) or isinstance(t, TMap)))))
+
+def _exit_on_sigterm(signum, frame):
+    sys.exit(1)
+
+def _portfolio_worker(i, config, query, model_extraction, q):
+    # undo Portfolio.race's handler: Python handlers wait for Z3 to return,
+    # and losers must die immediately
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        for opt, value in config.options:
+            opt.value = value
+        portfolio_after.value = 0
+        record_solver_queries.value = ""
+        query_cache_size.value = 0
+        depth = query.collection_depth
+        if config.collection_depth is not None:
+            depth = min(depth, config.collection_depth)
+        s = IncrementalSolver(
+            vars=query.vars,
+            funcs=query.funcs,
+            collection_depth=depth,
+            min_collection_depth=query.min_collection_depth,
+            validate_model=query.validate_model,
+            logic=query.logic,
+            timeout=query.timeout)
+        for a in query.assumptions:
+            s.add_assumption(a)
+        res = s.satisfy(query.formula, model_extraction=model_extraction)
+        q.put((i, "unsat" if res is None else "sat", res))
+    except SolverReportedUnknown:
+        q.put((i, "unknown", None))
+    except Exception as e:
+        q.put((i, "error", repr(e)))
+
+class Portfolio(object):
+    """
+    Races solver configurations (see PORTFOLIO) on a query, each in its own
+    process, and takes the first definitive answer. The losers are killed, as
+    are all of the workers if the racing process itself is terminated.
+
+    The wins of each configuration are counted per query shape, and the
+    configurations with the best record for a shape are raced first;
+    configurations that were never tried on a shape rank above ones that
+    usually lose.
+    """
+
+    def __init__(self, configs=PORTFOLIO):
+        self.configs = list(configs)
+        self.races = defaultdict(int) # (shape, config name) -> number of races
+        self.wins = defaultdict(int)  # (shape, config name) -> number of wins
+
+    def score(self, shape, config):
+        k = (shape, config.name)
+        return (self.wins[k] + 1) / (self.races[k] + 2)
+
+    def choose(self, shape, collection_depth):
+        configs = [c for c in self.configs if c.collection_depth is None or c.collection_depth < collection_depth]
+        configs.sort(key=lambda c: -self.score(shape, c))
+        return configs[:max(portfolio_size.value, 1)]
+
+    def race(self, solver, e, model_extraction=True):
+        """
+        Answer solver.satisfy(e). Raises SolverReportedUnknown if no
+        configuration finds a definitive answer.
+        """
+        shape = query_shape(e)
+        configs = self.choose(shape, solver.collection_depth)
+        query = RecordedQuery(
+            formula=e,
+            assumptions=list(solver._assumptions),
+            vars=list(solver.vars),
+            funcs=OrderedDict(solver.funcs),
+            collection_depth=solver.collection_depth,
+            min_collection_depth=solver.min_collection_depth,
+            validate_model=solver.validate_model,
+            logic=solver.logic,
+            timeout=solver.timeout,
+            sat=None,
+            seconds=None,
+            cached=False)
+        q = Queue()
+        procs = [Process(target=_portfolio_worker, args=(i, c, query, model_extraction, q), daemon=True) for (i, c) in enumerate(configs)]
+        deadline = None if solver.timeout is None else time.monotonic() + solver.timeout
+        winner = None
+        # if this process is terminated mid-race (e.g. a killed Job), unwind
+        # so that the workers are terminated too
+        old_handler = None
+        if threading.current_thread() is threading.main_thread():
+            old_handler = signal.signal(signal.SIGTERM, _exit_on_sigterm)
+        with task("portfolio", configs=len(configs)):
+            try:
+                for p in procs:
+                    p.start()
+                pending = len(procs)
+                while pending and (deadline is None or time.monotonic() < deadline):
+                    try:
+                        i, status, res = q.get(timeout=0.1)
+                    except Empty:
+                        if not any(p.is_alive() for p in procs) and q.empty():
+                            break
+                        continue
+                    pending -= 1
+                    event("{} reported {}", configs[i].name, status)
+                    if status == "sat" or (status == "unsat" and configs[i].collection_depth is None):
+                        winner = i
+                        break
+            finally:
+                for p in procs:
+                    if p.is_alive():
+                        p.terminate()
+                for p in procs:
+                    if p.pid is not None:
+                        p.join()
+                q.close()
+                if old_handler is not None:
+                    signal.signal(signal.SIGTERM, old_handler)
+        for c in configs:
+            self.races[(shape, c.name)] += 1
+        if winner is None:
+            raise SolverReportedUnknown("no portfolio configuration found an answer")
+        self.wins[(shape, configs[winner].name)] += 1
+        tracing.instant("portfolio", winner=configs[winner].name)
+        return res
+
+    def stats(self):
+        """Wins and races of each configuration, summed over query shapes."""
+        res = OrderedDict((c.name, [0, 0]) for c in self.configs)
+        for (shape, name), n in self.races.items():
+            res[name][1] += n
+        for (shape, name), n in self.wins.items():
+            res[name][0] += n
+        return res
+
+portfolio = Portfolio()
+
 def satisfy(e, **opts):
-    s = IncrementalSolver(**opts)
-    return s.satisfy(e)
+    with solver_pool.solver(**opts) as s:
+        return s.satisfy(e)
 
 def satisfiable(e, **opts):
-    s = IncrementalSolver(**opts)
-    return s.satisfiable(e)
+    with solver_pool.solver(**opts) as s:
+        return s.satisfiable(e)
 
 def valid(e, **opts):
-    s = IncrementalSolver(**opts)
-    return s.valid(e)
+    with solver_pool.solver(**opts) as s:
+        return s.valid(e)
+
+def _removals(model, v):
+    """All copies of `model` with one element or entry removed from v's value."""
+    val = model[v.id]
+    if isinstance(v.type, TMap):
+        items = list(val.items())
+        vals = (evaluation.Map(v.type, val.default, items[:i] + items[i+1:]) for i in range(len(items)))
+    elif isinstance(v.type, TList):
+        vals = (val[:i] + val[i+1:] for i in range(len(val)))
+    else:
+        elems = tuple(val)
+        vals = (evaluation.Bag(elems[:i] + elems[i+1:]) for i in range(len(elems)))
+    for x in vals:
+        m = dict(model)
+        m[v.id] = x
+        yield m
+
+def shrink_model(e : Exp, model : dict) -> dict:
+    """
+    Remove elements from the collections and entries from the maps in
+    `model` for as long as it still satisfies `e`. In the result, removing
+    any one of them would falsify `e`.
+
+    Only top-level variables are shrunk, and the check is done by evaluation,
+    so this never calls the solver.
+    """
+    vars = [v for v in free_vars(e) if v.id in model and (is_collection(v.type) or isinstance(v.type, TMap))]
+    with task("shrinking model"):
+        while True:
+            smaller = [m for v in vars for m in _removals(model, v)]
+            i = next((i for (i, ok) in enumerate(eval_bulk(e, smaller)) if ok), None)
+            if i is None:
+                return model
+            model = smaller[i]
 
 class ModelCachingSolver(object):
     """
@@ -1287,6 +1914,7 @@ class ModelCachingSolver(object):
         self.calls = 0
         self.hits = 0
         self.examples = list(examples)
+        self.assumptions = assumptions
         self.solver = IncrementalSolver(vars=vars, funcs=funcs)
         self.solver.add_assumption(assumptions)
 
@@ -1299,6 +1927,9 @@ class ModelCachingSolver(object):
                 return x
         x = self.solver.satisfy(e)
         if x is not None:
+            if shrink_models.value:
+                # smaller models are cheaper to evaluate on every later call
+                x = shrink_model(EAll([self.assumptions, e]), x)
             self.examples.append(x)
         return x
 
@@ -4,6 +4,8 @@ Important functions:
  - pprint: prettyprint a syntax tree
  - free_vars: compute the set of free variables
  - alpha_equivalent: test alpha equivalence of two expressions
+ - alpha_key: a hashable key that is equal for alpha-equivalent expressions
+ - hash_cons: share structurally identical subtrees between expressions
  - tease_apart: separate a packed expression into its state and runtime
     components
 """
@@ -14,6 +16,7 @@ import sys
 import itertools
 import json
 import functools
+import weakref
 from enum import Enum
 
 from cozy import common
@@ -480,8 +483,16 @@ def free_vars(exp, counts=False):
     If counts=True, then this function returns an OrderedDict in a
     deterministic order mapping each EVar to the number of times it occurs in
     the AST.
+
+    Results for expressions are cached on the expression (see
+    common.cached_result).
     """
 
+    if isinstance(exp, syntax.Exp):
+        cached = common.cached_result(exp, "_free_vars_cache")
+        if cached is not None:
+            return collections.OrderedDict(cached) if counts else common.OrderedSet(cached.keys())
+
     res = collections.OrderedDict()
     bound = collections.defaultdict(int)
 
@@ -518,6 +529,15 @@ def free_vars(exp, counts=False):
     stk = [exp]
     while stk:
         x = stk.pop()
+        if x is not exp and isinstance(x, syntax.Exp):
+            cached = common.cached_result(x, "_free_vars_cache")
+            if cached is not None:
+                # variables bound outside an EStateVar are not visible inside it
+                is_state_var = isinstance(x, target_syntax.EStateVar)
+                for k, v in cached.items():
+                    if is_state_var or not bound[k]:
+                        res[k] = res.get(k, 0) + v
+                continue
         if isinstance(x, PushScope) or isinstance(x, PopScope) or isinstance(x, Bind):
             x.exec()
         elif isinstance(x, syntax.EVar):
@@ -591,6 +611,9 @@ def free_vars(exp, counts=False):
         else:
             raise NotImplementedError(repr(x))
 
+    if isinstance(exp, syntax.Exp):
+        common.cache_result(exp, "_free_vars_cache", res)
+        res = collections.OrderedDict(res)
     if not counts:
         res = common.OrderedSet(res.keys())
     return res
@@ -1168,8 +1191,116 @@ def alpha_equivalent(e1 : syntax.Exp, e2 : syntax.Exp) -> bool:
         def visit_object(self, o, *args):
             raise NotImplementedError("{} ({})".format(type(o), repr(o)))
 
+    if e1 is e2:
+        return True
     return V().visit(e1, e2)
 
+def alpha_key(e : syntax.Exp, typed : bool = False, binders : (str,) = ()):
+    """
+    A hashable canonical form for `e` in which bound variables are replaced
+    by de Bruijn indices, so that
+        alpha_key(e1) == alpha_key(e2)
+    whenever alpha_equivalent(e1, e2). If typed=True, then the key also
+    includes the type of every node.
+
+    The `binders` are the names of variables bound around `e`, innermost
+    last. Untyped keys computed with no binders are cached on the expression
+    (see common.cached_result). Typed keys are not, since reassigning the
+    `type` of a node does not invalidate cached results.
+    """
+    if typed or binders or not isinstance(e, syntax.Exp):
+        return _alpha_key(e, typed, binders)
+    res = common.cached_result(e, "_alpha_key_cache")
+    if res is None:
+        res = _alpha_key(e, typed, ())
+        common.cache_result(e, "_alpha_key_cache", res)
+    return res
+
+def _alpha_key(e, typed, binders):
+    if isinstance(e, syntax.Exp):
+        t = getattr(e, "type", None) if typed else None
+        if isinstance(e, syntax.EVar):
+            for (i, v) in enumerate(reversed(binders)):
+                if v == e.id:
+                    return (syntax.EVar, t, i)
+            return (syntax.EVar, t, e.id)
+        elif isinstance(e, target_syntax.ELambda):
+            return (target_syntax.ELambda, e.arg.type if typed else None, _alpha_key(e.body, typed, binders + (e.arg.id,)))
+        elif isinstance(e, target_syntax.EStateVar):
+            # variables under EStateVar are never bound by enclosing binders
+            return (target_syntax.EStateVar, t, alpha_key(e.e, typed))
+        elif isinstance(e, syntax.EListComprehension):
+            res = [syntax.EListComprehension, t]
+            for c in e.clauses:
+                if isinstance(c, syntax.CPull):
+                    res.append((syntax.CPull, _alpha_key(c.e, typed, binders)))
+                    binders = binders + (c.id,)
+                else:
+                    res.append((type(c), _alpha_key(c.e, typed, binders)))
+            res.append(_alpha_key(e.e, typed, binders))
+            return tuple(res)
+        elif binders:
+            return (type(e), t) + tuple(_alpha_key(c, typed, binders) for c in e.children())
+        else:
+            return (type(e), t) + tuple(alpha_key(c, typed) for c in e.children())
+    elif isinstance(e, tuple) or isinstance(e, list):
+        return tuple(_alpha_key(c, typed, binders) for c in e)
+    return e
+
+_hash_cons_table = weakref.WeakValueDictionary()
+
+def hash_cons(e : syntax.Exp) -> syntax.Exp:
+    """
+    Returns an expression equivalent to `e` (including the .type of every
+    node) in which structurally identical subtrees are the same object.
+    Nodes are shared with every other expression returned by this function
+    for as long as any of them is alive, so equality checks between the
+    results mostly succeed on object identity and they use less memory.
+
+    The results (which may include `e` itself or its subtrees) must not be
+    mutated.
+    """
+    memo = { } # id(node) -> (node, hash-consed node)
+    def key(x):
+        if isinstance(x, syntax.Exp):
+            return id(cons(x))
+        if isinstance(x, tuple) or isinstance(x, list):
+            return (type(x),) + tuple(key(c) for c in x)
+        return (type(x), x)
+    def cons(x):
+        res = memo.get(id(x))
+        if res is not None:
+            return res[1]
+        children = x.children()
+        k = (type(x), getattr(x, "type", None)) + tuple(key(c) for c in children)
+        try:
+            res = _hash_cons_table.get(k)
+        except TypeError:
+            # some child is not hashable; leave the node unshared
+            res = x
+        if res is None:
+            new_children = tuple(_rebuild(c, memo) for c in children)
+            if all(a is b for (a, b) in zip(children, new_children)):
+                res = x
+            else:
+                res = type(x)(*new_children)
+                if hasattr(x, "type"):
+                    res.type = x.type
+            _hash_cons_table[k] = res
+        memo[id(x)] = (x, res)
+        return res
+    return cons(e)
+
+def _rebuild(x, memo):
+    if isinstance(x, syntax.Exp):
+        return memo[id(x)][1]
+    if isinstance(x, tuple) or isinstance(x, list):
+        new = [_rebuild(c, memo) for c in x]
+        if all(a is b for (a, b) in zip(x, new)):
+            return x
+        return type(x)(new)
+    return x
+
 def freshen_binders(e : syntax.Exp, context):
     fvs = { v : True for v, p in context.vars() }
     class V(BottomUpRewriter):
@@ -1296,26 +1427,9 @@ class Aeq(object):
     def __init__(self, e : syntax.Exp):
         self.e = e
     def __hash__(self):
-        res = 0
-        q = [self.e]
-        while q:
-            x = q[-1]
-            del q[-1]
-            if isinstance(x, syntax.EVar):
-                continue
-            elif isinstance(x, common.ADT):
-                res *= 31
-                res += hash(type(x))
-                res %= 2**64
-                q.extend(x.children())
-            elif isinstance(x, tuple) or isinstance(x, list):
-                q.extend(x)
-            else:
-                res += hash(x)
-                # raise NotImplementedError(repr(x))
-        return res % (2**64)
+        return hash(alpha_key(self.e))
     def __eq__(self, other):
-        return isinstance(other, Aeq) and alpha_equivalent(self.e, other.e)
+        return isinstance(other, Aeq) and alpha_key(self.e) == alpha_key(other.e)
     def __ne__(self, other):
         return not (self == other)
 
@@ -1326,26 +1440,24 @@ class ExpMap(object):
         for k, v in items:
             self[k] = v
     def _hash(self, k):
-        return (type(k), k.type, k)
-    def _unhash(self, h):
-        return h[2]
+        return alpha_key(k, typed=True)
     def get(self, k):
         i = id(k)
         try:
             return self.by_id[i]
         except KeyError:
-            return self.by_hash.get(self._hash(k))
+            res = self.by_hash.get(self._hash(k))
+            return None if res is None else res[1]
     def __setitem__(self, k, v):
         self.by_id[id(k)] = v
-        self.by_hash[self._hash(k)] = v
+        self.by_hash[self._hash(k)] = (k, v)
     def __delitem__(self, k):
         i = id(k)
         if i in self.by_id:
             del self.by_id[i]
         del self.by_hash[self._hash(k)]
     def items(self):
-        for (k, v) in self.by_hash.items():
-            yield (self._unhash(k), v)
+        yield from self.by_hash.values()
     def values(self):
         for k, v in self.items():
             yield v
@@ -8,7 +8,7 @@ from cozy.typecheck import is_numeric, is_collection, retypecheck
 from cozy.pools import RUNTIME_POOL, STATE_POOL, ALL_POOLS, pool_name
 from cozy.structures.heaps import TMinHeap, TMaxHeap, EMakeMinHeap, EMakeMaxHeap, EHeapPeek, EHeapPeek2
 from cozy.evaluation import construct_value
-from cozy.logging import task, event
+from cozy.logging import task, event, lazy
 from cozy.cost_model import is_constant_time
 
 accelerate = Option("acceleration-rules", bool, True)
@@ -52,7 +52,7 @@ def reachable_values_of_type(root : Exp, t : Type) -> Exp:
 def map_accelerate(e, context):
     with task("map_accelerate", size=e.size()):
         if is_constant_time(e):
-            event("skipping map lookup inference for constant-time exp: {}".format(pprint(e)))
+            event("skipping map lookup inference for constant-time exp: {}", lazy(pprint, e))
             return
 
         @lru_cache()
@@ -65,7 +65,7 @@ def map_accelerate(e, context):
 
         stk = [e]
         while stk:
-            event("exp {} / {}".format(i, e.size()))
+            event("exp {} / {}", i, e.size())
             i += 1
             arg = stk.pop()
             if isinstance(arg, tuple):
@@ -125,7 +125,7 @@ def map_accelerate(e, context):
             if num_with_args < 2:
                 stk.extend(arg.children())
             else:
-                event("refusing to visit children of {}".format(pprint(arg)))
+                event("refusing to visit children of {}", lazy(pprint, arg))
 
 def histogram(xs : Exp) -> Exp:
     elem_type = xs.type.t
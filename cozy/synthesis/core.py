@@ -3,26 +3,33 @@ import datetime
 import itertools
 import functools
 import sys
+import time
 import traceback
 
 from cozy.target_syntax import *
 from cozy.typecheck import is_collection
-from cozy.syntax_tools import subst, pprint, free_vars, fresh_var, alpha_equivalent, enumerate_fragments, strip_EStateVar, freshen_binders, wrap_naked_statevars, break_conj
+from cozy.syntax_tools import BottomUpRewriter, subst, pprint, free_vars, fresh_var, alpha_equivalent, alpha_key, enumerate_fragments, strip_EStateVar, freshen_binders, wrap_naked_statevars, break_conj, all_exps, free_funcs
 from cozy.wf import ExpIsNotWf, exp_wf
 from cozy.common import OrderedSet, ADT, Visitor, fresh_name, unique, pick_to_sum, OrderedDefaultDict, OrderedSet, group_by, find_one, extend, StopException
-from cozy.solver import satisfy, satisfiable, valid, IncrementalSolver, ModelCachingSolver
-from cozy.evaluation import eval, eval_bulk, mkval, construct_value, uneval, eq
+from cozy import solver as solver_module
+from cozy.solver import satisfy, satisfiable, valid, IncrementalSolver, ModelCachingSolver, shrink_model, shrink_models
+from cozy.evaluation import eval, eval_bulk, free_vars_and_funcs, mkval, construct_value, uneval, comparator, EQ, compile_cache
 from cozy.cost_model import CostModel, Order, rt as runtime, asymptotic_runtime, max_storage_size, LINEAR_TIME_UOPS
 from cozy.opts import Option
+from cozy import tracing
 from cozy.pools import Pool, ALL_POOLS, RUNTIME_POOL, STATE_POOL, pool_name
-from cozy.contexts import Context, shred, replace
-from cozy.logging import task, event
+from cozy.contexts import Context, UnderBinder, shred, replace
+from cozy.logging import task, event, lazy
 
 from .acceleration import try_optimize
-from .enumeration import Enumerator, fingerprint, eviction_policy
+from .enumeration import Enumerator, fingerprint, eviction_policy, essential_examples
+
+METRICS_INTERVAL = 1.0 # seconds
 
 eliminate_vars = Option("eliminate-vars", bool, False)
 incremental = Option("incremental", bool, False, description="Experimental option that can greatly improve performance.")
+prune_examples = Option("prune-examples", int, 0, metavar="N", description="After every N counterexamples, drop the examples that no longer tell apart any expressions the search has seen; 0 keeps every example.")
+counterexamples_per_failure = Option("counterexamples-per-failure", int, 1, metavar="K", description="When a candidate is wrong, look for up to K counterexamples on which it produces different outputs before restarting the search.")
 
 class NoMoreImprovements(Exception):
     pass
@@ -47,6 +54,119 @@ def exploration_order(targets : [Exp], context : Context, pool : Pool = RUNTIME_
         for e, ctx, p in sorted(unique(shred(target, context, pool=pool)), key=sort_key):
             yield (target, e, ctx, p)
 
+class _Precomputer(BottomUpRewriter):
+    """
+    Replaces every non-trivial subexpression that neither contains the hole
+    nor mentions one of the `bound` variables with a fresh variable, recording
+    the replacements in `self.cached`.
+    """
+    def __init__(self, hole, bound):
+        self.hole = hole
+        self.bound = bound
+        self.cached = []
+    def visit_ELambda(self, e):
+        return self.join(e, (e.arg, self.visit(e.body)))
+    def visit_Exp(self, e):
+        if (e.size() > 1
+                and self.hole not in free_funcs(e)
+                and not any(v.id in self.bound for v in free_vars(e))):
+            v = fresh_var(e.type, "cached")
+            self.cached.append((v, e))
+            return v
+        return self.visit_ADT(e)
+
+class _HoleFiller(BottomUpRewriter):
+    def __init__(self, hole, binders, replacement):
+        self.hole = hole
+        self.binders = binders
+        self.replacement = replacement
+    def visit_ECall(self, e):
+        if e.func == self.hole:
+            return subst(self.replacement, { v.id : a for (v, a) in zip(self.binders, e.args) })
+        return self.visit_ADT(e)
+
+class SubstitutionTemplate(object):
+    """
+    A target with a hole where some subexpression used to be.
+
+    The values of everything outside the hole are computed once for each
+    example, so fingerprinting the target with a different expression in the
+    hole only re-evaluates the path from the hole to the root.
+    """
+    def __init__(self,
+            target : Exp, context : Context,
+            needle : Exp, needle_context : Context, needle_pool : Pool,
+            examples : [{str:object}]):
+        self.target = target
+        self.context = context
+        self.needle = needle
+        self.needle_context = needle_context
+        self.needle_pool = needle_pool
+        self.examples = examples
+
+        binders = []
+        ctx = needle_context
+        while isinstance(ctx, UnderBinder):
+            binders.append(ctx.var)
+            ctx = ctx.parent()
+        self.binders = binders
+
+        # The hole is a variable if the replacement cannot mention binders.
+        # Otherwise it is a call taking the binders, so that `replace` renames
+        # them for each place the hole appears.
+        hole_name = fresh_name("hole")
+        if binders:
+            hole = ECall(hole_name, tuple(binders)).with_type(needle.type)
+        else:
+            hole = EVar(hole_name).with_type(needle.type)
+        self.hole = hole_name
+        holed = replace(
+            target, context, RUNTIME_POOL,
+            needle, needle_context, needle_pool,
+            hole)
+
+        bound = { hole_name }
+        for x in all_exps(holed):
+            if isinstance(x, ELambda):
+                bound.add(x.arg.id)
+        p = _Precomputer(hole_name, bound)
+        self.spine = p.visit(holed)
+
+        envs = [dict(ex) for ex in examples]
+        for v, e in p.cached:
+            for env, val in zip(envs, eval_bulk(e, examples)):
+                env[v.id] = val
+        if not binders:
+            needed = set(free_vars_and_funcs(self.spine))
+            envs = [{ k : v for (k, v) in env.items() if k in needed } for env in envs]
+        self.envs = envs
+
+    def fingerprint(self, replacement : Exp, replacement_fingerprint : tuple = None) -> tuple:
+        """
+        Equivalent to fingerprint(self.instantiate(replacement), self.examples).
+
+        For a hole in the root context, `replacement_fingerprint` may give the
+        replacement's own fingerprint on the examples to avoid evaluating it
+        again.
+        """
+        if self.binders:
+            e = _HoleFiller(self.hole, self.binders, replacement).visit(self.spine)
+            return (self.target.type,) + tuple(eval_bulk(e, self.envs))
+        if replacement_fingerprint is None:
+            replacement_fingerprint = fingerprint(replacement, self.examples)
+        envs = []
+        for env, val in zip(self.envs, replacement_fingerprint[1:]):
+            env = dict(env)
+            env[self.hole] = val
+            envs.append(env)
+        return (self.target.type,) + tuple(eval_bulk(self.spine, envs))
+
+    def instantiate(self, replacement : Exp) -> Exp:
+        return freshen_binders(replace(
+            self.target, self.context, RUNTIME_POOL,
+            self.needle, self.needle_context, self.needle_pool,
+            replacement), self.context)
+
 class Learner(object):
     def __init__(self, targets, assumptions, context, examples, cost_model, stop_callback, hints):
         self.context = context
@@ -54,6 +174,11 @@ class Learner(object):
         self.cost_model = cost_model
         self.assumptions = assumptions
         self.hints = list(hints)
+        self.examples = []
+        self.enumerator = None
+        self.templates = {}
+        self.considered = 0
+        self.size = 0
         self.reset(examples)
         self.watch(targets)
         self.wf_solver = ModelCachingSolver(
@@ -61,19 +186,69 @@ class Learner(object):
             funcs=context.funcs())
 
     def reset(self, examples):
-        self.examples = list(examples)
+        examples = list(examples)
+        old = self.examples
+        if self.enumerator is not None and len(examples) >= len(old) and all(x is y for (x, y) in zip(old, examples)):
+            # Only new examples were added; keep everything enumerated so far.
+            self.enumerator.add_examples(examples[len(old):])
+        else:
+            self.enumerator = None
+        self.examples = examples
+        self.templates = {}
 
     def watch(self, new_targets):
         assert new_targets
         self.targets = list(new_targets)
+        self.target_keys = { alpha_key(t) for t in self.targets }
+        # New targets bring new hints; the enumerator has to start over.
+        self.enumerator = None
+        self.templates = {}
+
+    def template(self, target, e, ctx, pool):
+        k = (target, e, ctx, pool)
+        t = self.templates.get(k)
+        if t is None:
+            with task("precomputing template", size=target.size()):
+                t = SubstitutionTemplate(target, self.context, e, ctx, pool, self.examples)
+            self.templates[k] = t
+        return t
+
+    def prune_examples(self, protect=()):
+        """
+        Drop examples that are not needed to tell apart the equivalence
+        classes of the enumerator or the pairs of expressions in `protect`.
+        Returns the remaining examples.
+        """
+        if self.enumerator is None:
+            return list(self.examples)
+        n = len(self.examples)
+        classes = self.enumerator.fingerprint_classes()
+        root_spans = list(range(n + 1))
+        for (a, b) in protect:
+            classes.append((root_spans, [fingerprint(a, self.examples), fingerprint(b, self.examples)]))
+        with task("pruning examples", examples=n):
+            keep = essential_examples(classes, n)
+        if len(keep) < n:
+            self.enumerator.remove_examples(keep)
+            self.examples = [self.examples[i] for i in keep]
+            self.templates = {}
+        return list(self.examples)
+
+    def metrics(self):
+        return {
+            "considered": self.considered,
+            "size": self.size,
+            "cache_size": self.enumerator.cache_size() if self.enumerator is not None else 0,
+            "wf_solver_calls": self.wf_solver.calls,
+            "wf_solver_hits": self.wf_solver.hits }
 
     def matches(self, fp, target_fp):
         assert isinstance(fp[0], Type)
         assert isinstance(target_fp[0], Type)
         if fp[0] != target_fp[0]:
             return False
-        t = fp[0]
-        return all(eq(t, fp[i], target_fp[i]) for i in range(1, len(fp)))
+        c = comparator(fp[0])
+        return all(c(fp[i], target_fp[i]) == EQ for i in range(1, len(fp)))
 
     def next(self):
         class No(object):
@@ -104,16 +279,18 @@ class Learner(object):
                 #         return No("too big")
                 return True
 
-        frags = list(unique(itertools.chain(
-            *[shred(t, root_ctx) for t in self.targets],
-            *[shred(h, root_ctx) for h in self.hints])))
-        enum = Enumerator(
-            examples=self.examples,
-            cost_model=self.cost_model,
-            check_wf=check_wf,
-            hints=frags,
-            heuristics=try_optimize,
-            stop_callback=self.stop_callback)
+        if self.enumerator is None:
+            frags = list(unique(itertools.chain(
+                *[shred(t, root_ctx) for t in self.targets],
+                *[shred(h, root_ctx) for h in self.hints])))
+            self.enumerator = Enumerator(
+                examples=self.examples,
+                cost_model=self.cost_model,
+                check_wf=check_wf,
+                hints=frags,
+                heuristics=try_optimize,
+                stop_callback=self.stop_callback)
+        enum = self.enumerator
 
         size = 0
         # target_cost = self.cost_model.cost(self.target, RUNTIME_POOL)
@@ -124,23 +301,26 @@ class Learner(object):
 
         while True:
 
+            self.size = size
             print("starting minor iteration {} with |cache|={}".format(size, enum.cache_size()))
+            tracing.instant("minor iteration", size=size, cache_size=enum.cache_size())
             if self.stop_callback():
                 raise StopException()
 
             n = 0
             for target, e, ctx, pool in exploration_order(self.targets, root_ctx):
+                template = self.template(target, e, ctx, pool)
                 with task("checking substitutions",
-                        target=pprint(replace(target, root_ctx, RUNTIME_POOL, e, ctx, pool, EVar("___"))),
-                        e=pprint(e)):
+                        target=lazy(lambda: pprint(replace(target, root_ctx, RUNTIME_POOL, e, ctx, pool, EVar("___")))),
+                        e=lazy(pprint, e)):
                     for info in enum.enumerate_with_info(size=size, context=ctx, pool=pool):
-                        with task("checking substitution", expression=pprint(info.e)):
+                        with task("checking substitution", expression=lazy(pprint, info.e)):
                             if self.stop_callback():
                                 raise StopException()
                             if info.e.type != e.type:
-                                event("wrong type (is {}, need {})".format(pprint(info.e.type), pprint(e.type)))
+                                event("wrong type (is {}, need {})", lazy(pprint, info.e.type), lazy(pprint, e.type))
                                 continue
-                            if alpha_equivalent(info.e, e):
+                            if alpha_key(info.e) == alpha_key(e):
                                 event("no change")
                                 continue
 
@@ -150,20 +330,19 @@ class Learner(object):
                                 continue
 
                             n += 1
-                            ee = freshen_binders(replace(
-                                target, root_ctx, RUNTIME_POOL,
-                                e, ctx, pool,
-                                info.e), root_ctx)
-                            if any(alpha_equivalent(t, ee) for t in self.targets):
-                                event("already seen")
-                                continue
-                            if not self.matches(fingerprint(ee, self.examples), target_fp):
+                            self.considered += 1
+                            fp = template.fingerprint(info.e, info.fingerprint if ctx == root_ctx else None)
+                            if not self.matches(fp, target_fp):
                                 event("incorrect")
                                 self.blacklist.add(k)
                                 continue
+                            ee = template.instantiate(info.e)
+                            if alpha_key(ee) in self.target_keys:
+                                event("already seen")
+                                continue
                             wf = check_wf(ee, root_ctx, RUNTIME_POOL)
                             if not wf:
-                                event("not well-formed [wf={}]".format(wf))
+                                event("not well-formed [wf={}]", wf)
                                 # if "expensive" in str(wf):
                                 #     print(repr(self.cost_model.examples))
                                 #     print(repr(ee))
@@ -201,6 +380,29 @@ def heuristic_done(e : Exp):
 def never_stop():
     return False
 
+def more_counterexamples(solver : IncrementalSolver, candidate : Exp, examples : [{str:object}], k : int) -> [{str:object}]:
+    """
+    Extend `examples`, models of the formula asserted on `solver`, to at most
+    `k` models on which `candidate` evaluates to pairwise different values.
+    Adds blocking assumptions to `solver`; callers should push and pop around
+    this call.
+    """
+    examples = list(examples)
+    blocked = 0
+    while len(examples) < k:
+        for ex in examples[blocked:]:
+            try:
+                val = uneval(candidate.type, eval(candidate, ex))
+            except NotImplementedError:
+                return examples
+            solver.add_assumption(ENot(EBinOp(candidate, "==", val).with_type(BOOL)))
+        blocked = len(examples)
+        ex = solver.satisfy(T)
+        if ex is None:
+            break
+        examples.append(ex)
+    return examples
+
 def improve(
         target        : Exp,
         context       : Context,
@@ -208,12 +410,22 @@ def improve(
         stop_callback                  = never_stop,
         hints         : [Exp]          = (),
         examples      : [{str:object}] = (),
-        cost_model    : CostModel      = None):
+        cost_model    : CostModel      = None,
+        frontier      : [Exp]          = (),
+        progress_callback              = None,
+        metrics_callback               = None):
     """
     Improve the target expression using enumerative synthesis.
     This function is a generator that yields increasingly better and better
     versions of the input expression `target`.
 
+    To resume an earlier search, pass the examples and the frontier (the
+    watched targets) it last reported. Whenever either of those changes,
+    `progress_callback(examples, frontier)` is called with copies of them.
+
+    If given, `metrics_callback(metrics)` is called about once per second
+    with a dictionary of counters describing the search.
+
     Notes on internals of this algorithm follow.
 
     Key differences from "regular" enumerative synthesis:
@@ -236,14 +448,16 @@ def improve(
         stop_callback={stop_callback!r},
         hints={hints!r},
         examples={examples!r},
-        cost_model={cost_model!r})""".format(
+        cost_model={cost_model!r},
+        frontier={frontier!r})""".format(
             target=target,
             context=context,
             assumptions=assumptions,
             stop_callback=stop_callback,
             hints=hints,
             examples=examples,
-            cost_model=cost_model))
+            cost_model=cost_model,
+            frontier=frontier))
 
     target = freshen_binders(target, context)
     assumptions = freshen_binders(assumptions, context)
@@ -294,6 +508,48 @@ def improve(
         cost_model = CostModel(funcs=funcs, assumptions=assumptions)
 
     watched_targets = [target]
+    for e in frontier:
+        if not any(alpha_key(e) == alpha_key(t) for t in watched_targets):
+            watched_targets.append(e)
+    if len(watched_targets) > 1:
+        print("Resuming with {} examples and {} watched targets".format(len(examples), len(watched_targets)))
+
+    def report_progress(*new_targets):
+        if progress_callback is not None:
+            progress_callback(list(examples), list(watched_targets) + list(new_targets))
+
+    learner = None
+    start = last_improvement = time.time()
+    improvements = 0
+    refuted = [] # (target, wrong candidate) pairs the examples must tell apart
+    pruned = 0
+    unpruned = 0 # counterexamples found since the last pruning
+    last_metrics = [start, 0]
+    def report_metrics():
+        now = time.time()
+        if learner is None or now - last_metrics[0] < METRICS_INTERVAL:
+            return
+        m = learner.metrics()
+        m["considered_per_second"] = (m["considered"] - last_metrics[1]) / (now - last_metrics[0])
+        m["solver_calls"] = solver_module.z3_calls
+        m["solver_cache_hits"] = solver_module.query_cache.hits
+        m["eval_cache_hits"] = compile_cache.hits
+        m["eval_cache_misses"] = compile_cache.misses
+        m["examples"] = len(examples)
+        m["counterexamples"] = len(examples) + pruned
+        m["pruned_examples"] = pruned
+        m["improvements"] = improvements
+        m["last_improvement"] = last_improvement
+        m["timestamp"] = now
+        last_metrics[:] = [now, m["considered"]]
+        metrics_callback(m)
+
+    if metrics_callback is not None:
+        orig_stop_callback = stop_callback
+        def stop_callback():
+            report_metrics()
+            return orig_stop_callback()
+
     learner = Learner(watched_targets, assumptions, context, examples, cost_model, stop_callback, hints)
     try:
         while True:
@@ -303,25 +559,53 @@ def improve(
 
                 # 2. check
                 with task("verifying candidate"):
+                    k = max(counterexamples_per_failure.value, 1)
+                    wrong = ENot(EBinOp(target, "==", new_target).with_type(BOOL))
                     if incremental.value:
                         solver.push()
-                        solver.add_assumption(ENot(EBinOp(target, "==", new_target).with_type(BOOL)))
-                        counterexample = _sat(T)
+                        solver.add_assumption(wrong)
+                        new_examples = more_counterexamples(solver, new_target, [], k)
+                        solver.pop()
                     else:
-                        formula = EAll([assumptions, ENot(EBinOp(target, "==", new_target).with_type(BOOL))])
+                        formula = EAll([assumptions, wrong])
                         counterexample = _sat(formula)
-                if counterexample is not None:
-                    if counterexample in examples:
-                        print("assumptions = {!r}".format(assumptions))
-                        print("duplicate example: {!r}".format(counterexample))
-                        print("old target = {!r}".format(target))
-                        print("new target = {!r}".format(new_target))
-                        raise Exception("got a duplicate example")
-                    # a. if incorrect: add example, reset the learner
-                    examples.append(counterexample)
-                    event("new example: {!r}".format(counterexample))
+                        new_examples = [] if counterexample is None else [counterexample]
+                        if new_examples and k > 1:
+                            with solver_module.solver_pool.solver(vars=vars, funcs=funcs) as s:
+                                s.add_assumption(formula)
+                                new_examples = more_counterexamples(s, new_target, new_examples, k)
+                if new_examples:
+                    if shrink_models.value:
+                        formula = EAll([assumptions, wrong])
+                        shrunk = []
+                        for ex in new_examples:
+                            ex = shrink_model(formula, ex)
+                            if ex not in shrunk:
+                                shrunk.append(ex)
+                        new_examples = shrunk
+                    for counterexample in new_examples:
+                        if counterexample in examples:
+                            print("assumptions = {!r}".format(assumptions))
+                            print("duplicate example: {!r}".format(counterexample))
+                            print("old target = {!r}".format(target))
+                            print("new target = {!r}".format(new_target))
+                            raise Exception("got a duplicate example")
+                    # a. if incorrect: add examples, reset the learner
+                    examples.extend(new_examples)
+                    tracing.instant("counterexample", examples=len(examples), candidate=lazy(pprint, new_target))
+                    for counterexample in new_examples:
+                        event("new example: {!r}", counterexample)
                     print("wrong; restarting with {} examples".format(len(examples)))
                     learner.reset(examples)
+                    refuted.append((target, new_target))
+                    unpruned += len(new_examples)
+                    if prune_examples.value > 0 and unpruned >= prune_examples.value:
+                        n = len(examples)
+                        examples = learner.prune_examples(refuted)
+                        pruned += n - len(examples)
+                        unpruned = 0
+                        print("kept {}/{} examples".format(len(examples), n))
+                    report_progress()
                     break
                 else:
                     # b. if correct: yield it, watch the new target, goto 1
@@ -346,8 +630,14 @@ def improve(
                             print("Whoops! Looks like we already found something better.")
                             print(" --> {}".format(pprint(old_better)))
                             continue
+                        # report before yielding, since the caller might not
+                        # resume this generator
+                        report_progress(new_target)
                         if target in to_evict:
                             print("Yep, it's an improvement!")
+                            improvements += 1
+                            last_improvement = time.time()
+                            tracing.instant("improvement", size=new_target.size(), target=lazy(pprint, new_target))
                             yield new_target
                             if heuristic_done(new_target):
                                 print("target now matches doneness heuristic")
@@ -360,9 +650,6 @@ def improve(
                     print("Now watching {} targets".format(len(watched_targets)))
                     learner.watch(watched_targets)
                     break
-
-                if incremental.value:
-                    solver.pop()
     except NoMoreImprovements:
         return
     except KeyboardInterrupt:
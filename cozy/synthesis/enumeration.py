@@ -4,18 +4,48 @@ import itertools
 
 from cozy.common import pick_to_sum, OrderedSet, unique, make_random_access, StopException
 from cozy.target_syntax import *
-from cozy.syntax_tools import pprint, fresh_var, free_vars, freshen_binders, alpha_equivalent, all_types
+from cozy.syntax_tools import pprint, fresh_var, free_vars, freshen_binders, alpha_equivalent, alpha_key, all_types, hash_cons, subst
 from cozy.evaluation import eval_bulk, construct_value
 from cozy.typecheck import is_numeric, is_scalar, is_collection
 from cozy.cost_model import CostModel, Order
 from cozy.pools import Pool, ALL_POOLS, RUNTIME_POOL, STATE_POOL, pool_name
 from cozy.contexts import Context, RootCtx, UnderBinder
-from cozy.logging import task, task_begin, task_end, event, verbose
+from cozy.logging import task, task_begin, task_end, event, verbose, lazy
 from cozy.synthesis.acceleration import histogram
+from cozy.opts import Option
+from cozy import tracing
+
+intern_exps = Option("intern-exps", bool, False, description="Share one object between structurally identical enumerated expressions. Saves memory and speeds up equality checks.")
 
 def fingerprint(e : Exp, examples : [{str:object}]):
     return (e.type,) + tuple(eval_bulk(e, examples))
 
+def project_fingerprint(fp, spans : [int], keep : [int]):
+    """
+    Restrict the fingerprint `fp` to the examples at the indices in `keep`.
+    The values for example i are fp[spans[i]+1 : spans[i+1]+1]; under a
+    binder, one example yields a value for each element of the bag.
+    """
+    return (fp[0],) + tuple(x for i in keep for x in fp[spans[i]+1 : spans[i+1]+1])
+
+def essential_examples(classes : [([int], [tuple])], n : int) -> [int]:
+    """
+    Given (spans, fingerprints) pairs, where each list of fingerprints over
+    `n` examples is pairwise distinct, find examples that can be dropped
+    without making any two fingerprints in a list equal. Returns the indices
+    of the examples to keep.
+
+    Examples are considered oldest first, so that newer ones (which were
+    usually found to refute more refined candidates) survive.
+    """
+    classes = [(spans, fps) for (spans, fps) in classes if len(fps) > 1]
+    keep = list(range(n))
+    for i in range(n):
+        trial = [j for j in keep if j != i]
+        if all(len(set(project_fingerprint(fp, spans, trial) for fp in fps)) == len(fps) for (spans, fps) in classes):
+            keep = trial
+    return keep
+
 EnumeratedExp = namedtuple("EnumeratedExp", [
     "e",                # The expression
     "fingerprint",      # Its fingerprint
@@ -51,21 +81,24 @@ def _interesting(e, context, pool):
 def _consider(e, context, pool):
     if _interesting(e, context, pool) and not verbose.value:
         print("considering {} in {}".format(pprint(e), context))
-    task_begin("considering expression", expression=pprint(e), context=context, pool=pool_name(pool), interesting=_interesting(e, context, pool))
+    task_begin("considering expression", expression=lazy(pprint, e), context=context, pool=lazy(pool_name, pool), interesting=_interesting(e, context, pool))
 def _accept(e, context, pool):
     if _interesting(e, context, pool) and not verbose.value:
         print("accepting")
     event("accepting")
+    tracing.instant("accept", expression=lazy(pprint, e), context=context, pool=lazy(pool_name, pool))
     task_end()
-def _skip(e, context, pool, reason):
+def _skip(e, context, pool, reason, *args):
+    # `reason` is a format string, filled in with `args` only when printed
     if _interesting(e, context, pool) and not verbose.value:
-        print("skipping [{}]".format(reason))
-    event("skipping [{}]".format(reason))
+        print("skipping [{}]".format(reason.format(*args)))
+    event("skipping [{}]", lazy(reason.format, *args))
     task_end()
 def _evict(e, context, pool, better_exp):
     if _interesting(e, context, pool) and not verbose.value:
         print("evicting {}".format(pprint(e)))
-    event("evicting {}".format(pprint(e)))
+    event("evicting {}", lazy(pprint, e))
+    tracing.instant("evict", expression=lazy(pprint, e), better=lazy(pprint, better_exp), context=context, pool=lazy(pool_name, pool))
 
 def more_specific(ctx1, ctx2):
     a = ctx1
@@ -98,7 +131,11 @@ class Enumerator(object):
         self.examples = list(examples)
         self.cost_model = cost_model
         self.cache = { } # keys -> [exp]
-        self.seen = { }  # (ctx, pool, fp) -> frontier, i.e. [exp]
+        self.seen = { }  # (ctx, pool, fp) -> frontier, i.e. [(size, exp)]
+        self.seen_keys = { } # (ctx, pool, fp) -> {alpha_key(exp) for exp in frontier}
+        self.displaced = { } # keys -> [exp] rejected or evicted for an equivalent exp
+        self.contexts = OrderedDict() # context_key(ctx) -> first ctx with that key in self.seen
+        self._context_keys = { } # ctx -> context_key(ctx)
         self.in_progress = set()
         if check_wf is None:
             check_wf = lambda e, ctx, pool: True
@@ -114,6 +151,137 @@ class Enumerator(object):
     def cache_size(self):
         return sum(len(v) for v in self.cache.values())
 
+    def _displace(self, k, info):
+        l = self.displaced.get(k)
+        if l is None:
+            l = []
+            self.displaced[k] = l
+        l.append(info)
+
+    def _add_seen(self, context, pool, size, info):
+        seen_key = (context, pool, info.fingerprint)
+        l = self.seen.get(seen_key)
+        if l is None:
+            l = []
+            self.seen[seen_key] = l
+            self.seen_keys[seen_key] = set()
+            self.contexts.setdefault(self.context_key(context), context)
+        l.append((size, info))
+        self.seen_keys[seen_key].add(alpha_key(info.e))
+
+    def _reindex(self):
+        self.seen = { }
+        self.seen_keys = { }
+        self.contexts = OrderedDict()
+        self._context_keys = { }
+        for (pool, size, context), infos in self.cache.items():
+            for info in infos:
+                self._add_seen(context, pool, size, info)
+
+    def add_examples(self, new_examples):
+        """
+        Extend the examples used for fingerprinting without discarding the
+        cache.
+
+        Every cached expression is evaluated on the new examples only, which
+        splits its equivalence class if the new examples distinguish it from
+        the others. Expressions that were rejected or evicted in favor of an
+        equivalent expression are re-checked too: if one of them is now
+        distinguishable from everything in the cache, the cache is truncated
+        just below its size so that it (and everything built from it) gets
+        enumerated again.
+
+        Enumerations left incomplete by an abandoned generator are discarded.
+        """
+        new_examples = list(new_examples)
+
+        for k in self.in_progress:
+            del self.cache[k]
+            self.displaced.pop(k, None)
+        self.in_progress.clear()
+
+        instantiated = { }
+        def refingerprint(k, infos):
+            (pool, size, context) = k
+            examples = instantiated.get(context)
+            if examples is None:
+                examples = context.instantiate_examples(new_examples)
+                instantiated[context] = examples
+            return [info._replace(fingerprint=info.fingerprint + tuple(eval_bulk(info.e, examples))) for info in infos]
+
+        with task("re-fingerprinting cache", examples=len(new_examples)):
+            for k, infos in self.cache.items():
+                self.cache[k] = refingerprint(k, infos)
+            for k, infos in self.displaced.items():
+                self.displaced[k] = refingerprint(k, infos)
+            self.examples.extend(new_examples)
+            self._reindex()
+
+        with task("checking displaced expressions"):
+            max_size = max((size for (pool, size, context) in self.cache.keys()), default=0)
+            cutoff = None
+            for (pool, size, context), infos in self.displaced.items():
+                if cutoff is not None and size >= cutoff:
+                    continue
+                if any(not self.equivalent_exps(context, max_size, pool, info.fingerprint) for info in infos):
+                    cutoff = size
+
+        if cutoff is not None:
+            event("re-enumerating from size {}", cutoff)
+            self.cache = { k : v for (k, v) in self.cache.items() if k[1] < cutoff }
+            self.displaced = { k : v for (k, v) in self.displaced.items() if k[1] < cutoff }
+            self._reindex()
+
+    def example_spans(self, context : Context) -> [int]:
+        """
+        Offsets of each example's values in fingerprints computed in
+        `context` (see `project_fingerprint`).
+        """
+        spans = [0]
+        for ex in self.examples:
+            spans.append(spans[-1] + len(context.instantiate_examples([ex])))
+        return spans
+
+    def fingerprint_classes(self):
+        """
+        The distinct fingerprints that the cache keeps apart, grouped by
+        context, pool, and type, as (spans, fingerprints) pairs.
+        """
+        groups = OrderedDict()
+        for (context, pool, fp) in self.seen.keys():
+            groups.setdefault((context, pool, fp[0]), []).append(fp)
+        spans = { }
+        for (context, pool, t) in groups.keys():
+            if context not in spans:
+                spans[context] = self.example_spans(context)
+        return [(spans[context], fps) for ((context, pool, t), fps) in groups.items()]
+
+    def remove_examples(self, keep : [int]):
+        """
+        Restrict the examples used for fingerprinting to those at the indices
+        in `keep`, projecting the fingerprints of everything cached onto them.
+        Callers should only drop examples that no two fingerprint classes
+        depend on (see `essential_examples`); otherwise distinct cached
+        expressions become equivalent.
+        """
+        for k in self.in_progress:
+            del self.cache[k]
+            self.displaced.pop(k, None)
+        self.in_progress.clear()
+
+        spans = { }
+        def project(k, infos):
+            (pool, size, context) = k
+            if context not in spans:
+                spans[context] = self.example_spans(context)
+            return [info._replace(fingerprint=project_fingerprint(info.fingerprint, spans[context], keep)) for info in infos]
+
+        with task("projecting cache", examples=len(keep)):
+            self.cache = { k : project(k, v) for (k, v) in self.cache.items() }
+            self.displaced = { k : project(k, v) for (k, v) in self.displaced.items() }
+            self.examples = [self.examples[i] for i in keep]
+            self._reindex()
+
     def heuristic_enumeration(self, context : Context, size : int, pool : Pool) -> [Exp]:
         # lambda-instantiation
         for sz1, sz2 in pick_to_sum(2, size-1):
@@ -199,7 +367,7 @@ class Enumerator(object):
                 for t in all_types(v):
                     yield construct_value(t)
             for (e, ctx, p) in self.hints:
-                if p == pool and ctx.alpha_equivalent(context):
+                if p == pool and ctx.alpha_key() == context.alpha_key():
                     yield context.adapt(e, ctx)
                 for t in all_types(e):
                     yield construct_value(t)
@@ -350,22 +518,87 @@ class Enumerator(object):
         for info in self.enumerate_with_info(context, size, pool):
             yield info.e
 
+    def equivalent_exps(self, context : Context, size : int, pool : Pool, fp) -> [Exp]:
+        """
+        Returns all cached expressions of at most the given size that have the
+        given fingerprint and are legal in the given context or its parents,
+        in the same order that `enumerate_with_info` would produce them.
+
+        This is a lookup in the fingerprint index `self.seen`, so it does not
+        depend on the total size of the cache.
+        """
+        res = []
+        ctx = context
+        while ctx is not None:
+            canonical_ctx = self.canonical_context(ctx)
+            for (s, info) in self.seen.get((canonical_ctx, pool, fp), ()):
+                if s <= size:
+                    e = info.e if canonical_ctx is ctx else self.adapt(info.e, ctx, canonical_ctx)
+                    res.append((s, ctx.complexity(), e))
+            ctx = ctx.parent()
+        res.sort(key=lambda x: x[:2])
+        return [e for (s, c, e) in res]
+
+    def is_duplicate(self, e : Exp, fvs : {EVar}, context : Context, pool : Pool, fp) -> bool:
+        """
+        Determine whether an expression alpha-equivalent to `e` (whose free
+        variables are `fvs`) is cached with the given fingerprint in the given
+        context or its parents. Like `equivalent_exps`, this only looks at
+        the fingerprint index, and each context costs one set lookup.
+        """
+        e_key = alpha_key(e)
+        ctx = context
+        while ctx is not None:
+            if ctx.legal_for(fvs):
+                canonical_ctx = self.canonical_context(ctx)
+                k = e_key if canonical_ctx is ctx else alpha_key(self.adapt(e, canonical_ctx, ctx))
+                if k in self.seen_keys.get((canonical_ctx, pool, fp), ()):
+                    return True
+            ctx = ctx.parent()
+        return False
+
     def known_contexts(self):
-        return unique(ctx for (ctx, pool, fp) in self.seen.keys())
+        return self.contexts.values()
+
+    def context_key(self, context):
+        """
+        A key that is equal for contexts that bind variables of the same types
+        to the same values on every example. Such contexts share one
+        enumeration cache.
+        """
+        k = self._context_keys.get(context)
+        if k is None:
+            parent = context.parent()
+            if parent is None:
+                k = context.alpha_key()
+            else:
+                k = (self.context_key(parent), context.var.type, context.pool,
+                    tuple(eval_bulk(context.bag, parent.instantiate_examples(self.examples))))
+            self._context_keys[context] = k
+        return k
 
     def canonical_context(self, context):
-        # TODO: deduplicate based on examples, not alpha equivalence
-        for ctx in self.known_contexts():
-            if ctx != context and ctx.alpha_equivalent(context):
-                return ctx
-        return context
+        return self.contexts.get(self.context_key(context), context)
+
+    def adapt(self, e : Exp, context : Context, canonical_context : Context) -> Exp:
+        """
+        Rewrite an expression enumerated in `canonical_context` for use in
+        `context`, which must have the same context_key.
+        """
+        m = { }
+        while context is not canonical_context and canonical_context.parent() is not None:
+            if context.var != canonical_context.var:
+                m[canonical_context.var.id] = context.var
+            context = context.parent()
+            canonical_context = canonical_context.parent()
+        return subst(e, m) if m else e
 
     def enumerate_with_info(self, context : Context, size : int, pool : Pool) -> [EnumeratedExp]:
         canonical_context = self.canonical_context(context)
         if canonical_context is not context:
             print("adapting request: {} ---> {}".format(context, canonical_context))
             for info in self.enumerate_with_info(canonical_context, size, pool):
-                yield info._replace(e=context.adapt(info.e, canonical_context))
+                yield info._replace(e=self.adapt(info.e, context, canonical_context))
             return
 
         if context.parent() is not None:
@@ -400,23 +633,22 @@ class Enumerator(object):
                     continue
 
                 e = freshen_binders(e, context)
+                if intern_exps.value:
+                    e = hash_cons(e)
                 _consider(e, context, pool)
 
                 wf = self.check_wf(e, context, pool)
                 if not wf:
-                    _skip(e, context, pool, "wf={}".format(wf))
+                    _skip(e, context, pool, "wf={}", wf)
                     continue
 
                 fp = fingerprint(e, examples)
 
                 # collect all expressions from parent contexts
                 with task("collecting prev exps", size=size, context=context, pool=pool_name(pool)):
-                    prev = []
-                    for sz in range(0, size+1):
-                        prev.extend(self.enumerate_with_info(context, sz, pool))
-                    prev = [ p.e for p in prev if p.fingerprint == fp ]
+                    prev = self.equivalent_exps(context, size, pool, fp)
 
-                if any(alpha_equivalent(e, p) for p in prev):
+                if self.is_duplicate(e, fvs, context, pool, fp):
                     _skip(e, context, pool, "duplicate")
                     should_keep = False
                 else:
@@ -428,12 +660,13 @@ class Enumerator(object):
                     # print("seen={}".format(self.seen))
                     with task("comparing to cached equivalents"):
                         for prev_exp in prev:
-                            event("previous: {}".format(pprint(prev_exp)))
+                            event("previous: {}", lazy(pprint, prev_exp))
                             # prev_cost = self.cost_model.cost(prev_exp, pool)
                             # ordering = cost.compare_to(prev_cost)
                             to_keep = eviction_policy(e, context, prev_exp, context, pool, cost_model)
                             if e not in to_keep:
-                                _skip(e, context, pool, "preferring {}".format(pprint(prev_exp)))
+                                _skip(e, context, pool, "preferring {}", lazy(pprint, prev_exp))
+                                self._displace(k, EnumeratedExp(e=e, fingerprint=fp, cost=None))
                                 should_keep = False
                                 break
 
@@ -457,31 +690,27 @@ class Enumerator(object):
 
                     with task("evicting"):
                         to_evict = []
-                        for (key, exps) in self.cache.items():
-                            (p, s, c) = key
-                            if p == pool and c in itertools.chain([context], parent_contexts(context)):
-                                for ee in exps:
-                                    if ee.fingerprint == fp: # and cost_model.compare(e, ee.e, context, pool) == Order.LT:
-                                        # to_evict.append((key, ee))
-                                        to_keep = eviction_policy(e, context, ee.e, c, pool, cost_model)
-                                        if ee.e not in to_keep:
-                                            to_evict.append((key, ee))
-                        for key, ee in to_evict:
-                            (p, s, c) = key
+                        for c in itertools.chain([context], parent_contexts(context)):
+                            if c is None:
+                                break
+                            for (s, ee) in self.seen.get((c, pool, fp), ()):
+                                to_keep = eviction_policy(e, context, ee.e, c, pool, cost_model)
+                                if ee.e not in to_keep:
+                                    to_evict.append((c, s, ee))
+                        for c, s, ee in to_evict:
                             # self.blacklist.add((ee.e, c, pool))
                             _evict(ee.e, c, pool, e)
-                            self.cache[key].remove(ee)
-                            self.seen[(c, p, fp)].remove(ee.e)
+                            self.cache[(pool, s, c)].remove(ee)
+                            self.seen[(c, pool, fp)].remove((s, ee))
+                            self.seen_keys[(c, pool, fp)].discard(alpha_key(ee.e))
+                            self._displace((pool, s, c), ee)
 
                     _accept(e, context, pool)
-                    seen_key = (context, pool, fp)
-                    if seen_key not in self.seen:
-                        self.seen[seen_key] = []
-                    self.seen[seen_key].append(e)
                     info = EnumeratedExp(
                         e=e,
                         fingerprint=fp,
                         cost=None)
+                    self._add_seen(context, pool, size, info)
                     res.append(info)
                     yield info
 
@@ -10,7 +10,7 @@ from cozy.target_syntax import *
 import cozy.syntax_tools
 from cozy.syntax_tools import all_types, alpha_equivalent, BottomUpExplorer, BottomUpRewriter, free_vars, pprint, subst, implies, fresh_var, mk_lambda, all_exps, equal, is_scalar, tease_apart, shallow_copy, wrap_naked_statevars
 from cozy.timeouts import Timeout, TimeoutException
-from cozy import jobs
+from cozy import jobs, tracing
 from cozy.contexts import RootCtx
 from cozy.solver import valid
 from cozy.opts import Option
@@ -21,6 +21,7 @@ from .impls import Implementation
 
 nice_children = Option("nice-children", bool, False)
 log_dir = Option("log-dir", str, "/tmp")
+progress_interval = Option("progress-interval", int, 60, metavar="N", description="Minimum seconds between progress reports for changes to the synthesis state (examples and watched targets) alone")
 SynthCtx = namedtuple("SynthCtx", ["all_types", "basic_types"])
 LINE_BUFFER_MODE = 1 # see help for open() function
 
@@ -33,7 +34,11 @@ class ImproveQueryJob(jobs.Job):
             q : Query,
             k,
             hints : [Exp] = [],
-            funcs : { str:TFunc } = { }):
+            funcs : { str:TFunc } = { },
+            examples : [dict] = (),
+            frontier : [Exp] = (),
+            progress_k = None,
+            metrics_k = None):
         assert all(v in state for v in free_vars(q)), "Oops, query looks malformed due to {}:\n{}\nfree_vars({})".format([v for v in free_vars(q) if v not in state], pprint(q), repr(q))
         super().__init__()
         self.ctx = ctx
@@ -45,6 +50,10 @@ class ImproveQueryJob(jobs.Job):
         self.hints = hints
         self.k = k
         self.funcs = OrderedDict(funcs)
+        self.examples = list(examples)
+        self.frontier = list(frontier)
+        self.progress_k = progress_k
+        self.metrics_k = metrics_k
     def __str__(self):
         return "ImproveQueryJob[{}]".format(self.q.name)
     def run(self):
@@ -74,8 +83,12 @@ class ImproveQueryJob(jobs.Job):
                         assumptions=EAll(self.assumptions),
                         context=ctx,
                         hints=self.hints,
-                        stop_callback=lambda: self.stop_requested,
-                        cost_model=cost_model)):
+                        stop_callback=self.poll_stop,
+                        cost_model=cost_model,
+                        examples=self.examples,
+                        frontier=self.frontier,
+                        progress_callback=self.progress_k,
+                        metrics_callback=self.metrics_k)):
 
                     new_rep, new_ret = tease_apart(expr)
                     self.k(new_rep, new_ret)
@@ -88,7 +101,16 @@ class ImproveQueryJob(jobs.Job):
 def improve_implementation(
         impl              : Implementation,
         timeout           : datetime.timedelta = datetime.timedelta(seconds=60),
-        progress_callback = None) -> Implementation:
+        progress_callback = None,
+        metrics_callback  = None) -> Implementation:
+    """
+    Improve the queries of `impl` until `timeout` expires or synthesis ends.
+
+    `progress_callback((impl, code, concretization_functions))` is called
+    whenever the implementation improves. `metrics_callback(metrics)` is
+    called with the latest counters of each running query (see core.improve),
+    keyed by query name, whenever some job reports new ones.
+    """
 
     start_time = datetime.datetime.now()
 
@@ -99,7 +121,8 @@ def improve_implementation(
         list(impl.query_specs),
         OrderedDict(impl.query_impls),
         defaultdict(SNoOp, impl.updates),
-        defaultdict(SNoOp, impl.handle_updates))
+        defaultdict(SNoOp, impl.handle_updates),
+        OrderedDict(getattr(impl, "query_progress", ())))
 
     # gather root types
     types = list(all_types(impl.spec))
@@ -112,9 +135,9 @@ def improve_implementation(
     ctx = SynthCtx(all_types=types, basic_types=basic_types)
 
     # the actual worker threads
-    improvement_jobs = []
+    improvement_jobs = jobs.JobPool(restart=lambda j: restart_job(j))
 
-    with jobs.SafeQueue() as solutions_q:
+    with jobs.SafeQueue() as solutions_q, jobs.SafeQueue() as progress_q, jobs.SafeQueue() as metrics_q:
 
         def stop_jobs(js):
             js = list(js)
@@ -122,20 +145,37 @@ def improve_implementation(
             for j in js:
                 improvement_jobs.remove(j)
 
+        def make_job(q):
+            examples, frontier = [], []
+            progress = impl.query_progress.get(q.name)
+            if progress is not None and progress[0] == q:
+                _, examples, frontier = progress
+                print("resuming {} with {} examples and {} watched targets".format(q.name, len(examples), len(frontier)))
+            return ImproveQueryJob(
+                ctx,
+                impl.abstract_state,
+                list(impl.spec.assumptions) + list(q.assumptions),
+                q,
+                k=(lambda q: lambda new_rep, new_ret: solutions_q.put((q, new_rep, new_ret)))(q),
+                hints=[EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()],
+                funcs=impl.extern_funcs,
+                examples=examples,
+                frontier=frontier,
+                progress_k=(lambda q: lambda examples, frontier: progress_q.put((q, examples, frontier)))(q),
+                metrics_k=(lambda q: lambda metrics: metrics_q.put((q.name, metrics)))(q))
+
+        def restart_job(j):
+            # pick up the progress the stopped job reported
+            nonlocal progress_changed
+            if record_progress():
+                progress_changed = True
+            q = find_one(q for q in impl.query_specs if q.name == j.q.name)
+            return None if q is None else make_job(q)
+
         def reconcile_jobs():
             # figure out what new jobs we need
             job_query_names  = set(j.q.name for j in improvement_jobs)
-            new = []
-            for q in impl.query_specs:
-                if q.name not in job_query_names:
-                    new.append(ImproveQueryJob(
-                        ctx,
-                        impl.abstract_state,
-                        list(impl.spec.assumptions) + list(q.assumptions),
-                        q,
-                        k=(lambda q: lambda new_rep, new_ret: solutions_q.put((q, new_rep, new_ret)))(q),
-                        hints=[EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()],
-                        funcs=impl.extern_funcs))
+            new = [make_job(q) for q in impl.query_specs if q.name not in job_query_names]
 
             # figure out what old jobs we can stop
             impl_query_names = set(q.name for q in impl.query_specs)
@@ -144,8 +184,29 @@ def improve_implementation(
             # make it so
             stop_jobs(old)
             for j in new:
-                j.start()
-            improvement_jobs.extend(new)
+                improvement_jobs.add(j)
+            improvement_jobs.update()
+
+        def record_progress():
+            changed = False
+            for (q, examples, frontier) in progress_q.drain():
+                if q.name in [qq.name for qq in impl.query_specs]:
+                    impl.query_progress[q.name] = (q, examples, frontier)
+                    changed = True
+            return changed
+
+        query_metrics = OrderedDict()
+        def record_metrics():
+            changed = False
+            for (name, metrics) in metrics_q.drain():
+                query_metrics[name] = metrics
+                changed = True
+            live = set(q.name for q in impl.query_specs)
+            for name in [name for name in query_metrics if name not in live]:
+                del query_metrics[name]
+                changed = True
+            if changed and metrics_callback is not None:
+                metrics_callback(OrderedDict(query_metrics))
 
         # start jobs
         reconcile_jobs()
@@ -153,7 +214,19 @@ def improve_implementation(
         # wait for results
         timeout = Timeout(timeout)
         done = False
+        last_progress_report = datetime.datetime.now()
+        progress_changed = False
         while not done and not timeout.is_timed_out():
+            # record the latest examples and watched targets of each job
+            if record_progress():
+                progress_changed = True
+            record_metrics()
+            if progress_changed and progress_callback is not None and datetime.datetime.now() - last_progress_report >= datetime.timedelta(seconds=progress_interval.value):
+                progress_callback((impl, impl.code, impl.concretization_functions))
+                last_progress_report = datetime.datetime.now()
+                progress_changed = False
+
+            improvement_jobs.update()
             for j in improvement_jobs:
                 if j.done:
                     if j.successful:
@@ -162,7 +235,7 @@ def improve_implementation(
                         print("failed job: {}".format(j), file=sys.stderr)
                         # raise Exception("failed job: {}".format(j))
 
-            done = all(j.done for j in improvement_jobs)
+            done = improvement_jobs.done
 
             try:
                 # list of (Query, new_rep, new_ret) objects
@@ -179,6 +252,9 @@ def improve_implementation(
                 if q.name in improved_queries_by_name:
                     killed += 1
                 improved_queries_by_name[q.name] = r
+                j = find_one(j for j in improvement_jobs if j.q.name == q.name)
+                if j is not None:
+                    improvement_jobs.credit(j)
             if killed:
                 print(" --> dropped {} worse solutions".format(killed))
 
@@ -208,6 +284,7 @@ def improve_implementation(
                 if q.name in [qq.name for qq in impl.query_specs]:
                     elapsed = datetime.datetime.now() - start_time
                     print("SOLUTION FOR {} AT {} [size={}]".format(q.name, elapsed, new_ret.size() + sum(proj.size() for (v, proj) in new_rep)))
+                    tracing.instant("solution", query=q.name, size=new_ret.size() + sum(proj.size() for (v, proj) in new_rep))
                     print("-" * 40)
                     for (sv, proj) in new_rep:
                         print("  {} : {} = {}".format(sv.id, pprint(sv.type), pprint(proj)))
@@ -219,6 +296,8 @@ def improve_implementation(
                     impl.cleanup()
                     if progress_callback is not None:
                         progress_callback((impl, impl.code, impl.concretization_functions))
+                        last_progress_report = datetime.datetime.now()
+                        progress_changed = False
                     reconcile_jobs()
                 else:
                     print("  (skipped)")
@@ -226,4 +305,8 @@ def improve_implementation(
         # stop jobs
         print("Stopping jobs")
         stop_jobs(list(improvement_jobs))
+        record_progress()
+        trace = tracing.merge()
+        if trace is not None:
+            print("Trace: {}".format(trace))
         return impl
@@ -82,13 +82,15 @@ class Implementation(object):
             query_specs : [Query],
             query_impls : OrderedDict,
             updates : defaultdict,
-            handle_updates : defaultdict):
+            handle_updates : defaultdict,
+            query_progress : OrderedDict = None):
         self.spec = spec
         self.concrete_state = concrete_state
         self.query_specs = query_specs
         self.query_impls = query_impls
         self.updates = updates # maps (concrete_var_name, op_name) to stm
         self.handle_updates = handle_updates # maps (handle_type, op_name) to stm
+        self.query_progress = query_progress if query_progress is not None else OrderedDict() # maps query_name to (query_spec, examples, frontier)
         self.state_solver = ModelCachingSolver(vars=self.abstract_state, funcs=self.extern_funcs)
 
     def __getstate__(self):
@@ -385,6 +387,11 @@ class Implementation(object):
             if qname not in queries_to_keep:
                 del self.query_impls[qname]
 
+        # remove old synthesis progress
+        for qname in list(self.query_progress.keys()):
+            if qname not in queries_to_keep:
+                del self.query_progress[qname]
+
         # remove old state vars
         self.concrete_state = [ v for v in self.concrete_state if any(v[0] in free_vars(q) for q in self.query_impls.values()) ]
 
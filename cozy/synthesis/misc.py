@@ -3,7 +3,7 @@ import itertools
 from cozy.common import FrozenDict, partition
 from cozy.syntax import Exp, Query, TFunc, EVar, EAll, EImplies, EEq, ELambda, Stm, SNoOp, SDecl, SAssign, SSeq, SIf, SForEach, SCall
 from cozy.target_syntax import TMap, EMakeMap2, EMapGet, SMapPut, SMapDel, SMapUpdate
-from cozy.syntax_tools import fresh_var, free_vars, subst
+from cozy.syntax_tools import fresh_var, free_vars, subst, alpha_key
 from cozy.solver import ModelCachingSolver
 from cozy.logging import task
 
@@ -28,6 +28,8 @@ def queries_equivalent(q1 : Query, q2 : Query, state_vars : [EVar], extern_funcs
 
         q1a = EAll(q1.assumptions)
         q2a = EAll(q2.assumptions)
+        if alpha_key(q1a) == alpha_key(q2a) and alpha_key(q1.ret) == alpha_key(q2.ret):
+            return True
         return checker.valid(EEq(q1a, q2a)) and checker.valid(EImplies(q1a, EEq(q1.ret, q2.ret)))
 
 def pull_temps(s : Stm, decls_out : [SDecl], exp_is_bad) -> Stm:
@@ -0,0 +1,145 @@
+"""Structured traces of where synthesis spends its time.
+
+With --trace-dir DIR, every process appends the spans of its tasks (see
+cozy.logging) and a few notable events to its own file in DIR, one Chrome
+trace event per line. `merge` combines the files of the current run into
+DIR/trace.json, which chrome://tracing and Perfetto can open.
+
+Important functions:
+ - start: name the current process (e.g. after the query a job improves)
+ - instant: record a point event
+ - span: record a finished span
+ - merge: combine the per-process files into one trace
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+
+from cozy.opts import Option
+
+trace_dir = Option("trace-dir", str, "", metavar="DIR", description="Record a Chrome trace of synthesis in DIR/trace.json")
+trace_min_duration = Option("trace-min-duration", int, 1000, metavar="US", description="Leave spans shorter than this many microseconds out of traces")
+
+FLUSH_THRESHOLD = 512 # events
+
+# Processes forked from this one inherit the run id, so that `merge` can tell
+# the files of this run from those of earlier runs.
+_run = str(os.getpid())
+_label = "main"
+_pid = None
+_dir = None
+_file = None
+_buffer = []
+
+def enabled():
+    return bool(trace_dir.value)
+
+def now():
+    """Timestamp for `span`; comparable across processes."""
+    return time.monotonic()
+
+def _us(t):
+    return int(t * 1000000)
+
+def _ensure_open():
+    global _pid, _dir, _file, _buffer
+    pid = os.getpid()
+    if _pid == pid and _dir == trace_dir.value:
+        return
+    if _pid == pid:
+        flush()
+        _file.close()
+    # The file and buffered events of a parent process are not ours.
+    _pid = pid
+    _dir = trace_dir.value
+    _buffer = []
+    os.makedirs(trace_dir.value, exist_ok=True)
+    filename = os.path.join(trace_dir.value, "{}-{}-{}.jsonl".format(_run, _label, pid))
+    _file = open(filename, "a")
+    _buffer.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": _label}})
+
+def _emit(event):
+    _ensure_open()
+    event["pid"] = _pid
+    event["tid"] = threading.get_ident()
+    _buffer.append(event)
+    if len(_buffer) >= FLUSH_THRESHOLD:
+        flush()
+
+def _args(kwargs):
+    return { k : str(v) for (k, v) in kwargs.items() }
+
+def start(label):
+    """
+    Start a new trace file for the current process, labeled `label`.
+    """
+    global _label
+    if not enabled():
+        return
+    close()
+    _label = label
+    _ensure_open()
+
+def flush():
+    if _file is None or _pid != os.getpid():
+        return
+    for event in _buffer:
+        _file.write(json.dumps(event))
+        _file.write("\n")
+    _buffer.clear()
+    _file.flush()
+
+def close():
+    """
+    Flush and close this process's trace file. Tracing again reopens it.
+    """
+    global _pid, _file
+    flush()
+    if _file is not None and _pid == os.getpid():
+        _file.close()
+    _pid = None
+    _file = None
+
+def span(name, start, end, **kwargs):
+    """
+    Record a span from `start` to `end` (as returned by `now`). Arguments are
+    only formatted if the span is long enough to be kept.
+    """
+    if not enabled():
+        return
+    duration = _us(end - start)
+    if duration < trace_min_duration.value:
+        return
+    _emit({"name": name, "cat": "task", "ph": "X", "ts": _us(start), "dur": duration, "args": _args(kwargs)})
+
+def instant(name, **kwargs):
+    if not enabled():
+        return
+    _emit({"name": name, "cat": "event", "ph": "i", "s": "t", "ts": _us(now()), "args": _args(kwargs)})
+
+def merge() -> str:
+    """
+    Combine the trace files of this run into one Chrome trace. Returns the
+    path of the merged trace, or None if tracing is off.
+    """
+    if not enabled():
+        return None
+    flush()
+    events = []
+    for filename in sorted(glob.glob(os.path.join(trace_dir.value, "{}-*.jsonl".format(_run)))):
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # the last line of a killed job may be incomplete
+                        pass
+    out = os.path.join(trace_dir.value, "trace.json")
+    with open(out, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return out
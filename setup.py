@@ -24,4 +24,5 @@ setup(
     packages=find_packages(),
     entry_points = { "console_scripts": "cozy=cozy.main:run" },
     install_requires=reqs,
+    extras_require={ "numpy": ["numpy"] },
     )
@@ -0,0 +1,31 @@
+import unittest
+
+from cozy.bench import compare
+
+def results(rss=1000, rate=100.0, first=1.0, final=2.0, runtime=5, size=10):
+    return { "version": 1, "seed": 0, "results": [{
+        "spec": "examples/basic.ds",
+        "peak_rss_kb": rss,
+        "considered_per_second": rate,
+        "queries": { "q": {
+            "time_to_first_improvement": first,
+            "time_to_final": final,
+            "runtime": runtime,
+            "size": size } } }] }
+
+class TestBenchmarkComparison(unittest.TestCase):
+
+    def test_no_regressions(self):
+        self.assertEqual(compare(results(), results()), [])
+        self.assertEqual(compare(results(rss=1400, rate=60.0, first=1.4), results()), [])
+
+    def test_regressions(self):
+        self.assertEqual(len(compare(results(rss=2000), results())), 1)
+        self.assertEqual(len(compare(results(rate=10.0), results())), 1)
+        self.assertEqual(len(compare(results(first=None), results())), 1)
+        self.assertEqual(len(compare(results(runtime=6), results())), 1)
+        self.assertEqual(len(compare(results(runtime=6), results(), cost_tolerance=0.5)), 0)
+
+    def test_later_but_better(self):
+        self.assertEqual(compare(results(final=10.0), results()), ["examples/basic.ds q time to final: 10.00 (baseline: 2.00)"])
+        self.assertEqual(compare(results(final=10.0, size=8), results()), [])
@@ -0,0 +1,136 @@
+import unittest
+
+from cozy.target_syntax import *
+from cozy.syntax_tools import alpha_equivalent, alpha_key, free_vars
+from cozy.contexts import RootCtx, UnderBinder
+from cozy.cost_model import CostModel
+from cozy.evaluation import Bag
+from cozy.pools import RUNTIME_POOL, STATE_POOL
+from cozy.logging import lazy
+from cozy.synthesis import enumeration
+from cozy.synthesis.enumeration import Enumerator, essential_examples
+
+class TestEnumerator(unittest.TestCase):
+
+    def enumerator(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        ctx = RootCtx(state_vars=[xs], args=[y])
+        examples = [
+            {"xs": Bag((0, 1, 1)), "y": 1},
+            {"xs": Bag((2,)), "y": 0}]
+        return ctx, Enumerator(examples=examples, cost_model=CostModel(), hints=())
+
+    def test_fingerprint_index_matches_cache(self):
+        ctx, enum = self.enumerator()
+        for size in range(2):
+            for pool in (STATE_POOL, RUNTIME_POOL):
+                list(enum.enumerate_with_info(context=ctx, size=size, pool=pool))
+        cached = set()
+        for (pool, size, c), infos in enum.cache.items():
+            for info in infos:
+                cached.add((c, pool, info.fingerprint, size, info.e))
+        indexed = set()
+        for (c, pool, fp), entries in enum.seen.items():
+            for (size, info) in entries:
+                self.assertEqual(info.fingerprint, fp)
+                indexed.add((c, pool, fp, size, info.e))
+            self.assertEqual(enum.seen_keys[(c, pool, fp)], { alpha_key(info.e) for (size, info) in entries })
+        self.assertEqual(cached, indexed)
+
+    def test_no_alpha_equivalent_duplicates(self):
+        ctx, enum = self.enumerator()
+        for size in range(2):
+            for pool in (STATE_POOL, RUNTIME_POOL):
+                list(enum.enumerate_with_info(context=ctx, size=size, pool=pool))
+        for entries in enum.seen.values():
+            exps = [info.e for (size, info) in entries]
+            for i in range(len(exps)):
+                for j in range(i + 1, len(exps)):
+                    assert not alpha_equivalent(exps[i], exps[j])
+
+    def test_is_duplicate(self):
+        ctx, enum = self.enumerator()
+        for size in range(2):
+            list(enum.enumerate_with_info(context=ctx, size=size, pool=RUNTIME_POOL))
+        infos = [info for size in range(2) for info in enum.cache[(RUNTIME_POOL, size, ctx)]]
+        for info in infos:
+            assert enum.is_duplicate(info.e, free_vars(info.e), ctx, RUNTIME_POOL, info.fingerprint)
+            assert not enum.is_duplicate(info.e, free_vars(info.e), ctx, RUNTIME_POOL, None)
+
+    def test_equivalent_exps(self):
+        ctx, enum = self.enumerator()
+        for size in range(2):
+            list(enum.enumerate_with_info(context=ctx, size=size, pool=RUNTIME_POOL))
+        infos = [info for size in range(2) for info in enum.cache[(RUNTIME_POOL, size, ctx)]]
+        for info in infos:
+            equivs = enum.equivalent_exps(ctx, 1, RUNTIME_POOL, info.fingerprint)
+            assert any(e is info.e for e in equivs)
+            for e in equivs:
+                assert any(e is i.e for i in infos if i.fingerprint == info.fingerprint)
+
+    def test_add_examples(self):
+        ctx, enum = self.enumerator()
+        for size in range(2):
+            list(enum.enumerate_with_info(context=ctx, size=size, pool=RUNTIME_POOL))
+        enum.add_examples([{"xs": Bag((3, 4)), "y": 4}])
+        self.assertEqual(len(enum.examples), 3)
+        for (pool, size, c), infos in enum.cache.items():
+            for info in infos:
+                self.assertEqual(len(info.fingerprint), 1 + len(c.instantiate_examples(enum.examples)))
+                self.assertIn((size, info), enum.seen[(c, pool, info.fingerprint)])
+        fresh = Enumerator(examples=enum.examples, cost_model=CostModel(), hints=())
+        for size in range(2):
+            a = {info.fingerprint for info in enum.enumerate_with_info(context=ctx, size=size, pool=RUNTIME_POOL)}
+            b = {info.fingerprint for info in fresh.enumerate_with_info(context=ctx, size=size, pool=RUNTIME_POOL)}
+            self.assertEqual(a, b)
+
+    def test_skip_reason_is_lazy(self):
+        ctx = RootCtx(state_vars=(), args=())
+        calls = []
+        enumeration._consider(ONE, ctx, RUNTIME_POOL)
+        enumeration._skip(ONE, ctx, RUNTIME_POOL, "preferring {}", lazy(calls.append, ZERO))
+        self.assertEqual(calls, [])
+
+    def test_contexts_with_equal_bags_share_cache(self):
+        ctx, enum = self.enumerator()
+        xs = EVar("xs").with_type(INT_BAG)
+        a = EVar("a").with_type(INT)
+        b = EVar("b").with_type(INT)
+        ctx1 = UnderBinder(ctx, a, EStateVar(xs).with_type(INT_BAG), RUNTIME_POOL)
+        ctx2 = UnderBinder(ctx, b, EFilter(EStateVar(xs).with_type(INT_BAG), ELambda(EVar("c").with_type(INT), T)).with_type(INT_BAG), RUNTIME_POOL)
+        self.assertEqual(enum.context_key(ctx1), enum.context_key(ctx2))
+        for size in range(2):
+            list(enum.enumerate_with_info(context=ctx1, size=size, pool=RUNTIME_POOL))
+        self.assertIs(enum.canonical_context(ctx2), ctx1)
+        exps = [info.e for size in range(2) for info in enum.enumerate_with_info(context=ctx2, size=size, pool=RUNTIME_POOL)]
+        assert any(e == b for e in exps)
+        assert not any(a in free_vars(e) for e in exps)
+        self.assertNotIn((RUNTIME_POOL, 1, ctx2), enum.cache)
+
+    def test_remove_examples(self):
+        ctx, enum = self.enumerator()
+        enum.add_examples([{"xs": Bag((0, 1, 1)), "y": 1}, {"xs": Bag((5,)), "y": 0}])
+        a = EVar("a").with_type(INT)
+        sub = UnderBinder(ctx, a, EStateVar(EVar("xs").with_type(INT_BAG)).with_type(INT_BAG), RUNTIME_POOL)
+        for size in range(2):
+            for c in (ctx, sub):
+                list(enum.enumerate_with_info(context=c, size=size, pool=RUNTIME_POOL))
+        classes = enum.fingerprint_classes()
+        keep = essential_examples(classes, len(enum.examples))
+        # the third example repeats the first
+        assert not (0 in keep and 2 in keep)
+        enum.remove_examples(keep)
+        self.assertEqual(len(enum.examples), len(keep))
+        self.assertEqual(
+            sorted(len(fps) for (spans, fps) in classes),
+            sorted(len(fps) for (spans, fps) in enum.fingerprint_classes()))
+        for (pool, size, c), infos in enum.cache.items():
+            for info in infos:
+                self.assertEqual(len(info.fingerprint), 1 + len(c.instantiate_examples(enum.examples)))
+                self.assertIn((size, info), enum.seen[(c, pool, info.fingerprint)])
+        fresh = Enumerator(examples=enum.examples, cost_model=CostModel(), hints=())
+        for size in range(2):
+            a = {info.fingerprint for info in enum.enumerate_with_info(context=sub, size=size, pool=RUNTIME_POOL)}
+            b = {info.fingerprint for info in fresh.enumerate_with_info(context=sub, size=size, pool=RUNTIME_POOL)}
+            self.assertEqual(a, b)
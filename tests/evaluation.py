@@ -2,9 +2,15 @@ import unittest
 
 from cozy.target_syntax import *
 from cozy.syntax_tools import *
-from cozy.evaluation import eval, Bag, Map, Handle, cmp, eq, EQ, LT, GT
+from cozy.common import FrozenDict
+from cozy.evaluation import eval, eval_bulk, Bag, Map, Handle, cmp, eq, EQ, LT, GT
 from cozy.typecheck import retypecheck
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 zero = ENum(0).with_type(INT)
 one  = ENum(1).with_type(INT)
 
@@ -49,3 +55,110 @@ class TestEvaluation(unittest.TestCase):
         e = EEq(EBinOp(EVar("s1").with_type(t), "-", EVar("s2").with_type(t)), EEmptyList().with_type(t))
         assert retypecheck(e)
         assert eval(e, {"s1": s1, "s2": s2}) is True
+
+    def test_eval_bulk(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        b = EVar("b").with_type(BOOL)
+        xs = EVar("xs").with_type(INT_BAG)
+        e = ECond(EAll([b, EBinOp(x, "<", y).with_type(BOOL)]),
+            EBinOp(ESum([EBinOp(x, "*", ENum(3).with_type(INT)).with_type(INT), y]), "-", ELen(xs)).with_type(INT),
+            ESum([x, EUnaryOp("-", y).with_type(INT), EUnaryOp(UOp.Sum, EFilter(xs, mk_lambda(INT, lambda v: EBinOp(v, ">", x).with_type(BOOL))).with_type(INT_BAG)).with_type(INT)])).with_type(INT)
+        assert retypecheck(e)
+        envs = [
+            {"x": i, "y": (i * 7) % 5 - 2 ** 40 * (i % 3), "b": i % 2 == 0, "xs": Bag(range(i % 4))}
+            for i in range(100)]
+        expected = [eval(e, env) for env in envs]
+        from cozy.evaluation import vectorize_threshold
+        old = vectorize_threshold.value
+        try:
+            for threshold in (0, 1000):
+                vectorize_threshold.value = threshold
+                res = eval_bulk(e, envs)
+                self.assertEqual(res, expected)
+                assert all(type(v) is int for v in res)
+        finally:
+            vectorize_threshold.value = old
+
+    @unittest.skipUnless(numpy, "requires NumPy")
+    def test_eval_bulk_numpy(self):
+        from cozy.evaluation import vectorize_threshold, _to_array, _SMALL
+        assert isinstance(_to_array([1, -1, _SMALL - 1, 1 - _SMALL]), numpy.ndarray)
+        assert _to_array([1, _SMALL]) is None
+        assert _to_array([1, -_SMALL]) is None
+        assert _to_array([1, 2 ** 70]) is None
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        b = EVar("b").with_type(BOOL)
+        exps = [
+            EBinOp(EBinOp(x, "*", ENum(_SMALL - 1).with_type(INT)).with_type(INT), "*", ENum(3).with_type(INT)).with_type(INT),
+            EBinOp(EBinOp(x, "+", y).with_type(INT), "-", EUnaryOp("-", x).with_type(INT)).with_type(INT),
+            EBinOp(x, "<", EUnaryOp("-", y).with_type(INT)).with_type(BOOL),
+            EUnaryOp(UOp.Not, EBinOp(b, "==", EBinOp(x, "==", y).with_type(BOOL)).with_type(BOOL)).with_type(BOOL)]
+        boundary = [0, 1, -1, _SMALL - 1, _SMALL, _SMALL + 1, 1 - _SMALL, -_SMALL, -_SMALL - 1, 2 ** 62, -(2 ** 63), 2 ** 64]
+        envs = [{"x": v, "y": w, "b": (v + w) % 2 == 0} for v in boundary for w in boundary]
+        small_envs = [{"x": v, "y": w, "b": v < w} for v in range(-20, 20) for w in (-(_SMALL - 1), -3, 0, 5, _SMALL - 1)]
+        old = vectorize_threshold.value
+        try:
+            for e in exps:
+                assert retypecheck(e)
+                for es in (envs, small_envs):
+                    vectorize_threshold.value = len(es) + 1
+                    expected = eval_bulk(e, es)
+                    vectorize_threshold.value = 0
+                    res = eval_bulk(e, es)
+                    self.assertEqual(res, expected)
+                    self.assertEqual(res, [eval(e, env) for env in es])
+                    assert all(type(v) is type(w) for (v, w) in zip(res, expected))
+        finally:
+            vectorize_threshold.value = old
+
+    def test_compile_cache(self):
+        from cozy.evaluation import compile_cache
+        xs = EVar("xs").with_type(INT_BAG)
+        e1 = EFilter(xs, mk_lambda(INT, lambda v: EBinOp(v, ">", ONE).with_type(BOOL))).with_type(INT_BAG)
+        e2 = EFilter(xs, mk_lambda(INT, lambda v: EBinOp(v, ">", ONE).with_type(BOOL))).with_type(INT_BAG)
+        assert e1.p.arg != e2.p.arg
+        compile_cache.clear()
+        env = {"xs": Bag((0, 1, 2, 3))}
+        self.assertEqual(eval(e1, env), Bag((2, 3)))
+        self.assertEqual((compile_cache.hits, compile_cache.misses), (0, 1))
+        self.assertEqual(eval(e2, env), Bag((2, 3)))
+        self.assertEqual((compile_cache.hits, compile_cache.misses), (1, 1))
+        self.assertEqual(eval(EBinOp(xs, "+", xs).with_type(INT_BAG), env), Bag((0, 1, 2, 3, 0, 1, 2, 3)))
+        self.assertEqual((compile_cache.hits, compile_cache.misses), (1, 2))
+
+    def test_map_keys(self):
+        t = THandle("H", INT)
+        m = Map(TMap(t, INT), 0)
+        m[Handle(0, 1)] = 1
+        m[Handle(1, 1)] = 2
+        m[Handle(0, 2)] = 3
+        self.assertEqual(list(m.items()), [(Handle(0, 1), 3), (Handle(1, 1), 2)])
+        self.assertEqual(m[Handle(0, 5)], 3)
+        self.assertEqual(m[Handle(2, 1)], 0)
+        m2 = Map(TMap(TBag(INT), INT), 0, [(Bag((1, 2)), 1), (Bag((2, 1)), 2)])
+        self.assertEqual(list(m2.items()), [(Bag((1, 2)), 2)])
+
+    def test_cmp(self):
+        e = TEnum(("b", "a"))
+        t = THandle("H", INT)
+        cases = [
+            (TBag(INT), Bag((2, 1)), Bag((1, 2)), EQ),
+            (TBag(INT), Bag((1, 1)), Bag((1, 2)), LT),
+            (TBag(INT), Bag((3,)), Bag((1, 2)), LT),
+            (TList(INT), (3,), (1, 2), LT),
+            (TList(INT), (2, 1), (1, 2), GT),
+            (TBag(e), Bag(("a",)), Bag(("b",)), GT),
+            (TSet(e), Bag(("a", "b")), Bag(("b", "a")), EQ),
+            (TBag(t), Bag((Handle(1, 0), Handle(0, 5))), Bag((Handle(0, 1), Handle(1, 0))), EQ),
+            (TTuple((INT, e)), (1, "a"), (1, "b"), GT),
+            (TRecord((("x", STRING), ("y", INT))), FrozenDict({"x": "s", "y": 1}), FrozenDict({"x": "s", "y": 2}), LT),
+            (TMap(INT, INT), Map(TMap(INT, INT), 0, [(1, 2), (3, 4)]), Map(TMap(INT, INT), 0, [(3, 4), (1, 2)]), EQ),
+            (TMap(INT, INT), Map(TMap(INT, INT), 0, [(1, 2)]), Map(TMap(INT, INT), 0, [(1, 3)]), LT),
+            (TMap(INT, INT), Map(TMap(INT, INT), 1, [(1, 2)]), Map(TMap(INT, INT), 0, [(1, 3)]), GT),
+        ]
+        for (typ, v1, v2, res) in cases:
+            self.assertEqual(cmp(typ, v1, v2), res)
+            self.assertEqual(cmp(typ, v2, v1), -res)
+        self.assertEqual(cmp(TBag(t), Bag((Handle(0, 1),)), Bag((Handle(0, 2),)), deep=True), LT)
@@ -0,0 +1,177 @@
+import unittest
+import json
+import os
+import tempfile
+import time
+from multiprocessing import Queue
+
+from cozy.target_syntax import EVar, ENum, EGt, EUnaryOp, TBag, INT
+from cozy.jobs import Job, JobPool
+from cozy.logging import task
+from cozy import tracing
+from cozy.solver import IncrementalSolver, Portfolio, PORTFOLIO, portfolio_size
+
+class FakeJob(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = False
+        self.stop_requested = False
+        self.done = False
+    def start(self):
+        self.started = True
+    def request_stop(self):
+        self.stop_requested = True
+    def __str__(self):
+        return self.name
+
+class TestJobPool(unittest.TestCase):
+
+    def test_pool_size(self):
+        pool = JobPool(size=2, time_slice=1000)
+        js = [FakeJob(str(i)) for i in range(5)]
+        for j in js:
+            pool.add(j)
+        pool.update()
+        self.assertEqual([j.started for j in js], [True, True, False, False, False])
+        js[0].done = True
+        pool.update()
+        self.assertEqual([j.started for j in js], [True, True, True, False, False])
+
+    def test_no_rotation_without_restart(self):
+        pool = JobPool(size=1, time_slice=5)
+        a = FakeJob("a")
+        b = FakeJob("b")
+        pool.add(a)
+        pool.add(b)
+        pool.update()
+        pool.run_time[a] = 10
+        pool.slice_start = 0
+        pool.update()
+        assert a.started and not a.stop_requested and not b.started
+
+    def test_no_rotation_without_time_slice(self):
+        pool = JobPool(size=1, time_slice=0, restart=lambda j: FakeJob(j.name + "'"))
+        a = FakeJob("a")
+        b = FakeJob("b")
+        pool.add(a)
+        pool.add(b)
+        pool.update()
+        pool.run_time[a] = 10
+        pool.slice_start = 0
+        pool.update()
+        assert a.started and not a.stop_requested and not b.started
+
+    def test_rotation(self):
+        pool = JobPool(size=1, time_slice=5, restart=lambda j: FakeJob(j.name + "'"))
+        a = FakeJob("a")
+        b = FakeJob("b")
+        pool.add(a)
+        pool.add(b)
+        pool.update()
+        assert a.started and not b.started
+        pool.run_time[a] = 10
+        pool.slice_start = 0 # force the time slice to expire
+        pool.update()
+        # b waits until a's process is gone
+        assert a.stop_requested and not b.started
+        assert not pool.done
+        a.done = True
+        pool.update()
+        assert b.started
+        assert not pool.done
+        self.assertEqual([str(j) for j in pool], ["a", "b"])
+        pool.run_time[b] = 12
+        pool.credit(b)
+        pool.slice_start = 0
+        pool.update()
+        # b earned another slice
+        assert not b.stop_requested
+        pool.run_time[b] = 30
+        pool.slice_start = 0
+        pool.update()
+        assert b.stop_requested
+        b.done = True
+        pool.update()
+        self.assertEqual([str(j) for j in pool], ["a'", "b"])
+        a2 = pool.jobs[0]
+        assert a2.started and pool.run_time[a2] >= 10
+        a2.done = True
+        pool.update()
+        assert pool.jobs[1].started
+        pool.jobs[1].done = True
+        pool.update()
+        assert pool.done
+
+class TracedJob(Job):
+    def run(self):
+        with task("work", n=1):
+            tracing.instant("milestone")
+    def __str__(self):
+        return "traced"
+
+class TestTracing(unittest.TestCase):
+
+    def test_merged_trace(self):
+        with tempfile.TemporaryDirectory() as d:
+            tracing.trace_dir.value = d
+            tracing.trace_min_duration.value = 0
+            try:
+                with task("parent"):
+                    j = TracedJob()
+                    j.start()
+                    j.join()
+                path = tracing.merge()
+            finally:
+                tracing.close()
+                tracing.trace_dir.value = tracing.trace_dir.default
+                tracing.trace_min_duration.value = tracing.trace_min_duration.default
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+        names = { e["args"]["name"] : e["pid"] for e in events if e["ph"] == "M" }
+        assert names["traced"] != os.getpid()
+        pid = names["traced"]
+        assert any(e["ph"] == "X" and e["name"] == "work" and e["pid"] == pid and e["args"] == {"n": "1"} for e in events)
+        assert any(e["ph"] == "X" and e["name"] == "job" and e["pid"] == pid for e in events)
+        assert any(e["ph"] == "i" and e["name"] == "milestone" and e["pid"] == pid for e in events)
+        assert any(e["ph"] == "X" and e["name"] == "parent" and e["pid"] == os.getpid() for e in events)
+
+class RacingJob(Job):
+    def __init__(self, q):
+        super().__init__()
+        self.q = q
+    def run(self):
+        xs = EVar("xs").with_type(TBag(INT))
+        e = EGt(EUnaryOp("len", xs).with_type(INT), ENum(2).with_type(INT))
+        model = Portfolio(PORTFOLIO).race(IncrementalSolver(), e)
+        self.q.put(len(model["xs"]))
+
+class StuckRacingJob(RacingJob):
+    def run(self):
+        # the patch only affects this job's process and its workers
+        def satisfy(solver, e, model_extraction=True):
+            self.q.put(os.getpid())
+            time.sleep(1000)
+        IncrementalSolver.satisfy = satisfy
+        super().run()
+
+class TestChildProcesses(unittest.TestCase):
+
+    def test_race_inside_job(self):
+        q = Queue()
+        j = RacingJob(q)
+        j.start()
+        n = q.get(timeout=30)
+        j.join()
+        assert j.successful
+        assert n > 2
+
+    def test_kill_stops_race(self):
+        q = Queue()
+        j = StuckRacingJob(q)
+        j.start()
+        pids = [q.get(timeout=30) for i in range(portfolio_size.value)]
+        j.kill()
+        j.join()
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
@@ -0,0 +1,35 @@
+import unittest
+import json
+from urllib.request import urlopen
+
+from cozy.progress_server import ProgressServer, metrics_to_prometheus, with_derived_metrics
+
+class TestProgressServer(unittest.TestCase):
+
+    def test_metrics(self):
+        metrics = { "q": { "considered": 10, "size": 2, "last_improvement": 100.0 } }
+        server = ProgressServer(callback=lambda: "<html></html>", port=0, metrics_callback=lambda: metrics)
+        server.start_async()
+        try:
+            url = "http://localhost:{}".format(server.server_address[1])
+            with urlopen(url + "/") as f:
+                assert f.read() == b"<html></html>"
+            with urlopen(url + "/metrics") as f:
+                m = json.loads(f.read().decode("utf-8"))
+            assert m["q"]["considered"] == 10
+            assert m["q"]["seconds_since_improvement"] > 0
+            with urlopen(url + "/metrics?format=prometheus") as f:
+                text = f.read().decode("utf-8")
+            assert 'cozy_considered_total{query="q"} 10' in text
+        finally:
+            server.join()
+
+    def test_prometheus_format(self):
+        text = metrics_to_prometheus(with_derived_metrics({ "q": { "improvements": 1, "last_improvement": 5.0 } }, now=7.0))
+        self.assertEqual(text,
+            '# TYPE cozy_improvements_total counter\n'
+            'cozy_improvements_total{query="q"} 1\n'
+            '# TYPE cozy_last_improvement gauge\n'
+            'cozy_last_improvement{query="q"} 5.0\n'
+            '# TYPE cozy_seconds_since_improvement gauge\n'
+            'cozy_seconds_since_improvement{query="q"} 2.0\n')
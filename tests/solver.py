@@ -1,12 +1,12 @@
 import unittest
 
 from cozy.common import OrderedSet
-from cozy.solver import satisfy, valid, satisfiable, IncrementalSolver, ModelCachingSolver
+from cozy.solver import satisfy, valid, satisfiable, IncrementalSolver, ModelCachingSolver, query_cache, query_cache_file, record_solver_queries, load_recorded_queries, solver_pool, iterative_deepening, query_cache_size, shrink_model, Portfolio, PORTFOLIO, portfolio_after, EncodingMemo
 from cozy.typecheck import typecheck, retypecheck
 from cozy.target_syntax import *
 from cozy.structures.heaps import *
 from cozy.syntax_tools import pprint, equal, implies, mk_lambda, subst, free_vars
-from cozy.evaluation import eval, Bag, Handle
+from cozy.evaluation import eval, Bag, Handle, Map
 
 zero = ENum(0).with_type(TInt())
 one  = ENum(1).with_type(TInt())
@@ -448,6 +448,194 @@ class TestSolver(unittest.TestCase):
             v = fresh_var(e.type)
             assert i.satisfiable(EEq(e, v))
 
+    def test_encodings_shared_across_queries(self):
+        i = IncrementalSolver(validate_model=True)
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        e = EUnaryOp(UOp.Sum, EMap(xs, ELambda(x, EBinOp(x, "+", ONE).with_type(INT))).with_type(INT_BAG)).with_type(INT)
+        assert i.satisfiable(EBinOp(e, ">", ONE).with_type(BOOL))
+        n = len(i._encodings)
+        assert n > 0
+        i.push()
+        i.add_assumption(EEq(xs, EEmptyList().with_type(INT_BAG)))
+        assert not i.satisfiable(EBinOp(e, ">", ONE).with_type(BOOL))
+        i.pop()
+        self.assertEqual(len(i._encodings), n)
+        assert i.satisfiable(EBinOp(e, ">", ONE).with_type(BOOL))
+
+    def test_encoding_memo(self):
+        m = EncodingMemo(max_size=3)
+        m["a"] = 1
+        m.push()
+        m["b"] = 2
+        m.push()
+        m["c"] = 3
+        m.pop()
+        self.assertEqual((m.get("a"), m.get("b"), m.get("c")), (1, 2, None))
+        m.pop()
+        self.assertEqual(len(m), 1)
+        # when full, the memo starts over, and open scopes forget
+        # everything added since
+        m.push()
+        m["b"] = 2
+        m["c"] = 3
+        m["d"] = 4
+        self.assertEqual((len(m), m.get("d")), (1, 4))
+        m.pop()
+        self.assertEqual(len(m), 0)
+
+    def test_query_cache(self):
+        query_cache.clear()
+        xs = EVar("xs").with_type(INT_BAG)
+        e1 = EUnaryOp(UOp.Any, EMap(xs, ELambda(EVar("x").with_type(INT), EEq(EVar("x").with_type(INT), ONE))).with_type(BOOL_BAG)).with_type(BOOL)
+        e2 = EUnaryOp(UOp.Any, EMap(xs, ELambda(EVar("y").with_type(INT), EEq(EVar("y").with_type(INT), ONE))).with_type(BOOL_BAG)).with_type(BOOL)
+        m1 = satisfy(e1)
+        self.assertEqual(query_cache.hits, 0)
+        m2 = satisfy(e2)
+        self.assertEqual(query_cache.hits, 1)
+        self.assertEqual(m1, m2)
+        assert eval(e2, m2)
+        satisfy(e1, collection_depth=2)
+        self.assertEqual(query_cache.hits, 1)
+        # other solver configurations do not share results
+        satisfy(e1, validate_model=False)
+        satisfy(e1, timeout=10.0)
+        satisfy(e1, logic="QF_LIA")
+        self.assertEqual(query_cache.hits, 1)
+        s = IncrementalSolver()
+        s.add_assumption(EEq(xs, EEmptyList().with_type(INT_BAG)))
+        assert s.satisfy(e1) is None
+        self.assertEqual(query_cache.hits, 1)
+
+    def test_query_cache_file(self):
+        import os, tempfile
+        xs = EVar("xs").with_type(INT_BAG)
+        e = EGt(ELen(xs), ONE)
+        with tempfile.TemporaryDirectory() as d:
+            query_cache_file.value = os.path.join(d, "cache")
+            try:
+                query_cache.clear()
+                m = satisfy(e)
+                query_cache.clear()
+                query_cache.loaded_file = None
+                self.assertEqual(satisfy(e), m)
+                self.assertEqual(query_cache.hits, 1)
+            finally:
+                query_cache_file.value = ""
+                query_cache.clear()
+
+    def test_record_and_replay(self):
+        import os, tempfile
+        from cozy.bench import replay_solver_queries
+        xs = EVar("xs").with_type(INT_BAG)
+        assumption = EGt(ELen(xs), ONE)
+        with tempfile.TemporaryDirectory() as d:
+            record_solver_queries.value = os.path.join(d, "queries")
+            try:
+                s = IncrementalSolver()
+                s.add_assumption(assumption)
+                assert s.satisfy(EGt(ELen(xs), ENum(2).with_type(INT))) is not None
+                assert s.satisfy(ELt(ELen(xs), ONE)) is None
+                records = list(load_recorded_queries(record_solver_queries.value))
+            finally:
+                record_solver_queries.value = ""
+        self.assertEqual([r.sat for r in records], [True, False])
+        assert all(r.assumptions == [assumption] for r in records)
+        self.assertEqual([sat for (r, seconds, sat) in replay_solver_queries(records, repeat=2)], [True, True, False, False])
+
+    def test_solver_pool(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        solver_pool.clear()
+        assert satisfy(EGt(ELen(xs), ONE), vars=[xs]) is not None
+        assert not satisfiable(EAll([EGt(ELen(xs), ONE), ELt(ELen(xs), ONE)]), vars=[xs])
+        assert valid(EGe(ELen(xs), ZERO), vars=[xs])
+        self.assertEqual((solver_pool.misses, solver_pool.hits), (1, 2))
+        # undeclared variables do not outlive their query
+        assert satisfy(EEq(x, ONE)) is not None
+        assert satisfy(EVar("x").with_type(BOOL)) is not None
+        # neither do assertions
+        assert satisfy(EEq(x, ZERO)) is not None
+
+    def test_iterative_deepening(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(TList(INT))
+        m = EVar("m").with_type(TMap(INT, INT))
+        old = (iterative_deepening.value, query_cache_size.value)
+        iterative_deepening.value = True
+        query_cache_size.value = 0
+        try:
+            s = IncrementalSolver()
+            model = s.satisfy(EGt(ELen(xs), ZERO))
+            assert model is not None
+            self.assertEqual(len(model["xs"]), 1)
+            # all collections share the bound of the round that found the model
+            model = s.satisfy(EAll([EGt(ELen(xs), ZERO), EGt(ELen(ys), ONE), EGt(ELen(EMapKeys(m).with_type(INT_BAG)), ZERO)]))
+            assert model is not None
+            self.assertEqual(len(model["ys"]), 2)
+            assert 1 <= len(model["xs"]) <= 2
+            assert 1 <= len(list(model["m"].keys())) <= 2
+            # unsat is only reported at the full collection depth
+            model = s.satisfy(EGt(ELen(xs), ENum(s.collection_depth - 1).with_type(INT)))
+            assert model is not None
+            self.assertEqual(len(model["xs"]), s.collection_depth)
+            assert s.satisfy(EGt(ELen(xs), ENum(s.collection_depth).with_type(INT))) is None
+        finally:
+            iterative_deepening.value, query_cache_size.value = old
+
+    def test_shrink_model(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(TList(INT))
+        m = EVar("m").with_type(TMap(INT, INT))
+        x = EVar("x").with_type(INT)
+        e = EAll([
+            EIn(x, xs),
+            EGt(ELen(ys), ONE),
+            EEq(EMapGet(m, x).with_type(INT), ONE)])
+        assert retypecheck(e)
+        model = {
+            "x": 2,
+            "xs": Bag((1, 2, 2, 3)),
+            "ys": (4, 5, 6),
+            "m": Map(m.type, 0, [(1, 1), (2, 1), (3, 0)])}
+        assert eval(e, model)
+        small = shrink_model(e, model)
+        assert eval(e, small)
+        self.assertEqual(small["xs"], Bag((2,)))
+        self.assertEqual(len(small["ys"]), 2)
+        self.assertEqual(list(small["m"].keys()), [2])
+        self.assertEqual(small["x"], 2)
+
+    def test_portfolio(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(INT_BAG)
+        p = Portfolio([c for c in PORTFOLIO if c.name in ("shallow", "default")])
+        s = IncrementalSolver(collection_depth=4)
+        # the shallow configuration cannot find this model, and its "unsat"
+        # must not count
+        model = p.race(s, EGt(ELen(xs), ENum(2).with_type(INT)))
+        assert model is not None
+        assert len(model["xs"]) > 2
+        assert p.race(s, EGt(ELen(xs), ENum(4).with_type(INT))) is None
+        # only the default configuration can answer both definitively
+        self.assertEqual(p.stats()["default"], [2, 2])
+        self.assertEqual(p.stats()["shallow"][0], 0)
+        # slow queries go to the portfolio
+        old = (portfolio_after.value, query_cache_size.value)
+        portfolio_after.value = 1
+        query_cache_size.value = 0
+        try:
+            e = EAll([
+                EEq(EUnaryOp(UOp.Sum, xs).with_type(INT), EUnaryOp(UOp.Sum, ys).with_type(INT)),
+                ENot(EEq(xs, ys)),
+                EGt(ELen(xs), ENum(2).with_type(INT))])
+            assert retypecheck(e)
+            model = s.satisfy(e)
+            assert model is not None
+            assert eval(e, model)
+        finally:
+            portfolio_after.value, query_cache_size.value = old
+
     def test_list_slice(self):
         e = EListSlice(EVar('xs').with_type(TList(TFloat())), ENum(0).with_type(TInt()), EVar('index').with_type(TInt())).with_type(TList(TFloat()))
         check_encoding(e)
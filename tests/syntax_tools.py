@@ -116,6 +116,19 @@ class TestSyntaxTools(unittest.TestCase):
         print(free_vars(e))
         assert free_vars(e) == OrderedSet([EVar('l').with_type(TBag(INT)), EVar('n').with_type(INT), EVar('_var111').with_type(INT)])
 
+    def test_fvs_statevar_cold_and_warm_cache(self):
+        def mk():
+            x = EVar("x").with_type(INT)
+            sv = EStateVar(x).with_type(INT)
+            return sv, ELambda(x, EBinOp(sv, "+", x).with_type(INT))
+        sv, e = mk()
+        cold = list(free_vars(e))
+        sv, e = mk()
+        free_vars(sv)
+        warm = list(free_vars(e))
+        self.assertEqual(cold, [EVar("x")])
+        self.assertEqual(warm, cold)
+
     def test_recursive_adt_repr(self):
         e = EStateVar(None)
         e.e = e
@@ -1153,3 +1166,68 @@ class TestConditionals(unittest.TestCase):
         assert isinstance(s, SIf)
         assert "let a = 2;" in new_form
         assert "let g = 3;" in new_form
+
+    def test_hash_cons(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(BOOL_BAG)
+        x = EVar("x").with_type(INT)
+        e1 = EMap(xs, ELambda(x, EBinOp(x, "+", ONE).with_type(INT))).with_type(INT_BAG)
+        e2 = EMap(xs, ELambda(x, EBinOp(x, "+", ONE).with_type(INT))).with_type(INT_BAG)
+        assert e1 is not e2
+        h1 = hash_cons(e1)
+        h2 = hash_cons(e2)
+        assert h1 is h2
+        assert h1 == e1
+        assert hash_cons(EBinOp(ONE, "+", ONE).with_type(INT)).e1 is h1.f.body.e2
+        # nodes that differ only in their types are kept apart
+        l1 = hash_cons(ELen(xs).with_type(INT))
+        l2 = hash_cons(ELen(EVar("xs").with_type(BOOL_BAG)).with_type(INT))
+        assert l1 is not l2
+        assert l1.e.type == INT_BAG
+        assert l2.e.type == BOOL_BAG
+
+    def test_cached_size_and_free_vars(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        body = EBinOp(x, "+", y).with_type(INT)
+        e = EMap(EVar("xs").with_type(INT_BAG), ELambda(x, body)).with_type(INT_BAG)
+        n = e.size()
+        self.assertEqual(n, deep_copy(e).size())
+        self.assertEqual(list(free_vars(e)), [EVar("xs"), y])
+        self.assertEqual(free_vars(e, counts=True)[y], 1)
+        # in-place changes invalidate cached results
+        body.e2 = EBinOp(y, "+", EVar("z").with_type(INT)).with_type(INT)
+        self.assertEqual(e.size(), n + 4)
+        self.assertEqual(e.size(), deep_copy(e).size())
+        self.assertEqual(list(free_vars(e)), [EVar("xs"), y, EVar("z")])
+        # results are copies
+        free_vars(e).add(x)
+        assert x not in free_vars(e)
+
+    def test_alpha_key(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        exps = [
+            EMap(xs, ELambda(x, EBinOp(x, "+", ONE).with_type(INT))).with_type(INT_BAG),
+            EMap(xs, ELambda(y, EBinOp(y, "+", ONE).with_type(INT))).with_type(INT_BAG),
+            EMap(xs, ELambda(y, EBinOp(x, "+", ONE).with_type(INT))).with_type(INT_BAG),
+            EMap(xs, ELambda(x, EMap(xs, ELambda(y, x)).with_type(INT_BAG))).with_type(TBag(INT_BAG)),
+            EMap(xs, ELambda(y, EMap(xs, ELambda(x, y)).with_type(INT_BAG))).with_type(TBag(INT_BAG)),
+            EMap(xs, ELambda(x, EMap(xs, ELambda(y, y)).with_type(INT_BAG))).with_type(TBag(INT_BAG)),
+            EBinOp(x, "+", y).with_type(INT),
+            EBinOp(y, "+", x).with_type(INT)]
+        for e1 in exps:
+            for e2 in exps:
+                self.assertEqual(alpha_key(e1) == alpha_key(e2), alpha_equivalent(e1, e2), "{} vs {}".format(pprint(e1), pprint(e2)))
+        self.assertEqual(len({ alpha_key(e) for e in exps }), 6)
+        self.assertNotEqual(alpha_key(ELen(xs).with_type(INT), typed=True), alpha_key(ELen(EVar("xs").with_type(BOOL_BAG)).with_type(INT), typed=True))
+
+    def test_typed_alpha_key_after_retyping(self):
+        x = EVar("x").with_type(INT)
+        e = EBinOp(x, "+", ONE).with_type(INT)
+        k = alpha_key(e, typed=True)
+        x.with_type(LONG)
+        assert alpha_key(e, typed=True) != k
+        e.with_type(LONG)
+        self.assertEqual(alpha_key(e, typed=True), alpha_key(EBinOp(EVar("x").with_type(LONG), "+", ONE).with_type(LONG), typed=True))
@@ -1,12 +1,18 @@
 import unittest
+import datetime
 
-from cozy.syntax_tools import mk_lambda, pprint, alpha_equivalent, subst, strip_EStateVar
+from cozy.syntax_tools import mk_lambda, pprint, alpha_equivalent, subst, strip_EStateVar, freshen_binders
 from cozy.target_syntax import *
-from cozy.contexts import RootCtx
+from cozy.contexts import RootCtx, shred, replace
+from cozy.pools import RUNTIME_POOL
 from cozy.typecheck import retypecheck
-from cozy.evaluation import Bag, mkval
-from cozy.synthesis.core import improve
-from cozy.solver import valid, satisfy
+from cozy.evaluation import Bag, mkval, construct_value
+from cozy.synthesis import core
+from cozy.synthesis.core import improve, SubstitutionTemplate, more_counterexamples
+from cozy.synthesis.enumeration import fingerprint
+from cozy.solver import valid, satisfy, IncrementalSolver
+from cozy.common import StopException
+from cozy.timeouts import Timeout
 
 handle_type = THandle("H", INT)
 handle1 = (1, mkval(INT))
@@ -40,6 +46,119 @@ class TestSynthesisCore(unittest.TestCase):
         assert retypecheck(assumptions)
         assert check_discovery(target, EStateVar(EVar("xs")), args=[x], state_vars=[xs], assumptions=assumptions)
 
+    def test_resume(self):
+        x = EVar("x").with_type(BOOL)
+        xs = EVar("xs").with_type(TBag(BOOL))
+        target = EFilter(EStateVar(xs), ELambda(x, x))
+        assumptions = EUnaryOp(UOp.All, xs)
+        assert retypecheck(target)
+        assert retypecheck(assumptions)
+        ctx = RootCtx(state_vars=[xs], args=[x])
+        progress = []
+        found = [False]
+        try:
+            for r in improve(target, assumptions=assumptions, context=ctx,
+                    stop_callback=lambda: found[0],
+                    progress_callback=lambda examples, frontier: progress.append((examples, frontier))):
+                if alpha_equivalent(r, EStateVar(xs)):
+                    found[0] = True
+        except StopException:
+            pass
+        assert found[0]
+        assert progress
+        examples, frontier = progress[-1]
+        assert any(alpha_equivalent(e, EStateVar(xs)) for e in frontier)
+        timeout = Timeout(datetime.timedelta(seconds=2))
+        try:
+            for r in improve(target, assumptions=assumptions, context=ctx,
+                    examples=examples, frontier=frontier,
+                    stop_callback=timeout.is_timed_out):
+                # the resumed search already knows about `xs`
+                assert not alpha_equivalent(r, EStateVar(xs))
+        except StopException:
+            pass
+
+    def test_metrics(self):
+        x = EVar("x").with_type(BOOL)
+        xs = EVar("xs").with_type(TBag(BOOL))
+        target = EFilter(EStateVar(xs), ELambda(x, x))
+        assumptions = EUnaryOp(UOp.All, xs)
+        assert retypecheck(target)
+        assert retypecheck(assumptions)
+        ctx = RootCtx(state_vars=[xs], args=[x])
+        metrics = []
+        old_interval = core.METRICS_INTERVAL
+        core.METRICS_INTERVAL = 0
+        try:
+            for r in improve(target, assumptions=assumptions, context=ctx,
+                    stop_callback=lambda: len(metrics) > 20,
+                    metrics_callback=metrics.append):
+                pass
+        except StopException:
+            pass
+        finally:
+            core.METRICS_INTERVAL = old_interval
+        assert metrics
+        m = metrics[-1]
+        for k in ("considered", "considered_per_second", "size", "cache_size", "solver_calls", "wf_solver_calls", "wf_solver_hits", "counterexamples", "improvements", "last_improvement"):
+            assert k in m, k
+        assert m["considered"] > 0
+        assert all(a["considered"] <= b["considered"] for (a, b) in zip(metrics, metrics[1:]))
+
+    def test_more_counterexamples(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        candidate = EUnaryOp(UOp.Length, xs).with_type(INT)
+        solver = IncrementalSolver(vars=[x, xs])
+        solver.add_assumption(ENot(EEq(candidate, x)))
+        solver.push()
+        examples = more_counterexamples(solver, candidate, [], 3)
+        solver.pop()
+        self.assertEqual(len(examples), 3)
+        self.assertEqual(len(set(len(ex["xs"]) for ex in examples)), 3)
+        # stops early when the candidate has no more distinct outputs
+        solver.add_assumption(EUnaryOp(UOp.Empty, xs).with_type(BOOL))
+        self.assertEqual(len(more_counterexamples(solver, candidate, [], 3)), 1)
+
+    def test_easy_synth_many_counterexamples(self):
+        old = core.counterexamples_per_failure.value
+        core.counterexamples_per_failure.value = 3
+        try:
+            self.test_easy_synth()
+        finally:
+            core.counterexamples_per_failure.value = old
+
+    def test_prune_examples(self):
+        old = core.prune_examples.value
+        core.prune_examples.value = 1
+        try:
+            self.test_easy_synth()
+            self.test_bag_plus_minus()
+        finally:
+            core.prune_examples.value = old
+
+    def test_substitution_template(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        y = EVar("y").with_type(INT)
+        target = EUnaryOp(UOp.Sum, EMap(
+            EFilter(EStateVar(xs), mk_lambda(INT, lambda x: EEq(x, y))),
+            mk_lambda(INT, lambda x: EBinOp(x, "+", EUnaryOp(UOp.Length, EStateVar(xs)).with_type(INT)).with_type(INT))).with_type(INT_BAG)).with_type(INT)
+        assert retypecheck(target)
+        ctx = RootCtx(state_vars=[xs], args=[y])
+        target = freshen_binders(target, ctx)
+        examples = [
+            {"xs": Bag((1, 2, 2, 3)), "y": 2},
+            {"xs": Bag(()), "y": 0},
+            {"xs": Bag((5, 1)), "y": 1}]
+        for e, e_ctx, pool in shred(target, ctx):
+            t = SubstitutionTemplate(target, ctx, e, e_ctx, pool, examples)
+            replacements = [e, construct_value(e.type)]
+            replacements.extend(v for (v, p) in e_ctx.vars() if v.type == e.type)
+            for r in replacements:
+                expected = fingerprint(freshen_binders(replace(target, ctx, RUNTIME_POOL, e, e_ctx, pool, r), ctx), examples)
+                assert t.fingerprint(r) == expected, "replacing {} with {}".format(pprint(e), pprint(r))
+                assert alpha_equivalent(t.instantiate(r), replace(target, ctx, RUNTIME_POOL, e, e_ctx, pool, r))
+
     def test_bag_plus_minus(self):
         t = THandle("H", INT)
         x = EVar("x").with_type(t)